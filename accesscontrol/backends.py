@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 import json
 
-import requests
 from datetime import datetime
 from django.conf import settings
 from django.contrib.auth.models import Group
 from django.db.models import Q
 
+from ikwen.core import http_client
 from ikwen.core.utils import add_event, get_service_instance
 from permission_backend_nonrel.models import UserPermissionList
 
@@ -114,7 +114,7 @@ def check_user_remote(username=None, password=None):
         'username': username,
         'password': password
     }
-    r = requests.get(endpoint, params=params)
+    r = http_client.get(endpoint, params=params)
     response = json.loads(r.content.decode('utf8'))
     if response.get('success'):
         return response['member']
@@ -17,6 +17,7 @@ from permission_backend_nonrel.models import UserPermissionList
 from ikwen.core.constants import DEVICE_FAMILY_CHOICES
 from ikwen.accesscontrol.templatetags.auth_tokens import ikwenize
 from ikwen.core.fields import MultiImageField
+from ikwen.core.search import get_member_search_tokens
 from ikwen.core.models import Service, Model, OperatorWallet
 from ikwen.core.utils import add_event, to_dict, get_service_instance, add_database_to_settings
 
@@ -128,6 +129,8 @@ class Member(AbstractUser):
                                              "enrolled in revivals without actually having an account on the website")
     full_name = models.CharField(max_length=150, db_index=True)
     tags = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    search_tokens = ListField(db_index=True, editable=False,
+                              help_text="Prefixes of words of names, email and phone, used to search Members.")
     phone = models.CharField(max_length=30, db_index=True, blank=True, null=True)
     gender = models.CharField(max_length=15, blank=True, null=True)
     dob = models.DateField(blank=True, null=True, db_index=True)
@@ -171,6 +174,7 @@ class Member(AbstractUser):
     def save(self, **kwargs):
         if self.dob:
             self.birthday = int(self.dob.strftime('%m%d'))
+        self.search_tokens = get_member_search_tokens(self.first_name, self.last_name, self.email, self.phone)
         super(Member, self).save(**kwargs)
 
     def get_short_name(self):
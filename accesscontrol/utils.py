@@ -34,6 +34,7 @@ from ikwen.accesscontrol.models import Member, DEFAULT_GHOST_PWD, PWAProfile
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.core.models import Service, XEmailObject
 from ikwen.core.constants import MALE, FEMALE
+from ikwen.core.search import get_member_search_tokens
 from ikwen.core.utils import get_service_instance, get_mail_content, send_sms, XEmailMessage, get_device_type
 from ikwen.revival.models import MemberProfile, ProfileTag, Revival
 from ikwen.revival.utils import set_profile_tag_member_count
@@ -430,8 +431,12 @@ def shift_ghost_member(member, db='default'):
     shifted_phone = '__' + phone
     shifted_email = '__' + member.email
     shifted_username = '__' + member.username
-    Member.objects.using(db).filter(phone=phone, is_ghost=True).update(phone=shifted_phone)
-    Member.objects.using(db).filter(email=member.email, is_ghost=True).update(email=shifted_email)
+    for ghost in Member.objects.using(db).filter(phone=phone, is_ghost=True):
+        search_tokens = get_member_search_tokens(ghost.first_name, ghost.last_name, ghost.email, shifted_phone)
+        Member.objects.using(db).filter(pk=ghost.id).update(phone=shifted_phone, search_tokens=search_tokens)
+    for ghost in Member.objects.using(db).filter(email=member.email, is_ghost=True):
+        search_tokens = get_member_search_tokens(ghost.first_name, ghost.last_name, shifted_email, ghost.phone)
+        Member.objects.using(db).filter(pk=ghost.id).update(email=shifted_email, search_tokens=search_tokens)
     Member.objects.using(db).filter(username=member.username, is_ghost=True).update(username=shifted_username)
 
 
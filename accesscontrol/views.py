@@ -44,6 +44,9 @@ from ikwen.accesscontrol.admin import MemberResource
 from ikwen.accesscontrol.templatetags.auth_tokens import ikwenize
 from ikwen.core.constants import MALE, FEMALE
 from ikwen.core.models import Application, Service, ConsoleEvent, WELCOME_ON_IKWEN_EVENT, XEmailObject
+from ikwen.core.outbox import enqueue_event, enqueue_mail
+from ikwen.core.pagination import CACHED_COUNT
+from ikwen.core.search import PrefixTokenSearchBackend, get_member_search_tokens
 from ikwen.core.utils import get_service_instance, get_mail_content, add_database_to_settings, add_event, set_counters, \
     increment_history_field, XEmailMessage, DefaultUploadBackend
 from ikwen.core.utils import send_sms
@@ -766,6 +769,8 @@ class Community(HybridListView):
     context_object_name = 'nonrel_perm_list'
     ordering = ('-id', )
     ajax_ordering = ('-id', )
+    keyset_pagination = True
+    count_mode = CACHED_COUNT
     show_import = True
     export_resource = MemberResource
 
@@ -928,8 +933,10 @@ class Community(HybridListView):
             phone = email
         if member_id:
             full_name = first_name + ' ' + last_name
+            search_tokens = get_member_search_tokens(first_name, last_name, email, phone)
             Member.objects.filter(pk=member_id).update(first_name=first_name, last_name=last_name, full_name=full_name,
-                                                       email=email, phone=phone, gender=gender)
+                                                       email=email, phone=phone, gender=gender,
+                                                       search_tokens=search_tokens)
             member = Member.objects.get(pk=member_id)
             member_profile = MemberProfile.objects.get(member=member)
             previous_tag_fk_list = member_profile.tag_fk_list
@@ -990,7 +997,8 @@ upload_contacts_file = AjaxFileUploader(ContactsUploadBackend)
 class MemberList(HybridListView):
     context_object_name = 'customer_list'
     model = Member
-    search_field = 'tags'
+    search_field = 'search_tokens'
+    search_backend = PrefixTokenSearchBackend()
     ordering = ('first_name', '-id', )
     ajax_ordering = ('first_name', '-id', )
 
@@ -1055,8 +1063,8 @@ def join(request, *args, **kwargs):
     obj_list, created = UserPermissionList.objects.using(db).get_or_create(user=member)
     obj_list.group_fk_list.append(group.id)
     obj_list.save(using=db)
-    add_event(service, WELCOME_EVENT, member=member, object_id=rq.id)
-    add_event(service, ACCESS_GRANTED_EVENT, member=service.member, object_id=rq.id)
+    enqueue_event(service, WELCOME_EVENT, member=member, object_id=rq.id)
+    enqueue_event(service, ACCESS_GRANTED_EVENT, member=service.member, object_id=rq.id)
     set_counters(service)
     increment_history_field(service, 'community_history')
     events = getattr(settings, 'IKWEN_REGISTER_EVENTS', ())
@@ -1086,7 +1094,7 @@ def join(request, *args, **kwargs):
     sender = '%s <no-reply@%s>' % (host_service.project_name, host_service.domain)
     msg = XEmailMessage(subject, html_content, sender, [member.email])
     msg.content_subtype = "html"
-    Thread(target=lambda m: m.send(), args=(msg, )).start()
+    enqueue_mail(msg)
     if referrer_id:
         referrer = Member.objects.get(pk=referrer_id)
         bind_referrer_to_member(request, service)
@@ -1121,7 +1129,7 @@ def join(request, *args, **kwargs):
             msg.content_subtype = "html"
             msg.service = service
             msg.type = XEmailObject.REWARDING
-            Thread(target=lambda m: m.send(), args=(msg, )).start()
+            enqueue_mail(msg)
 
     if format == 'json':
         response = {'success': True, 'reward': reward, 'project_name': service.project_name,
@@ -22,6 +22,7 @@ from ikwen.billing.utils import get_payment_confirmation_message, get_invoice_ge
     get_next_invoice_number, get_subscription_registered_message, get_subscription_model, get_product_model, \
     get_invoicing_config_instance, get_days_count, share_payment_and_set_stats
 from ikwen.core.admin import CustomBaseAdmin
+from ikwen.core.local_cache import bump_service_cache_version
 from ikwen.core.models import QueuedSMS, Config, Application, Service, RETAIL_APP_SLUG
 from ikwen.core.utils import get_service_instance, get_mail_content, send_sms, add_event, add_database
 from ikwen.partnership.models import ApplicationRetailConfig
@@ -366,6 +367,7 @@ class InvoiceAdmin(CustomBaseAdmin, ImportExportMixin):
             if s.retailer:
                 db = s.retailer.database
                 Service.objects.using(db).filter(pk=s.id).update(expiry=s.expiry, status=s.status, version=s.version)
+                bump_service_cache_version(s.id)  # update() bypasses Service.save()
 
             sudo_group = Group.objects.using(UMBRELLA).get(name=SUDO)
             add_event(service, PAYMENT_CONFIRMATION, group_id=sudo_group.id, object_id=invoice.id)
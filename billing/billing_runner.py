@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs billing crons of all Services in parallel.
+
+Services having an InvoicingConfig are handed to the processes of a pool, where the
+billing tasks run for that Service only, exactly as the invoicing_crons script runs
+them for all Services. Each worker has its own database connections. SMTP connections
+and SMS sent by all workers are bounded by a shared semaphore and rate limiter.
+
+Counts of all Services are summed up in a SendingReport per task, and the time spent
+on each Service is logged so that slow ones can be identified.
+
+Run it from the crontab every day in place of invoicing_crons.py:
+python billing_runner.py [bundles] [--workers=4] [--smtp-connections=8] [--sms-rate=10]
+
+With the bundles option, bundle_crons.send_expiry_reminders issues Invoices instead
+of invoicing_crons.send_invoices.
+"""
+import os
+import sys
+
+sys.path.append("/home/libran/virtualenv/lib/python2.7/site-packages")
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ikwen.conf.settings")
+
+import logging.handlers
+from datetime import datetime, timedelta
+from multiprocessing import Pool, BoundedSemaphore
+
+from django.db import connections
+from django.utils.log import AdminEmailHandler
+
+from ikwen.core import http_client
+from ikwen.core.models import Service
+from ikwen.core.sms import SharedRateLimiter
+from ikwen.core.utils import get_service_instance, set_smtp_slots, set_sms_rate_limiter
+from ikwen.billing.models import InvoicingConfig, SendingReport
+from ikwen.billing import invoicing_crons, bundle_crons
+
+logger = logging.getLogger('crons.error')
+logger.setLevel(logging.DEBUG)
+file_handler = logging.handlers.RotatingFileHandler('billing_runner.log', 'w', 1000000, 4)
+file_handler.setLevel(logging.INFO)
+f = logging.Formatter('%(levelname)-10s %(asctime)-27s %(message)s')
+file_handler.setFormatter(f)
+email_handler = AdminEmailHandler()
+email_handler.setLevel(logging.ERROR)
+email_handler.setFormatter(f)
+logger.addHandler(file_handler)
+logger.addHandler(email_handler)
+
+DEFAULT_WORKERS = 4
+DEFAULT_SMTP_CONNECTIONS = 8
+DEFAULT_SMS_RATE = 10  # SMS per second over all workers
+MAX_TASKS_PER_CHILD = 20  # Worker processes are recycled after that many Services
+SLOWEST_COUNT = 10  # Number of slowest Services listed at the end of the run
+
+TASKS = {
+    'send_invoices': invoicing_crons.send_invoices,
+    'send_expiry_reminders': bundle_crons.send_expiry_reminders,
+    'send_invoice_reminders': invoicing_crons.send_invoice_reminders,
+    'send_invoice_overdue_notices': invoicing_crons.send_invoice_overdue_notices,
+    'suspend_customers_services': invoicing_crons.suspend_customers_services,
+}
+INVOICING_TASKS = ('send_invoices', 'send_invoice_reminders', 'send_invoice_overdue_notices',
+                   'suspend_customers_services')
+BUNDLE_TASKS = ('send_expiry_reminders', 'send_invoice_reminders', 'send_invoice_overdue_notices',
+                'suspend_customers_services')
+
+
+def _close_db_connections():
+    for connection in connections.all():
+        try:
+            connection.close()
+        except:
+            pass
+
+
+def _init_worker(smtp_slots, sms_rate_limiter):
+    # Connections inherited from the parent process must not be shared
+    _close_db_connections()
+    http_client.reset_session()
+    set_smtp_slots(smtp_slots)
+    set_sms_rate_limiter(sms_rate_limiter)
+
+
+def get_service_id_list():
+    """
+    Ids of active Services having an InvoicingConfig, except ikwen itself.
+    """
+    ikwen_service = get_service_instance()
+    service_id_list = [invoicing_config.service_id
+                       for invoicing_config in InvoicingConfig.objects.exclude(service=ikwen_service)]
+    return [service.id for service in Service.objects.filter(pk__in=service_id_list, status=Service.ACTIVE)]
+
+
+def run_service_billing(service_id, task_list=INVOICING_TASKS):
+    """
+    Runs billing tasks of a Service one after the other. Errors are logged so that
+    they never stop other tasks or Services.
+
+    :return: service_id and a dict of (count, total_amount, duration) keyed by task
+    """
+    stats = {}
+    for task in task_list:
+        t0 = datetime.now()
+        count, total_amount = 0, 0
+        try:
+            count, total_amount = TASKS[task](service_id=service_id)
+        except:
+            logger.error(u"%s failed for Service %s" % (task, service_id), exc_info=True)
+        stats[task] = count, total_amount, datetime.now() - t0
+    return service_id, stats
+
+
+def _run_service_billing(args):
+    return run_service_billing(*args)
+
+
+def save_reports(totals):
+    """
+    Saves a SendingReport summing up counts of all Services for each task in *totals*.
+    """
+    for task, (count, total_amount) in totals.items():
+        SendingReport.objects.create(task=task, count=count, total_amount=total_amount)
+        logger.debug(u"%s: %d Invoices for a total of %s" % (task, count, total_amount))
+
+
+def run(task_list=INVOICING_TASKS, workers=DEFAULT_WORKERS, smtp_connections=DEFAULT_SMTP_CONNECTIONS,
+        sms_rate=DEFAULT_SMS_RATE):
+    t0 = datetime.now()
+    service_id_list = get_service_id_list()
+    logger.debug(u"Running billing of %d Services with %d workers" % (len(service_id_list), workers))
+    if not service_id_list:
+        return
+    _close_db_connections()
+    smtp_slots = BoundedSemaphore(smtp_connections)
+    sms_rate_limiter = SharedRateLimiter(sms_rate)
+    pool = Pool(workers, _init_worker, (smtp_slots, sms_rate_limiter), MAX_TASKS_PER_CHILD)
+    totals = dict((task, (0, 0)) for task in task_list)
+    durations = []
+    try:
+        args_list = [(service_id, task_list) for service_id in service_id_list]
+        for service_id, stats in pool.imap_unordered(_run_service_billing, args_list):
+            duration = timedelta(0)
+            for task, (count, total_amount, task_duration) in stats.items():
+                totals[task] = totals[task][0] + count, totals[task][1] + total_amount
+                duration += task_duration
+            durations.append((duration, service_id))
+            logger.info(u"Billing of Service %s run in %s: %s" % (service_id, duration, ', '.join(
+                ["%s %s (%d)" % (task, stats[task][2], stats[task][0]) for task in task_list])))
+    finally:
+        pool.close()
+        pool.join()
+    save_reports(totals)
+    durations.sort(reverse=True)
+    logger.info(u"Slowest Services: %s" % ', '.join(["%s (%s)" % (service_id, duration)
+                                                     for duration, service_id in durations[:SLOWEST_COUNT]]))
+    logger.debug(u"Billing of %d Services run in %s" % (len(service_id_list), datetime.now() - t0))
+
+
+def _get_option(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith('--%s=' % name):
+            return int(arg.split('=')[1])
+    return default
+
+
+if __name__ == "__main__":
+    try:
+        task_list = BUNDLE_TASKS if 'bundles' in sys.argv[1:] else INVOICING_TASKS
+        run(task_list, _get_option('workers', DEFAULT_WORKERS),
+            _get_option('smtp-connections', DEFAULT_SMTP_CONNECTIONS), _get_option('sms-rate', DEFAULT_SMS_RATE))
+    except:
+        logger.error(u"Fatal error occured, billing not run", exc_info=True)
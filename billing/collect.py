@@ -20,6 +20,7 @@ from django.utils.translation import gettext as _, activate
 from ikwen.conf.settings import WALLETS_DB_ALIAS
 from ikwen.core.constants import CONFIRMED
 from ikwen.core.models import Service
+from ikwen.core.outbox import enqueue_event, enqueue_mail
 from ikwen.core.utils import add_database_to_settings, get_service_instance, add_event, get_mail_content, XEmailMessage
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.accesscontrol.models import SUDO
@@ -137,8 +138,8 @@ def confirm_service_invoice_payment(request, *args, **kwargs):
     else:
         vendor = ikwen_service
         sudo_group = Group.objects.using(UMBRELLA).get(name=SUDO)
-    add_event(vendor, PAYMENT_CONFIRMATION, member=member, object_id=invoice.id)
-    add_event(vendor, PAYMENT_CONFIRMATION, group_id=sudo_group.id, object_id=invoice.id)
+    enqueue_event(vendor, PAYMENT_CONFIRMATION, member=member, object_id=invoice.id)
+    enqueue_event(vendor, PAYMENT_CONFIRMATION, group_id=sudo_group.id, object_id=invoice.id)
 
     try:
         invoice_pdf_file = generate_pdf_invoice(invoicing_config, invoice)
@@ -163,7 +164,7 @@ def confirm_service_invoice_payment(request, *args, **kwargs):
         if getattr(settings, 'UNIT_TESTING', False):
             msg.send()
         else:
-            Thread(target=lambda m: m.send(), args=(msg,)).start()
+            enqueue_mail(msg)
     return HttpResponse("Notification received")
 
 
@@ -227,8 +228,8 @@ def confirm_invoice_payment(request, *args, **kwargs):
     member = invoice.member
     sudo_group = Group.objects.using(UMBRELLA).get(name=SUDO)
     if member:
-        add_event(service, PAYMENT_CONFIRMATION, member=member, object_id=invoice.id)
-    add_event(service, PAYMENT_CONFIRMATION, group_id=sudo_group.id, object_id=invoice.id)
+        enqueue_event(service, PAYMENT_CONFIRMATION, member=member, object_id=invoice.id)
+    enqueue_event(service, PAYMENT_CONFIRMATION, group_id=sudo_group.id, object_id=invoice.id)
 
     if invoicing_config.return_url:
         params = {'reference_id': subscription.reference_id, 'invoice_number': invoice.number,
@@ -264,7 +265,7 @@ def confirm_invoice_payment(request, *args, **kwargs):
                 msg.attach_file(invoice_pdf_file)
             balance.mail_count -= 1
             balance.save()
-            Thread(target=lambda m: m.send(), args=(msg,)).start()
+            enqueue_mail(msg)
     return HttpResponse("Notification received")
 
 
@@ -19,15 +19,18 @@ from django.utils.translation import gettext as _, activate
 from ikwen.accesscontrol.models import SUDO
 
 from ikwen.core.models import Config, QueuedSMS, Service
-from ikwen.core.utils import get_service_instance, send_sms, add_event
+from ikwen.core.sms import SMSDispatcher
+from ikwen.core.utils import get_service_instance, add_event
 from ikwen.core.utils import get_mail_content
 from ikwen.billing.models import Invoice, InvoicingConfig, INVOICES_SENT_EVENT, \
     NEW_INVOICE_EVENT, INVOICE_REMINDER_EVENT, REMINDERS_SENT_EVENT, OVERDUE_NOTICE_EVENT, OVERDUE_NOTICES_SENT_EVENT, \
-    SUSPENSION_NOTICES_SENT_EVENT, SERVICE_SUSPENDED_EVENT, SendingReport, IkwenInvoiceItem, InvoiceEntry
+    SUSPENSION_NOTICES_SENT_EVENT, SERVICE_SUSPENDED_EVENT, SendingReport, IkwenInvoiceItem, InvoiceEntry, \
+    InvoiceNotice
 from ikwen.billing.utils import get_invoice_generated_message, get_invoice_reminder_message, \
     get_invoice_overdue_message, \
-    get_service_suspension_message, get_next_invoice_number, get_subscription_model, get_billing_cycle_months_count, \
-    pay_with_wallet_balance, generate_pdf_invoice
+    get_service_suspension_message, InvoiceNumberAllocator, get_subscription_model, get_billing_cycle_months_count, \
+    pay_with_wallet_balance, generate_pdf_invoice, generate_pdf_invoices, get_invoice_notice_campaign, \
+    render_invoice_notice, get_pending_invoice_subscription_ids, get_invoice_sms_callback, claim_invoice_notice
 from ikwen.partnership.models import ApplicationRetailConfig
 from ikwen.rewarding.models import CROperatorProfile
 
@@ -46,6 +49,8 @@ logger.addHandler(email_handler)
 
 Subscription = get_subscription_model()
 
+INVOICE_NOTICE_CHUNK = 50  # Invoices issued before their PDF are generated and they are notified
+
 
 def _init_base_vars():
     """
@@ -78,19 +83,16 @@ def _set_actual_vendor(subscription, vendor, config):
             config = vendor.config
 
 
-def _get_email_msg(member, subject, message, invoice, vendor, config):
+def _get_email_msg(member, subject, message, invoice, vendor, config, campaign=None):
     """
-    Returns a ready to send HTML EmailMessage object from data in parameters
+    Returns a ready to send HTML EmailMessage object from data in parameters.
+    *campaign* is the MailCampaign of the notices being sent in the loop, if any.
     """
     activate(member.language)
     invoice_url = 'http://ikwen.com' + reverse('billing:invoice_detail', args=(invoice.id,))
-    html_content = get_mail_content(subject, message, template_name='billing/mails/notice.html',
-                                    extra_context={'member_name': member.first_name, 'invoice': invoice,
-                                                   'invoice_url': invoice_url, 'cta': _("Pay now"),
-                                                   'currency': config.currency_symbol, 'service': vendor,
-                                                   'config': config, 'logo': config.logo,
-                                                   'project_name': vendor.project_name,
-                                                   'company_name': config.company_name})
+    if not campaign:
+        campaign = get_invoice_notice_campaign(vendor, config)
+    html_content = render_invoice_notice(campaign, member, subject, message, invoice, invoice_url)
     # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
     # to be delivered to Spams because of origin check.
     sender = '%s <no-reply@%s>' % (config.company_name, vendor.domain)
@@ -99,29 +101,113 @@ def _get_email_msg(member, subject, message, invoice, vendor, config):
     return msg
 
 
+def _notify_new_invoices(issued_list, vendor, config, invoicing_config, notice_campaign, sms_dispatcher,
+                         pdf_vendor_cache):
+    """
+    Sends the mail and SMS of new Invoices in *issued_list* made of (subscription, invoice,
+    paid_by_wallet_debit) tuples. Each notice is claimed first so that an Invoice is
+    notified once, even when a run interrupted after issuing it is started again.
+    """
+    # PDF of Invoices to mail are generated at once by a pool of processes. Those
+    # attached below are then found on disk rather than generated one after the other.
+    try:
+        generate_pdf_invoices([invoice.id for subscription, invoice, paid_by_wallet_debit in issued_list
+                               if subscription.member.email])
+    except:
+        logger.error(u"Could not generate PDF of Invoices in batch", exc_info=True)
+
+    for subscription, invoice, paid_by_wallet_debit in issued_list:
+        if not claim_invoice_notice(invoice, InvoiceNotice.INVOICE):
+            continue  # Already notified
+        member = subscription.member
+        number = invoice.number
+        subject, message, sms_text = get_invoice_generated_message(invoice)
+
+        if member.email:
+            activate(member.language)
+            invoice_url = 'http://ikwen.com' + reverse('billing:invoice_detail', args=(invoice.id,))
+            if paid_by_wallet_debit:
+                subject = _("Thanks for your payment")
+                invoice_url = 'http://ikwen.com' + reverse('billing:invoice_detail', args=(invoice.id,))
+                context = {'wallet_debit': True, 'invoice': invoice, 'config': config,
+                           'member_name': member.first_name, 'invoice_url': invoice_url, 'cta': _("View invoice")}
+                html_content = get_mail_content(subject, '', template_name='billing/mails/wallet_debit_notice.html',
+                                                extra_context=context)
+            else:
+                html_content = render_invoice_notice(notice_campaign, member, subject, message, invoice, invoice_url)
+            # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
+            # to be delivered to Spams because of origin check.
+            sender = '%s <no-reply@%s>' % (config.company_name, vendor.domain)
+            msg = EmailMessage(subject, html_content, sender, [member.email])
+            try:
+                invoice_pdf_file = generate_pdf_invoice(invoicing_config, invoice, vendor_cache=pdf_vendor_cache)
+                msg.attach_file(invoice_pdf_file)
+            except:
+                pass
+            if paid_by_wallet_debit:
+                msg.bcc = ['k.sihon@ikwen.com']
+            msg.content_subtype = "html"
+            invoice.last_reminder = timezone.now()
+            try:
+                if msg.send():
+                    logger.debug("1st Invoice reminder for %s sent to %s" % (subscription.domain, member.email))
+                    if not paid_by_wallet_debit:
+                        invoice.reminders_sent = 1
+                        invoice.save()
+                else:
+                    logger.error(u"Invoice #%s generated but mail not sent to %s" % (number, member.email),
+                                 exc_info=True)
+            except:
+                logger.error(u"Connexion error on Invoice #%s to %s" % (number, member.email), exc_info=True)
+
+        if sms_text:
+            if member.phone:
+                if config.sms_sending_method == Config.HTTP_API:
+                    sms_dispatcher.submit(member.phone, sms_text, tag=(invoice.number, False))
+                else:
+                    QueuedSMS.objects.create(recipient=member.phone, text=sms_text)
+
+        path_after = getattr(settings, 'BILLING_AFTER_NEW_INVOICE', None)
+        if path_after:
+            after_new_invoice = import_by_path(path_after)
+            after_new_invoice(invoice)
+
+
 def send_invoices():
     """
     This cron task simply sends the Invoice *invoicing_gap* days before Subscription *expiry*
     """
     vendor, config, invoicing_config, connection = _init_base_vars()
+    sms_dispatcher = SMSDispatcher(callback=get_invoice_sms_callback(u"SMS", log=logger))
+    notice_campaign = get_invoice_notice_campaign(vendor, config)
+    number_allocator = InvoiceNumberAllocator()
+    pdf_vendor_cache = {}
+    issued_list = []
     now = timezone.now()
     count, total_amount = 0, 0
     reminder_date_time = now + timedelta(days=invoicing_config.gap)
     subscription_qs = Subscription.objects.filter(status=Subscription.ACTIVE,
                                                   monthly_cost__gt=0, expiry__lt=reminder_date_time.date())
-    logger.debug("%d Service candidate for invoice issuance." % subscription_qs.count())
-    for subscription in subscription_qs:
+    subscription_list = list(subscription_qs)
+    logger.debug("%d Service candidate for invoice issuance." % len(subscription_list))
+    pending_subscription_ids = get_pending_invoice_subscription_ids(subscription_list)
+    # Invoices issued by a run interrupted before notifying them are notified now
+    recent_invoice_qs = Invoice.objects.filter(subscription__in=list(pending_subscription_ids), status=Invoice.PENDING,
+                                               created_on__gte=now - timedelta(days=1))
+    subscriptions_by_id = dict([(str(subscription.id), subscription) for subscription in subscription_list])
+    for invoice in recent_invoice_qs:
+        subscription = subscriptions_by_id.get(str(invoice.subscription_id))
+        if subscription and invoice.due_date == subscription.expiry:
+            issued_list.append((subscription, invoice, False))
+    for subscription in subscription_list:
         if getattr(settings, 'IS_IKWEN', False):
             if subscription.version == Service.FREE:
                 continue
-        try:
-            pending_invoice = Invoice.objects.get(subscription=subscription, status=Invoice.PENDING)
-            logger.debug("%s found for %s. Skipping" % (pending_invoice, subscription))
+        if subscription.id in pending_subscription_ids:
+            logger.debug("Pending Invoice found for %s. Skipping" % subscription)
             continue  # Continue if a Pending invoice for this Subscription is found
-        except Invoice.DoesNotExist:
-            pass
         member = subscription.member
-        number = get_next_invoice_number()
+        number = number_allocator.next()
         months_count = None
         if config.__dict__.get('separate_billing_cycle', True):
             months_count = get_billing_cycle_months_count(subscription.billing_cycle)
@@ -174,63 +260,15 @@ def send_invoices():
             pay_with_wallet_balance(invoice)
             paid_by_wallet_debit = True
             logger.debug("Invoice for %s paid by wallet debit" % subscription.domain)
+        issued_list.append((subscription, invoice, paid_by_wallet_debit))
+        if len(issued_list) >= INVOICE_NOTICE_CHUNK:
+            _notify_new_invoices(issued_list, vendor, config, invoicing_config, notice_campaign, sms_dispatcher,
+                                 pdf_vendor_cache)
+            issued_list = []
 
-        subject, message, sms_text = get_invoice_generated_message(invoice)
-
-        if member.email:
-            activate(member.language)
-            invoice_url = 'http://ikwen.com' + reverse('billing:invoice_detail', args=(invoice.id,))
-            if paid_by_wallet_debit:
-                subject = _("Thanks for your payment")
-                invoice_url = 'http://ikwen.com' + reverse('billing:invoice_detail', args=(invoice.id,))
-                context = {'wallet_debit': True, 'invoice': invoice, 'config': config,
-                           'member_name': member.first_name, 'invoice_url': invoice_url, 'cta': _("View invoice")}
-                html_content = get_mail_content(subject, '', template_name='billing/mails/wallet_debit_notice.html',
-                                                extra_context=context)
-            else:
-                context = {'invoice_url': invoice_url, 'cta': _("Pay now"), 'currency': config.currency_symbol,
-                           'service': vendor, 'config': config, 'logo': config.logo,
-                           'project_name': vendor.project_name, 'company_name': config.company_name,
-                           'member_name': member.first_name, 'invoice': invoice}
-                html_content = get_mail_content(subject, message, template_name='billing/mails/notice.html',
-                                                extra_context=context)
-            # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
-            # to be delivered to Spams because of origin check.
-            sender = '%s <no-reply@%s>' % (config.company_name, vendor.domain)
-            msg = EmailMessage(subject, html_content, sender, [member.email])
-            try:
-                invoice_pdf_file = generate_pdf_invoice(invoicing_config, invoice)
-                msg.attach_file(invoice_pdf_file)
-            except:
-                pass
-            if paid_by_wallet_debit:
-                msg.bcc = ['k.sihon@ikwen.com']
-            msg.content_subtype = "html"
-            invoice.last_reminder = timezone.now()
-            try:
-                if msg.send():
-                    logger.debug("1st Invoice reminder for %s sent to %s" % (subscription.domain, member.email))
-                    if not paid_by_wallet_debit:
-                        invoice.reminders_sent = 1
-                        invoice.save()
-                else:
-                    logger.error(u"Invoice #%s generated but mail not sent to %s" % (number, member.email),
-                                 exc_info=True)
-            except:
-                logger.error(u"Connexion error on Invoice #%s to %s" % (number, member.email), exc_info=True)
-
-        if sms_text:
-            if member.phone:
-                if config.sms_sending_method == Config.HTTP_API:
-                    send_sms(member.phone, sms_text)
-                else:
-                    QueuedSMS.objects.create(recipient=member.phone, text=sms_text)
-
-        path_after = getattr(settings, 'BILLING_AFTER_NEW_INVOICE', None)
-        if path_after:
-            after_new_invoice = import_by_path(path_after)
-            after_new_invoice(invoice)
-
+    _notify_new_invoices(issued_list, vendor, config, invoicing_config, notice_campaign, sms_dispatcher,
+                         pdf_vendor_cache)
+    sms_dispatcher.join()
     try:
         connection.close()
     finally:
@@ -245,6 +283,8 @@ def send_invoice_reminders():
     This cron task sends Invoice reminder notice to the client if unpaid
     """
     vendor, config, invoicing_config, connection = _init_base_vars()
+    sms_dispatcher = SMSDispatcher(callback=get_invoice_sms_callback(u"SMS reminder", log=logger))
+    notice_campaign = get_invoice_notice_campaign(vendor, config)
     now = timezone.now()
     count, total_amount = 0, 0
     invoice_qs = Invoice.objects.filter(status=Invoice.PENDING, due_date__gte=now.date(), last_reminder__isnull=False)
@@ -264,7 +304,7 @@ def send_invoice_reminders():
             add_event(vendor, INVOICE_REMINDER_EVENT, member=member, object_id=invoice.id)
             subject, message, sms_text = get_invoice_reminder_message(invoice)
             if member.email:
-                msg = _get_email_msg(member, subject, message, invoice, vendor, config)
+                msg = _get_email_msg(member, subject, message, invoice, vendor, config, notice_campaign)
                 invoice.last_reminder = timezone.now()
                 print ("Sending mail to %s" % member.email)
                 try:
@@ -281,9 +321,10 @@ def send_invoice_reminders():
             if sms_text:
                 if member.phone:
                     if config.sms_sending_method == Config.HTTP_API:
-                        send_sms(member.phone, sms_text)
+                        sms_dispatcher.submit(member.phone, sms_text, tag=(invoice.number, False))
                     else:
                         QueuedSMS.objects.create(recipient=member.phone, text=sms_text)
+    sms_dispatcher.join()
     try:
         connection.close()
     finally:
@@ -298,6 +339,8 @@ def send_invoice_overdue_notices():
     This cron task sends notice of Invoice overdue
     """
     vendor, config, invoicing_config, connection = _init_base_vars()
+    sms_dispatcher = SMSDispatcher(callback=get_invoice_sms_callback(u"SMS overdue notice", log=logger))
+    notice_campaign = get_invoice_notice_campaign(vendor, config)
     now = timezone.now()
     count, total_amount = 0, 0
     invoice_qs = Invoice.objects.filter(Q(status=Invoice.PENDING) | Q(status=Invoice.OVERDUE),
@@ -322,7 +365,7 @@ def send_invoice_overdue_notices():
             add_event(vendor, OVERDUE_NOTICE_EVENT, member=member, object_id=invoice.id)
             subject, message, sms_text = get_invoice_overdue_message(invoice)
             if member.email:
-                msg = _get_email_msg(member, subject, message, invoice, vendor, config)
+                msg = _get_email_msg(member, subject, message, invoice, vendor, config, notice_campaign)
                 invoice.last_overdue_notice = timezone.now()
                 print ("Sending mail to %s" % member.email)
                 try:
@@ -339,9 +382,10 @@ def send_invoice_overdue_notices():
             if sms_text:
                 if member.phone:
                     if config.sms_sending_method == Config.HTTP_API:
-                        send_sms(member.phone, sms_text)
+                        sms_dispatcher.submit(member.phone, sms_text, tag=(invoice.number, False))
                     else:
                         QueuedSMS.objects.create(recipient=member.phone, text=sms_text)
+    sms_dispatcher.join()
     try:
         connection.close()
     finally:
@@ -357,6 +401,8 @@ def suspend_customers_services():
     for Invoices which tolerance is exceeded.
     """
     vendor, config, invoicing_config, connection = _init_base_vars()
+    sms_dispatcher = SMSDispatcher(callback=get_invoice_sms_callback(u"SMS suspension notice", log=logger))
+    notice_campaign = get_invoice_notice_campaign(vendor, config)
     now = timezone.now()
     count, total_amount = 0, 0
     deadline = now - timedelta(days=invoicing_config.tolerance)
@@ -386,7 +432,7 @@ def suspend_customers_services():
             add_event(vendor, SERVICE_SUSPENDED_EVENT, member=member, object_id=invoice.id)
             subject, message, sms_text = get_service_suspension_message(invoice)
             if member.email:
-                msg = _get_email_msg(member, subject, message, invoice, vendor, config)
+                msg = _get_email_msg(member, subject, message, invoice, vendor, config, notice_campaign)
                 print ("Sending mail to %s" % member.email)
                 try:
                     if msg.send():
@@ -400,9 +446,10 @@ def suspend_customers_services():
             if sms_text:
                 if member.phone:
                     if config.sms_sending_method == Config.HTTP_API:
-                        send_sms(member.phone, sms_text)
+                        sms_dispatcher.submit(member.phone, sms_text, tag=(invoice.number, False))
                     else:
                         QueuedSMS.objects.create(recipient=member.phone, text=sms_text)
+    sms_dispatcher.join()
     try:
         connection.close()
     finally:
@@ -6,14 +6,14 @@ import string
 import traceback
 from datetime import datetime, timedelta
 
-import requests
 from django.conf import settings
 from django.contrib import messages
 from django.http import Http404, HttpResponse, HttpResponseRedirect
 
+from ikwen.core import http_client
 from ikwen.conf.settings import WALLETS_DB_ALIAS
 from ikwen.core.templatetags.url_utils import strip_base_alias
-from ikwen.core.utils import get_service_instance, set_counters, increment_history_field
+from ikwen.core.utils import get_service_instance, set_counters, increment_history_fields
 from ikwen.billing.models import MoMoTransaction
 from ikwen.billing.mtnmomo.open_api import MTN_MOMO
 
@@ -67,7 +67,7 @@ def momo_gateway_request(fn):
         if getattr(settings, 'UNIT_TESTING', False):  # Do not contact gateway on unit tests
             return HttpResponse(json.dumps(params), content_type='application/json')
         try:
-            r = requests.get(endpoint, params)
+            r = http_client.get(endpoint, params)
             resp = r.json()
             token = resp.get('token')
             if token:
@@ -127,11 +127,12 @@ def momo_gateway_callback(fn):
             amount = tx.amount - ikwen_charges - dara_fees
             try:
                 set_counters(weblet)
-                increment_history_field(weblet, 'turnover_history', tx.amount)
-                increment_history_field(weblet, 'earnings_history', amount)
-                increment_history_field(weblet, 'transaction_count_history')
+                increment_history_fields(weblet, {'turnover_history': tx.amount,
+                                                  'earnings_history': amount,
+                                                  'transaction_count_history': 1})
             except:
-                pass
+                logger.error("%s - Could not increment counters of transaction %s" % (weblet.project_name, tx.id),
+                             exc_info=True)
             tx.is_running = False
             tx.save()
             weblet.raise_balance(amount, tx.wallet)
@@ -40,6 +40,7 @@ from ikwen.billing.utils import get_invoicing_config_instance, get_subscription_
     get_months_count_billing_cycle, notify_event, get_payment_model, get_invoice_model
 from ikwen.core.utils import add_database_to_settings, get_service_instance, get_mail_content, XEmailMessage, \
     DefaultUploadBackend, set_counters, increment_history_field
+from ikwen.core.search import search_members
 from ikwen.core.views import HybridListView, ChangeObjectBase
 from daraja.models import DARAJA
 
@@ -104,8 +105,7 @@ class SubscriptionList(HybridListView):
             search_term = search_term.lower()
             word = slugify(search_term)
             if word:
-                word = word[:4]
-                member_list = list(Member.objects.filter(full_name__icontains=word))
+                member_list = list(search_members(search_term))
                 queryset = queryset.filter(member__in=member_list)
         return queryset
 
@@ -270,8 +270,7 @@ class AdminInvoiceList(HybridListView):
             search_term = search_term.lower()
             word = slugify(search_term)
             if word:
-                word = word[:4]
-                member_list = list(Member.objects.filter(full_name__icontains=word))
+                member_list = list(search_members(search_term))
                 if member_list:
                     queryset = queryset.filter(member__in=member_list)
                 else:
@@ -549,10 +548,9 @@ class PaymentList(HybridListView):
             search_term = search_term.lower()
             word = slugify(search_term)
             if word:
-                word = word[:4]
-                member_list = list(Member.objects.filter(full_name__icontains=word))
+                member_list = list(search_members(search_term))
                 invoice_list = list(Invoice.objects.filter(member__in=member_list))
-                queryset = queryset.select_relate('invoice').filter(invoice__in=invoice_list)
+                queryset = queryset.select_related('invoice').filter(invoice__in=invoice_list)
         return queryset
 
 
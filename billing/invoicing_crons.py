@@ -6,30 +6,28 @@ import logging
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ikwen.conf.settings")
 
-from django.db import transaction
 from django.db.models import Q
 from datetime import datetime, timedelta
 from django.conf import settings
 from django.contrib.auth.models import Group
-from django.core import mail
 from django.core.urlresolvers import reverse
 from django.utils import timezone
-from django.utils.translation import gettext as _
 
 from ikwen.accesscontrol.models import SUDO
-from ikwen.conf.settings import WALLETS_DB_ALIAS
+from ikwen.core.messaging_credit import CreditReservation, MAIL_CREDIT, SMS_CREDIT
 from ikwen.core.models import Service
-from ikwen.core.utils import get_service_instance, send_sms, add_event, add_database, XEmailMessage
-from ikwen.core.utils import get_mail_content
+from ikwen.core.sms import SMSDispatcher
+from ikwen.core.utils import get_service_instance, add_event, add_database, XEmailMessage, \
+    open_smtp_connection, close_smtp_connection
 from ikwen.billing.models import Invoice, InvoicingConfig, INVOICES_SENT_EVENT, \
     INVOICE_REMINDER_EVENT, REMINDERS_SENT_EVENT, OVERDUE_NOTICE_EVENT, OVERDUE_NOTICES_SENT_EVENT, \
-    SUSPENSION_NOTICES_SENT_EVENT, SERVICE_SUSPENDED_EVENT, SendingReport
+    SUSPENSION_NOTICES_SENT_EVENT, SERVICE_SUSPENDED_EVENT, SendingReport, InvoicingCheckpoint, InvoiceNotice
 from ikwen.billing.utils import get_invoice_generated_message, get_invoice_reminder_message, \
     get_invoice_overdue_message, \
-    get_service_suspension_message, get_next_invoice_number, get_subscription_model, get_billing_cycle_months_count, \
-    notify_event
+    get_service_suspension_message, InvoiceNumberAllocator, get_subscription_model, get_billing_cycle_months_count, \
+    notify_event, get_invoice_notice_campaign, render_invoice_notice, get_invoicing_checkpoint, iter_checkpointed, \
+    claim_invoice_notice, get_invoice_sms_callback
 
-from echo.models import Balance
 from echo.utils import LOW_MAIL_LIMIT, notify_for_low_messaging_credit, notify_for_empty_messaging_credit, LOW_SMS_LIMIT
 
 logger = logging.getLogger('ikwen.crons')
@@ -37,384 +35,448 @@ logger = logging.getLogger('ikwen.crons')
 Subscription = get_subscription_model()
 
 
-def send_invoices():
+def send_invoices(service_id=None):
     """
     This cron task simply sends the Invoice *invoicing_gap* days before Subscription *expiry*
+
+    :param service_id: If set, only this Service is processed
+    :return: Number and total amount of Invoices processed
     """
     ikwen_service = get_service_instance()
     now = datetime.now()
-    connection = mail.get_connection()
     try:
-        connection.open()
+        connection = open_smtp_connection()
     except:
+        connection = None
         logger.error(u"Connexion error", exc_info=True)
-
-    for invoicing_config in InvoicingConfig.objects.exclude(service=ikwen_service):
-        service = invoicing_config.service
-        if service.status != Service.ACTIVE or invoicing_config.pull_invoice:
-            continue
-        db = service.database
-        add_database(db)
-        config = service.basic_config
-        reminder_date_time = now + timedelta(days=invoicing_config.gap)
-        subscription_qs = Subscription.objects.using(db)\
-            .selected_related('member, product').filter(status=Subscription.ACTIVE,
-                                                        monthly_cost__gt=0, expiry=reminder_date_time.date())
-        count, total_amount = 0, 0
-        for subscription in subscription_qs:
-            member = subscription.member
-            number = get_next_invoice_number()
-            months_count = get_billing_cycle_months_count(subscription.billing_cycle)
-            amount = subscription.monthly_cost * months_count
-            invoice = Invoice.objects.create(member=member, subscription=subscription, number=number,
-                                             amount=amount, due_date=subscription.expiry, months_count=months_count)
-            count += 1
-            total_amount += amount
-
-            subject, message, sms_text = get_invoice_generated_message(invoice)
-            balance, update = Balance.objects.using(WALLETS_DB_ALIAS).get_or_create(service_id=service.id)
-            if member.email:
-                if 0 < balance.mail_count < LOW_MAIL_LIMIT:
-                    notify_for_low_messaging_credit(service, balance)
-                if balance.mail_count <= 0 and not getattr(settings, 'UNIT_TESTING', False):
-                    notify_for_empty_messaging_credit(service, balance)
-                else:
-                    invoice_url = service.url + reverse('billing:invoice_detail', args=(invoice.id,))
-                    html_content = get_mail_content(subject, message, service=service,
-                                                    template_name='billing/mails/notice.html',
-                                                    extra_context={'invoice_url': invoice_url, 'cta': _("Pay now"),
-                                                                   'currency': config.currency_symbol})
-                    # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
-                    # to be delivered to Spams because of origin check.
-                    sender = '%s <no-reply@%s>' % (config.company_name, service.domain)
-                    msg = XEmailMessage(subject, html_content, sender, [member.email])
-                    msg.content_subtype = "html"
-                    msg.service = service
-                    invoice.last_reminder = timezone.now()
-                    try:
-                        with transaction.atomic(using=WALLETS_DB_ALIAS):
-                            if msg.send():
-                                balance.mail_count -= 1
-                                balance.save()
-                                logger.debug("1st Invoice reminder for %s sent to %s" % (subscription, member.email))
-                            else:
-                                logger.error(u"Invoice #%s generated but mail not sent to %s" % (number, member.email),
-                                             exc_info=True)
-                    except:
-                        logger.error(u"Connexion error on Invoice #%s to %s" % (number, member.email), exc_info=True)
-
-            if sms_text and member.phone:
-                if 0 < balance.sms_count < LOW_SMS_LIMIT:
-                    notify_for_low_messaging_credit(service, balance)
-                if balance.sms_count <= 0 and not getattr(settings, 'UNIT_TESTING', False):
-                    notify_for_empty_messaging_credit(service, balance)
-                    continue
-                try:
-                    with transaction.atomic(using=WALLETS_DB_ALIAS):
-                        balance.sms_count -= 1
-                        balance.save()
-                        phone = member.phone if len(member.phone) > 9 else '237' + member.phone
-                        send_sms(phone, sms_text, fail_silently=False)
-                except:
-                    logger.error(u"SMS for invoice #%s not sent to %s" % (number, member.email), exc_info=True)
-
-        if count > 0:
-            report = SendingReport.objects.using(db).create(count=count, total_amount=total_amount)
-            sudo_group = Group.objects.using(db).get(name=SUDO)
-            add_event(ikwen_service, INVOICES_SENT_EVENT, group_id=sudo_group.id, object_id=report.id)
     try:
-        connection.close()
-    except:
-        pass
-
-
-def send_invoice_reminders():
+        number_allocator = InvoiceNumberAllocator()
+        invoicing_config_qs = InvoicingConfig.objects.exclude(service=ikwen_service)
+        if service_id:
+            invoicing_config_qs = invoicing_config_qs.filter(service=service_id)
+        total_count, total_amount = 0, 0
+        for invoicing_config in invoicing_config_qs:
+            service = invoicing_config.service
+            if service.status != Service.ACTIVE or invoicing_config.pull_invoice:
+                continue
+            checkpoint = get_invoicing_checkpoint('send_invoices', service, now.date())
+            if checkpoint.status == InvoicingCheckpoint.COMPLETE:
+                continue
+            db = service.database
+            add_database(db)
+            config = service.basic_config
+            notice_campaign = get_invoice_notice_campaign(service, config)
+            mail_credit = CreditReservation(service, MAIL_CREDIT)
+            sms_credit = CreditReservation(service, SMS_CREDIT, balance=mail_credit.balance)
+            sms_dispatcher = SMSDispatcher(callback=get_invoice_sms_callback(u"SMS", sms_credit, logger))
+            try:
+                balance = mail_credit.balance
+                reminder_date_time = now + timedelta(days=invoicing_config.gap)
+                subscription_qs = Subscription.objects.using(db)\
+                    .select_related('member', 'product').filter(status=Subscription.ACTIVE,
+                                                                monthly_cost__gt=0, expiry=reminder_date_time.date())
+                number_allocator.expect(subscription_qs.count())
+                for subscription in iter_checkpointed(subscription_qs, checkpoint):
+                    member = subscription.member
+                    invoice_list = list(Invoice.objects.filter(subscription=subscription, due_date=subscription.expiry)[:1])
+                    if invoice_list:
+                        # Invoice generated by a previous run interrupted before it was notified
+                        invoice = invoice_list[0]
+                    else:
+                        number = number_allocator.next()
+                        months_count = get_billing_cycle_months_count(subscription.billing_cycle)
+                        amount = subscription.monthly_cost * months_count
+                        invoice = Invoice.objects.create(member=member, subscription=subscription, number=number, amount=amount,
+                                                         due_date=subscription.expiry, months_count=months_count)
+                    if not claim_invoice_notice(invoice, InvoiceNotice.INVOICE, using=db):
+                        continue
+                    number = invoice.number
+                    checkpoint.count += 1
+                    checkpoint.total_amount += invoice.amount
+
+                    subject, message, sms_text = get_invoice_generated_message(invoice)
+                    if member.email:
+                        if 0 < mail_credit.remaining < LOW_MAIL_LIMIT:
+                            notify_for_low_messaging_credit(service, balance)
+                        if not mail_credit.ensure() and not getattr(settings, 'UNIT_TESTING', False):
+                            notify_for_empty_messaging_credit(service, balance)
+                        else:
+                            invoice_url = service.url + reverse('billing:invoice_detail', args=(invoice.id,))
+                            html_content = render_invoice_notice(notice_campaign, member, subject, message, invoice, invoice_url)
+                            # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
+                            # to be delivered to Spams because of origin check.
+                            sender = '%s <no-reply@%s>' % (config.company_name, service.domain)
+                            msg = XEmailMessage(subject, html_content, sender, [member.email], connection=connection)
+                            msg.content_subtype = "html"
+                            msg.service = service
+                            invoice.last_reminder = timezone.now()
+                            try:
+                                if msg.send():
+                                    mail_credit.consume()
+                                    logger.debug("1st Invoice reminder for %s sent to %s" % (subscription, member.email))
+                                else:
+                                    logger.error(u"Invoice #%s generated but mail not sent to %s" % (number, member.email),
+                                                 exc_info=True)
+                            except:
+                                logger.error(u"Connexion error on Invoice #%s to %s" % (number, member.email), exc_info=True)
+
+                    if sms_text and member.phone:
+                        if 0 < sms_credit.remaining < LOW_SMS_LIMIT:
+                            notify_for_low_messaging_credit(service, balance)
+                        if not sms_credit.ensure() and not getattr(settings, 'UNIT_TESTING', False):
+                            notify_for_empty_messaging_credit(service, balance)
+                            continue
+                        charged = sms_credit.consume()
+                        phone = member.phone if len(member.phone) > 9 else '237' + member.phone
+                        sms_dispatcher.submit(phone, sms_text, tag=(number, charged))
+            finally:
+                sms_dispatcher.join()  # Failed SMS are refunded before credits are released
+                mail_credit.release()
+                sms_credit.release()
+            total_count += checkpoint.count
+            total_amount += checkpoint.total_amount
+            if checkpoint.count > 0:
+                report = SendingReport.objects.using(db).create(count=checkpoint.count,
+                                                                total_amount=checkpoint.total_amount)
+                sudo_group = Group.objects.using(db).get(name=SUDO)
+                add_event(ikwen_service, INVOICES_SENT_EVENT, group_id=sudo_group.id, object_id=report.id)
+    finally:
+        if connection:
+            try:
+                close_smtp_connection(connection)
+            except:
+                pass
+    return total_count, total_amount
+
+
+def send_invoice_reminders(service_id=None):
     """
     This cron task sends Invoice reminder notice to the client if unpaid
+
+    :param service_id: If set, only this Service is processed
+    :return: Number and total amount of Invoices processed
     """
     ikwen_service = get_service_instance()
     now = datetime.now()
-    connection = mail.get_connection()
     try:
-        connection.open()
+        connection = open_smtp_connection()
     except:
+        connection = None
         logger.error(u"Connexion error", exc_info=True)
-
-    for invoicing_config in InvoicingConfig.objects.exclude(service=ikwen_service):
-        service = invoicing_config.service
-        if service.status != Service.ACTIVE:
-            continue
-        config = service.basic_config
-        db = service.database
-        add_database(db)
-        invoice_qs = Invoice.objects.using(db).select_related('subscription')\
-            .filter(status=Invoice.PENDING, due_date__gte=now.date(), last_reminder__isnull=False)
-        count, total_amount = 0, 0
-        for invoice in invoice_qs:
-            diff = now - invoice.last_reminder
-            if diff.days != invoicing_config.reminder_delay:
+    try:
+        invoicing_config_qs = InvoicingConfig.objects.exclude(service=ikwen_service)
+        if service_id:
+            invoicing_config_qs = invoicing_config_qs.filter(service=service_id)
+        total_count, total_amount = 0, 0
+        for invoicing_config in invoicing_config_qs:
+            service = invoicing_config.service
+            if service.status != Service.ACTIVE:
                 continue
-            count += 1
-            total_amount += invoice.amount
-            member = invoice.subscription.member
-            add_event(service, INVOICE_REMINDER_EVENT, member=member, object_id=invoice.id)
-            subject, message, sms_text = get_invoice_reminder_message(invoice)
-
-            balance, update = Balance.objects.using(WALLETS_DB_ALIAS).get_or_create(service_id=service.id)
-
-            if member.email:
-                if 0 < balance.mail_count < LOW_MAIL_LIMIT:
-                    notify_for_low_messaging_credit(service, balance)
-                if balance.mail_count <= 0 and not getattr(settings, 'UNIT_TESTING', False):
-                    notify_for_empty_messaging_credit(service, balance)
-                else:
-                    invoice_url = service.url + reverse('billing:invoice_detail', args=(invoice.id,))
-                    html_content = get_mail_content(subject, message, service=service,
-                                                    template_name='billing/mails/notice.html',
-                                                    extra_context={'member_name': member.first_name, 'invoice': invoice,
-                                                                   'invoice_url': invoice_url, 'cta': _("Pay now"),
-                                                                   'currency': config.currency_symbol})
-                    # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
-                    # to be delivered to Spams because of origin check.
-                    sender = '%s <no-reply@%s>' % (config.company_name, service.domain)
-                    msg = XEmailMessage(subject, html_content, sender, [member.email])
-                    msg.service = service
-                    msg.content_subtype = "html"
-                    invoice.last_reminder = timezone.now()
-                    try:
-                        with transaction.atomic(using=WALLETS_DB_ALIAS):
-                            if msg.send():
-                                invoice.reminders_sent += 1
-                                balance.mail_count -= 1
-                                balance.save()
-                            else:
-                                logger.error(u"Reminder mail for Invoice #%s not sent to %s" % (invoice.number, member.email), exc_info=True)
-                    except:
-                        logger.error(u"Connexion error on Invoice #%s to %s" % (invoice.number, member.email), exc_info=True)
-                    invoice.save()
-
-            if sms_text and member.phone:
-                if 0 < balance.sms_count < LOW_SMS_LIMIT:
-                    notify_for_low_messaging_credit(service, balance)
-                if balance.sms_count <= 0 and not getattr(settings, 'UNIT_TESTING', False):
-                    notify_for_empty_messaging_credit(service, balance)
-                    continue
-                try:
-                    with transaction.atomic(using=WALLETS_DB_ALIAS):
-                        balance.sms_count -= 1
-                        balance.save()
+            checkpoint = get_invoicing_checkpoint('send_invoice_reminders', service, now.date())
+            if checkpoint.status == InvoicingCheckpoint.COMPLETE:
+                continue
+            config = service.basic_config
+            notice_campaign = get_invoice_notice_campaign(service, config)
+            mail_credit = CreditReservation(service, MAIL_CREDIT)
+            sms_credit = CreditReservation(service, SMS_CREDIT, balance=mail_credit.balance)
+            sms_dispatcher = SMSDispatcher(callback=get_invoice_sms_callback(u"SMS reminder", sms_credit, logger))
+            try:
+                balance = mail_credit.balance
+                db = service.database
+                add_database(db)
+                invoice_qs = Invoice.objects.using(db).select_related('subscription')\
+                    .filter(status=Invoice.PENDING, due_date__gte=now.date(), last_reminder__isnull=False)
+                for invoice in iter_checkpointed(invoice_qs, checkpoint):
+                    diff = now - invoice.last_reminder
+                    if diff.days != invoicing_config.reminder_delay:
+                        continue
+                    if not claim_invoice_notice(invoice, InvoiceNotice.REMINDER, now.date(), using=db):
+                        continue
+                    checkpoint.count += 1
+                    checkpoint.total_amount += invoice.amount
+                    member = invoice.subscription.member
+                    add_event(service, INVOICE_REMINDER_EVENT, member=member, object_id=invoice.id)
+                    subject, message, sms_text = get_invoice_reminder_message(invoice)
+
+
+                    if member.email:
+                        if 0 < mail_credit.remaining < LOW_MAIL_LIMIT:
+                            notify_for_low_messaging_credit(service, balance)
+                        if not mail_credit.ensure() and not getattr(settings, 'UNIT_TESTING', False):
+                            notify_for_empty_messaging_credit(service, balance)
+                        else:
+                            invoice_url = service.url + reverse('billing:invoice_detail', args=(invoice.id,))
+                            html_content = render_invoice_notice(notice_campaign, member, subject, message, invoice, invoice_url)
+                            # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
+                            # to be delivered to Spams because of origin check.
+                            sender = '%s <no-reply@%s>' % (config.company_name, service.domain)
+                            msg = XEmailMessage(subject, html_content, sender, [member.email], connection=connection)
+                            msg.service = service
+                            msg.content_subtype = "html"
+                            invoice.last_reminder = timezone.now()
+                            try:
+                                if msg.send():
+                                    invoice.reminders_sent += 1
+                                    mail_credit.consume()
+                                else:
+                                    logger.error(u"Reminder mail for Invoice #%s not sent to %s" % (invoice.number, member.email), exc_info=True)
+                            except:
+                                logger.error(u"Connexion error on Invoice #%s to %s" % (invoice.number, member.email), exc_info=True)
+                            invoice.save()
+
+                    if sms_text and member.phone:
+                        if 0 < sms_credit.remaining < LOW_SMS_LIMIT:
+                            notify_for_low_messaging_credit(service, balance)
+                        if not sms_credit.ensure() and not getattr(settings, 'UNIT_TESTING', False):
+                            notify_for_empty_messaging_credit(service, balance)
+                            continue
+                        charged = sms_credit.consume()
                         phone = member.phone if len(member.phone) > 9 else '237' + member.phone
-                        send_sms(phone, sms_text, fail_silently=False)
-                except:
-                    logger.error(u"SMS reminder for invoice #%s not sent to %s" % (invoice.number, member.phone), exc_info=True)
-
-        if count > 0:
-            report = SendingReport.objects.using(db).create(count=count, total_amount=total_amount)
-            sudo_group = Group.objects.using(db).get(name=SUDO)
-            add_event(ikwen_service, REMINDERS_SENT_EVENT, group_id=sudo_group.id, object_id=report.id)
-
-    try:
-        connection.close()
-    except:
-        pass
-
-
-def send_invoice_overdue_notices():
+                        sms_dispatcher.submit(phone, sms_text, tag=(invoice.number, charged))
+            finally:
+                sms_dispatcher.join()  # Failed SMS are refunded before credits are released
+                mail_credit.release()
+                sms_credit.release()
+            total_count += checkpoint.count
+            total_amount += checkpoint.total_amount
+            if checkpoint.count > 0:
+                report = SendingReport.objects.using(db).create(count=checkpoint.count,
+                                                                total_amount=checkpoint.total_amount)
+                sudo_group = Group.objects.using(db).get(name=SUDO)
+                add_event(ikwen_service, REMINDERS_SENT_EVENT, group_id=sudo_group.id, object_id=report.id)
+
+    finally:
+        if connection:
+            try:
+                close_smtp_connection(connection)
+            except:
+                pass
+    return total_count, total_amount
+
+
+def send_invoice_overdue_notices(service_id=None):
     """
     This cron task sends notice of Invoice overdue
+
+    :param service_id: If set, only this Service is processed
+    :return: Number and total amount of Invoices processed
     """
     ikwen_service = get_service_instance()
     now = datetime.now()
-    connection = mail.get_connection()
     try:
-        connection.open()
+        connection = open_smtp_connection()
     except:
+        connection = None
         logger.error(u"Connexion error", exc_info=True)
-
-    for invoicing_config in InvoicingConfig.objects.exclude(service=ikwen_service):
-        service = invoicing_config.service
-        if service.status != Service.ACTIVE:
-            continue
-        config = service.basic_config
-        db = service.database
-        add_database(db)
-        invoice_qs = Invoice.objects.using(db).select_related('subscription')\
-            .filter(Q(status=Invoice.PENDING) | Q(status=Invoice.OVERDUE),
-                    due_date__lt=now, overdue_notices_sent__lt=3)
-        count, total_amount = 0, 0
-        for invoice in invoice_qs:
-            if invoice.last_overdue_notice:
-                diff = now - invoice.last_overdue_notice
-            else:
-                invoice.status = Invoice.OVERDUE
-                invoice.save()
-            if invoice.last_overdue_notice and diff.days != invoicing_config.overdue_delay:
+    try:
+        invoicing_config_qs = InvoicingConfig.objects.exclude(service=ikwen_service)
+        if service_id:
+            invoicing_config_qs = invoicing_config_qs.filter(service=service_id)
+        total_count, total_amount = 0, 0
+        for invoicing_config in invoicing_config_qs:
+            service = invoicing_config.service
+            if service.status != Service.ACTIVE:
                 continue
-            count += 1
-            total_amount += invoice.amount
-            member = invoice.subscription.member
-            add_event(service, OVERDUE_NOTICE_EVENT, member=member, object_id=invoice.id)
-            subject, message, sms_text = get_invoice_overdue_message(invoice)
-            balance, update = Balance.objects.using(WALLETS_DB_ALIAS).get_or_create(service_id=service.id)
-            if member.email:
-                if 0 < balance.mail_count < LOW_MAIL_LIMIT:
-                    notify_for_low_messaging_credit(service, balance)
-                if balance.mail_count <= 0 and not getattr(settings, 'UNIT_TESTING', False):
-                    notify_for_empty_messaging_credit(service, balance)
-                else:
-                    invoice_url = 'http://ikwen.com' + reverse('billing:invoice_detail', args=(invoice.id,))
-                    html_content = get_mail_content(subject, message, service=service,
-                                                    template_name='billing/mails/notice.html',
-                                                    extra_context={'member_name': member.first_name, 'invoice': invoice,
-                                                                   'invoice_url': invoice_url, 'cta': _("Pay now"),
-                                                                   'currency': config.currency_symbol})
-                    # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
-                    # to be delivered to Spams because of origin check.
-                    sender = '%s <no-reply@%s>' % (config.company_name, service.domain)
-                    msg = XEmailMessage(subject, html_content, sender, [member.email])
-                    msg.service = service
-                    msg.content_subtype = "html"
-                    invoice.last_overdue_notice = timezone.now()
-                    try:
-                        with transaction.atomic(using=WALLETS_DB_ALIAS):
-                            if msg.send():
-                                invoice.overdue_notices_sent += 1
-                                balance.mail_count -= 1
-                                balance.save()
-                            else:
-                                logger.error(u"Overdue notice for Invoice #%s not sent to %s" % (invoice.number, member.email), exc_info=True)
-                    except:
-                        logger.error(u"Connexion error on Invoice #%s to %s" % (invoice.number, member.email), exc_info=True)
-                    invoice.save()
-
-            if sms_text and member.phone:
-                if 0 < balance.sms_count < LOW_SMS_LIMIT:
-                    notify_for_low_messaging_credit(service, balance)
-                if balance.sms_count <= 0 and not getattr(settings, 'UNIT_TESTING', False):
-                    notify_for_empty_messaging_credit(service, balance)
-                    continue
-                try:
-                    with transaction.atomic(using=WALLETS_DB_ALIAS):
-                        balance.sms_count -= 1
-                        balance.save()
+            checkpoint = get_invoicing_checkpoint('send_invoice_overdue_notices', service, now.date())
+            if checkpoint.status == InvoicingCheckpoint.COMPLETE:
+                continue
+            config = service.basic_config
+            notice_campaign = get_invoice_notice_campaign(service, config)
+            mail_credit = CreditReservation(service, MAIL_CREDIT)
+            sms_credit = CreditReservation(service, SMS_CREDIT, balance=mail_credit.balance)
+            sms_dispatcher = SMSDispatcher(callback=get_invoice_sms_callback(u"SMS overdue notice", sms_credit, logger))
+            try:
+                balance = mail_credit.balance
+                db = service.database
+                add_database(db)
+                invoice_qs = Invoice.objects.using(db).select_related('subscription')\
+                    .filter(Q(status=Invoice.PENDING) | Q(status=Invoice.OVERDUE),
+                            due_date__lt=now, overdue_notices_sent__lt=3)
+                for invoice in iter_checkpointed(invoice_qs, checkpoint):
+                    if invoice.last_overdue_notice:
+                        diff = now - invoice.last_overdue_notice
+                    else:
+                        invoice.status = Invoice.OVERDUE
+                        invoice.save()
+                    if invoice.last_overdue_notice and diff.days != invoicing_config.overdue_delay:
+                        continue
+                    if not claim_invoice_notice(invoice, InvoiceNotice.OVERDUE, now.date(), using=db):
+                        continue
+                    checkpoint.count += 1
+                    checkpoint.total_amount += invoice.amount
+                    member = invoice.subscription.member
+                    add_event(service, OVERDUE_NOTICE_EVENT, member=member, object_id=invoice.id)
+                    subject, message, sms_text = get_invoice_overdue_message(invoice)
+                    if member.email:
+                        if 0 < mail_credit.remaining < LOW_MAIL_LIMIT:
+                            notify_for_low_messaging_credit(service, balance)
+                        if not mail_credit.ensure() and not getattr(settings, 'UNIT_TESTING', False):
+                            notify_for_empty_messaging_credit(service, balance)
+                        else:
+                            invoice_url = 'http://ikwen.com' + reverse('billing:invoice_detail', args=(invoice.id,))
+                            html_content = render_invoice_notice(notice_campaign, member, subject, message, invoice, invoice_url)
+                            # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
+                            # to be delivered to Spams because of origin check.
+                            sender = '%s <no-reply@%s>' % (config.company_name, service.domain)
+                            msg = XEmailMessage(subject, html_content, sender, [member.email], connection=connection)
+                            msg.service = service
+                            msg.content_subtype = "html"
+                            invoice.last_overdue_notice = timezone.now()
+                            try:
+                                if msg.send():
+                                    invoice.overdue_notices_sent += 1
+                                    mail_credit.consume()
+                                else:
+                                    logger.error(u"Overdue notice for Invoice #%s not sent to %s" % (invoice.number, member.email), exc_info=True)
+                            except:
+                                logger.error(u"Connexion error on Invoice #%s to %s" % (invoice.number, member.email), exc_info=True)
+                            invoice.save()
+
+                    if sms_text and member.phone:
+                        if 0 < sms_credit.remaining < LOW_SMS_LIMIT:
+                            notify_for_low_messaging_credit(service, balance)
+                        if not sms_credit.ensure() and not getattr(settings, 'UNIT_TESTING', False):
+                            notify_for_empty_messaging_credit(service, balance)
+                            continue
+                        charged = sms_credit.consume()
                         phone = member.phone if len(member.phone) > 9 else '237' + member.phone
-                        send_sms(phone, sms_text, fail_silently=False)
-                except:
-                    logger.error(
-                        u"SMS overdue notice for invoice #%s not sent to %s" % (invoice.number, member.phone),
-                        exc_info=True)
-        if count > 0:
-            report = SendingReport.objects.using(db).create(count=count, total_amount=total_amount)
-            sudo_group = Group.objects.using(db).get(name=SUDO)
-            add_event(ikwen_service, OVERDUE_NOTICES_SENT_EVENT, group_id=sudo_group.id, object_id=report.id)
-
-    try:
-        connection.close()
-    except:
-        pass
-
-
-def suspend_customers_services():
+                        sms_dispatcher.submit(phone, sms_text, tag=(invoice.number, charged))
+            finally:
+                sms_dispatcher.join()  # Failed SMS are refunded before credits are released
+                mail_credit.release()
+                sms_credit.release()
+            total_count += checkpoint.count
+            total_amount += checkpoint.total_amount
+            if checkpoint.count > 0:
+                report = SendingReport.objects.using(db).create(count=checkpoint.count,
+                                                                total_amount=checkpoint.total_amount)
+                sudo_group = Group.objects.using(db).get(name=SUDO)
+                add_event(ikwen_service, OVERDUE_NOTICES_SENT_EVENT, group_id=sudo_group.id, object_id=report.id)
+
+    finally:
+        if connection:
+            try:
+                close_smtp_connection(connection)
+            except:
+                pass
+    return total_count, total_amount
+
+
+def suspend_customers_services(service_id=None):
     """
     This cron task shuts down service and sends notice of Service suspension
     for Invoices which tolerance is exceeded.
+
+    :param service_id: If set, only this Service is processed
+    :return: Number and total amount of Invoices processed
     """
     ikwen_service = get_service_instance()
     now = datetime.now()
-    connection = mail.get_connection()
     try:
-        connection.open()
+        connection = open_smtp_connection()
     except:
+        connection = None
         logger.error(u"Connexion error", exc_info=True)
-
-    for invoicing_config in InvoicingConfig.objects.exclude(service=ikwen_service):
-        service = invoicing_config.service
-        if service.status != Service.ACTIVE:
-            continue
-        config = service.basic_config
-        db = service.database
-        add_database(db)
-        deadline = now - timedelta(days=invoicing_config.tolerance)
-        invoice_qs = Invoice.objects.using(db).select_related('subscription')\
-            .filter(due_date__lte=deadline, status=Invoice.OVERDUE)
-        count, total_amount = 0, 0
-        for invoice in invoice_qs:
-            due_date = invoice.due_date
-            due_datetime = datetime(due_date.year, due_date.month, due_date.day, 23, 59, 59)
-            diff = now - due_datetime
-            subscription = invoice.subscription
-            tolerance = subscription.tolerance
-            if diff.days < tolerance:
+    try:
+        invoicing_config_qs = InvoicingConfig.objects.exclude(service=ikwen_service)
+        if service_id:
+            invoicing_config_qs = invoicing_config_qs.filter(service=service_id)
+        total_count, total_amount = 0, 0
+        for invoicing_config in invoicing_config_qs:
+            service = invoicing_config.service
+            if service.status != Service.ACTIVE:
+                continue
+            checkpoint = get_invoicing_checkpoint('suspend_customers_services', service, now.date())
+            if checkpoint.status == InvoicingCheckpoint.COMPLETE:
                 continue
-            invoice.status = Invoice.EXCEEDED
-            invoice.save()
-            count += 1
-            total_amount += invoice.amount
-            subscription.status = Subscription.SUSPENDED
-            subscription.save()
-            member = subscription.member
-            add_event(service, SERVICE_SUSPENDED_EVENT, member=member, object_id=invoice.id)
-            subject, message, sms_text = get_service_suspension_message(invoice)
-
-            if invoicing_config.suspension_return_url:
-                params = {'reference_id': subscription.reference_id, 'invoice_number': invoice.number}
-                notify_event(service, invoicing_config.suspension_return_url, params)
-
-            balance, update = Balance.objects.using(WALLETS_DB_ALIAS).get_or_create(service_id=service.id)
-            if member.email:
-                if 0 < balance.mail_count < LOW_MAIL_LIMIT:
-                    notify_for_low_messaging_credit(service, balance)
-                if balance.mail_count <= 0 and not getattr(settings, 'UNIT_TESTING', False):
-                    notify_for_empty_messaging_credit(service, balance)
-                else:
-                    invoice_url = service.url + reverse('billing:invoice_detail', args=(invoice.id,))
-                    html_content = get_mail_content(subject, message, service=service, template_name='billing/mails/notice.html',
-                                                    extra_context={'member_name': member.first_name, 'invoice': invoice,
-                                                                   'invoice_url': invoice_url, 'cta': _("Pay now"),
-                                                                   'currency': config.currency_symbol})
-                    # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
-                    # to be delivered to Spams because of origin check.
-                    sender = '%s <no-reply@%s>' % (config.company_name, service.domain)
-                    msg = XEmailMessage(subject, html_content, sender, [member.email])
-                    msg.service = service
-                    msg.content_subtype = "html"
-                    try:
-                        with transaction.atomic(using=WALLETS_DB_ALIAS):
-                            if msg.send():
-                                balance.mail_count -= 1
-                                balance.save()
-                            else:
-                                logger.error(u"Notice of suspension for Invoice #%s not sent to %s" % (invoice.number, member.email), exc_info=True)
-                    except:
-                        print ("Sending mail to %s failed" % member.email)
-                        logger.error(u"Connexion error on Invoice #%s to %s" % (invoice.number, member.email), exc_info=True)
-
-            if sms_text and member.phone:
-                if 0 < balance.sms_count < LOW_SMS_LIMIT:
-                    notify_for_low_messaging_credit(service, balance)
-                if balance.sms_count <= 0 and not getattr(settings, 'UNIT_TESTING', False):
-                    notify_for_empty_messaging_credit(service, balance)
-                    continue
-                try:
-                    with transaction.atomic(using=WALLETS_DB_ALIAS):
-                        balance.sms_count -= 1
-                        balance.save()
+            config = service.basic_config
+            notice_campaign = get_invoice_notice_campaign(service, config)
+            mail_credit = CreditReservation(service, MAIL_CREDIT)
+            sms_credit = CreditReservation(service, SMS_CREDIT, balance=mail_credit.balance)
+            sms_dispatcher = SMSDispatcher(callback=get_invoice_sms_callback(u"SMS suspension notice", sms_credit, logger))
+            try:
+                balance = mail_credit.balance
+                db = service.database
+                add_database(db)
+                deadline = now - timedelta(days=invoicing_config.tolerance)
+                invoice_qs = Invoice.objects.using(db).select_related('subscription')\
+                    .filter(due_date__lte=deadline, status=Invoice.OVERDUE)
+                for invoice in iter_checkpointed(invoice_qs, checkpoint):
+                    due_date = invoice.due_date
+                    due_datetime = datetime(due_date.year, due_date.month, due_date.day, 23, 59, 59)
+                    diff = now - due_datetime
+                    subscription = invoice.subscription
+                    tolerance = subscription.tolerance
+                    if diff.days < tolerance:
+                        continue
+                    invoice.status = Invoice.EXCEEDED
+                    invoice.save()
+                    checkpoint.count += 1
+                    checkpoint.total_amount += invoice.amount
+                    subscription.status = Subscription.SUSPENDED
+                    subscription.save()
+                    # Claimed once suspended, so that a run stopped in between never leaves the Service running
+                    if not claim_invoice_notice(invoice, InvoiceNotice.SUSPENSION, using=db):
+                        continue
+                    member = subscription.member
+                    add_event(service, SERVICE_SUSPENDED_EVENT, member=member, object_id=invoice.id)
+                    subject, message, sms_text = get_service_suspension_message(invoice)
+
+                    if invoicing_config.suspension_return_url:
+                        params = {'reference_id': subscription.reference_id, 'invoice_number': invoice.number}
+                        notify_event(service, invoicing_config.suspension_return_url, params)
+
+                    if member.email:
+                        if 0 < mail_credit.remaining < LOW_MAIL_LIMIT:
+                            notify_for_low_messaging_credit(service, balance)
+                        if not mail_credit.ensure() and not getattr(settings, 'UNIT_TESTING', False):
+                            notify_for_empty_messaging_credit(service, balance)
+                        else:
+                            invoice_url = service.url + reverse('billing:invoice_detail', args=(invoice.id,))
+                            html_content = render_invoice_notice(notice_campaign, member, subject, message, invoice, invoice_url)
+                            # Sender is simulated as being no-reply@company_name_slug.com to avoid the mail
+                            # to be delivered to Spams because of origin check.
+                            sender = '%s <no-reply@%s>' % (config.company_name, service.domain)
+                            msg = XEmailMessage(subject, html_content, sender, [member.email], connection=connection)
+                            msg.service = service
+                            msg.content_subtype = "html"
+                            try:
+                                if msg.send():
+                                    mail_credit.consume()
+                                else:
+                                    logger.error(u"Notice of suspension for Invoice #%s not sent to %s" % (invoice.number, member.email), exc_info=True)
+                            except:
+                                print ("Sending mail to %s failed" % member.email)
+                                logger.error(u"Connexion error on Invoice #%s to %s" % (invoice.number, member.email), exc_info=True)
+
+                    if sms_text and member.phone:
+                        if 0 < sms_credit.remaining < LOW_SMS_LIMIT:
+                            notify_for_low_messaging_credit(service, balance)
+                        if not sms_credit.ensure() and not getattr(settings, 'UNIT_TESTING', False):
+                            notify_for_empty_messaging_credit(service, balance)
+                            continue
+                        charged = sms_credit.consume()
                         phone = member.phone if len(member.phone) > 9 else '237' + member.phone
-                        send_sms(phone, sms_text, fail_silently=False)
-                except:
-                    logger.error(
-                        u"SMS overdue notice for invoice #%s not sent to %s" % (invoice.number, member.phone),
-                        exc_info=True)
-
-        if count > 0:
-            report = SendingReport.objects.using(db).create(count=count, total_amount=total_amount)
-            sudo_group = Group.objects.using(db).get(name=SUDO)
-            add_event(ikwen_service, SUSPENSION_NOTICES_SENT_EVENT, group_id=sudo_group.id, object_id=report.id)
-
-    try:
-        connection.close()
-    except:
-        pass
+                        sms_dispatcher.submit(phone, sms_text, tag=(invoice.number, charged))
+            finally:
+                sms_dispatcher.join()  # Failed SMS are refunded before credits are released
+                mail_credit.release()
+                sms_credit.release()
+            total_count += checkpoint.count
+            total_amount += checkpoint.total_amount
+            if checkpoint.count > 0:
+                report = SendingReport.objects.using(db).create(count=checkpoint.count,
+                                                                total_amount=checkpoint.total_amount)
+                sudo_group = Group.objects.using(db).get(name=SUDO)
+                add_event(ikwen_service, SUSPENSION_NOTICES_SENT_EVENT, group_id=sudo_group.id, object_id=report.id)
+
+    finally:
+        if connection:
+            try:
+                close_smtp_connection(connection)
+            except:
+                pass
+    return total_count, total_amount
 
 
 if __name__ == "__main__":
@@ -227,6 +227,27 @@ class AbstractSubscription(Model):
     class Meta:
         abstract = True
 
+    def __init__(self, *args, **kwargs):
+        super(AbstractSubscription, self).__init__(*args, **kwargs)
+        self._expiry_on_load = self._get_expiry_state() if self.id else None
+
+    def _get_expiry_state(self):
+        return self.expiry, self.invoice_tolerance, self.status, self.monthly_cost
+
+    def save(self, *args, **kwargs):
+        """
+        Schedules the ExpiryEvents of the Subscription whenever its expiry, invoice_tolerance,
+        status or monthly_cost changes, as billing crons only process Subscriptions whose events
+        are due. Events of Subscriptions that are not billable are completed by the crons, so
+        they are scheduled again here once the Subscription is active or charged again.
+        """
+        from ikwen.billing.utils import schedule_expiry_events
+        super(AbstractSubscription, self).save(*args, **kwargs)
+        expiry_state = self._get_expiry_state()
+        if expiry_state != self._expiry_on_load:
+            schedule_expiry_events(self, using=kwargs.get('using') or self._state.db)
+            self._expiry_on_load = expiry_state
+
     def get_status(self):
         if self.status != self.EXPIRED and datetime.now().date() < self.expiry:
             self.status = self.EXPIRED
@@ -336,6 +357,15 @@ class Invoice(AbstractInvoice):
         super(Invoice, self).save(using=using, *args, **kwargs)
 
 
+class InvoiceSequence(models.Model):
+    """
+    Counter from which numbers of Invoices of a month are allocated.
+    See :func:`ikwen.billing.utils.allocate_invoice_numbers`
+    """
+    name = models.CharField(max_length=30, unique=True)
+    value = models.IntegerField(default=0)
+
+
 class SupportBundle(Model):
     """
     A customer support bundle
@@ -429,6 +459,59 @@ class SendingReport(Model):
     """
     count = models.IntegerField()
     total_amount = models.FloatField()
+    task = models.CharField(max_length=60, blank=True, null=True,
+                            help_text="Billing cron task summed up by this report when aggregated over all Services.")
+
+
+class InvoicingCheckpoint(Model):
+    """
+    Progress of a billing cron task on a Service for a given day. Objects are processed
+    in order of id and :attr:`last_id` is saved after each page, so that a run
+    interrupted midway resumes where it stopped instead of starting over.
+    """
+    STARTED = 'Started'
+    COMPLETE = 'Complete'
+
+    task = models.CharField(max_length=60, db_index=True)
+    service = models.ForeignKey(Service, related_name='+')
+    run_on = models.DateField(db_index=True)
+    status = models.CharField(max_length=15, default=STARTED)
+    last_id = models.CharField(max_length=24, blank=True, null=True,
+                               help_text="Id of the last object processed.")
+    count = models.IntegerField(default=0)
+    total_amount = models.FloatField(default=0)
+
+
+class ExpiryEvent(Model):
+    """
+    Billing work due on a Subscription at :attr:`due_on`: issuance of its next Invoice
+    or its suspension. Billing crons claim events due rather than scanning all Subscriptions.
+    See :func:`ikwen.billing.utils.schedule_expiry_events`
+    """
+    INVOICE = 'Invoice'
+    SUSPENSION = 'Suspension'
+
+    subscription_id = models.CharField(max_length=24, db_index=True)
+    type = models.CharField(max_length=15)
+    due_on = models.DateTimeField(db_index=True)
+    claimed_on = models.DateTimeField(blank=True, null=True,
+                                      help_text="When a cron took the event. It is removed once the work is done.")
+
+
+class InvoiceNotice(Model):
+    """
+    Notice sent to the client about an Invoice. Its unique :attr:`key` made of the invoice id,
+    notice type and tag guarantees that the same notice is never sent twice. See
+    :func:`ikwen.billing.utils.claim_invoice_notice`
+    """
+    INVOICE = 'Invoice'
+    REMINDER = 'Reminder'
+    OVERDUE = 'Overdue'
+    SUSPENSION = 'Suspension'
+
+    key = models.CharField(max_length=100, unique=True)
+    invoice_id = models.CharField(max_length=24, db_index=True)
+    type = models.CharField(max_length=15)
 
 
 class AbstractPayment(Model):
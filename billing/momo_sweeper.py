@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Marks MoMoTransactions that have been running for more than RUNNING_TIMEOUT seconds as Dropped.
+
+Payment processors sometimes never call back, so such transactions would stay running forever.
+Stale transactions are all marked Dropped with a single multi update on the (is_running,
+created_on) index, that also stamps them with the id of the sweep. Those of the sweep are then
+counted per Service and wallet, so that counts match exactly what the update touched, even if
+transactions complete meanwhile. Counts are added to the DashboardRollup of each Service on the
+umbrella database as dropped_transactions and dropped_<wallet> metrics, and logged.
+
+Run it from the crontab every 5 minutes:
+python momo_sweeper.py [--timeout=660]
+"""
+import os
+import sys
+
+sys.path.append("/home/libran/virtualenv/lib/python2.7/site-packages")
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ikwen.conf.settings")
+
+import logging.handlers
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from django.utils.log import AdminEmailHandler
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.core.models import Service
+from ikwen.core.rollups import update_rollup
+from ikwen.core.utils import get_collection
+from ikwen.billing.models import MoMoTransaction
+
+logger = logging.getLogger('crons.error')
+logger.setLevel(logging.DEBUG)
+file_handler = logging.handlers.RotatingFileHandler('momo_sweeper.log', 'w', 1000000, 4)
+file_handler.setLevel(logging.INFO)
+f = logging.Formatter('%(levelname)-10s %(asctime)-27s %(message)s')
+file_handler.setFormatter(f)
+email_handler = AdminEmailHandler()
+email_handler.setLevel(logging.ERROR)
+email_handler.setFormatter(f)
+logger.addHandler(file_handler)
+logger.addHandler(email_handler)
+
+RUNNING_TIMEOUT = 660  # Seconds after which a running transaction is considered dropped
+
+
+def count_transactions(collection, query):
+    """
+    Counts transactions matching *query* per Service and wallet.
+
+    :return: dict of counts keyed by (service_id, wallet)
+    """
+    pipeline = [{'$match': query},
+                {'$group': {'_id': {'service_id': '$service_id', 'wallet': '$wallet'}, 'count': {'$sum': 1}}}]
+    result = collection.aggregate(pipeline)
+    docs = result['result'] if isinstance(result, dict) else list(result)
+    return dict(((doc['_id'].get('service_id'), doc['_id'].get('wallet')), doc['count']) for doc in docs)
+
+
+def publish_metrics(counts):
+    """
+    Adds counts of dropped transactions to the DashboardRollup of their Service on the umbrella
+    database. Failures are only logged as transactions are already marked Dropped.
+    """
+    increments_by_service = {}
+    for (service_id, wallet), count in counts.items():
+        increments = increments_by_service.setdefault(service_id, {'dropped_transactions_history': 0})
+        increments['dropped_transactions_history'] += count
+        if wallet:
+            increments['dropped_%s_history' % wallet] = count
+    for service in Service.objects.using(UMBRELLA).filter(pk__in=increments_by_service.keys()):
+        try:
+            update_rollup(service, increments_by_service[service.id], UMBRELLA)
+        except:
+            logger.error(u"Could not publish dropped transactions of %s" % service, exc_info=True)
+
+
+def sweep(timeout=RUNNING_TIMEOUT, now=None):
+    """
+    Marks transactions running since more than *timeout* seconds as Dropped.
+
+    :return: Number of transactions marked Dropped
+    """
+    if not now:
+        now = datetime.now()
+    collection = get_collection(MoMoTransaction, 'wallets')
+    query = {'is_running': True, 'created_on': {'$lt': now - timedelta(seconds=timeout)}}
+    sweep_id = str(ObjectId())
+    result = collection.update(query, {'$set': {'is_running': False, 'status': MoMoTransaction.DROPPED,
+                                                'updated_on': now, 'sweep_id': sweep_id}}, multi=True)
+    if not (result and result.get('n')):
+        return 0
+    # updated_on is indexed, sweep_id sets apart transactions updated at the same time by others
+    counts = count_transactions(collection, {'updated_on': now, 'sweep_id': sweep_id})
+    publish_metrics(counts)
+    dropped = sum(counts.values())
+    wallet_counts = {}
+    for (service_id, wallet), count in counts.items():
+        wallet_counts[wallet] = wallet_counts.get(wallet, 0) + count
+    logger.info(u"%d transactions marked Dropped: %s" % (dropped, ', '.join(["%s %d" % (wallet, count)
+                                                                               for wallet, count in wallet_counts.items()])))
+    return dropped
+
+
+def _get_option(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith('--%s=' % name):
+            return int(arg.split('=')[1])
+    return default
+
+
+if __name__ == "__main__":
+    try:
+        sweep(_get_option('timeout', RUNNING_TIMEOUT))
+    except:
+        logger.error(u"Fatal error occured, MoMo transactions not swept", exc_info=True)
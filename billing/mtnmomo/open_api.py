@@ -5,7 +5,6 @@ import time
 from datetime import datetime
 from threading import Thread
 
-import requests
 import uuid
 
 from bson import ObjectId
@@ -17,6 +16,7 @@ from django.template.defaultfilters import slugify
 from django.utils.module_loading import import_by_path
 from django.utils.translation import ugettext as _
 from django.views.decorators.csrf import csrf_exempt
+from ikwen.core import http_client
 from ikwen.core.templatetags.url_utils import strip_base_alias
 
 from ikwen.cashout.utils import submit_cashout_request_for_manual_processing
@@ -104,7 +104,7 @@ def init_momo_payment(request, *args, **kwargs):
     elif getattr(settings, 'DEBUG', False):
         headers.update({'X-Target-Environment': 'sandbox'})
         data.update({'currency': 'EUR'})
-        r = requests.post(endpoint, headers=headers, json=data, verify=False, timeout=300)
+        r = http_client.post(endpoint, headers=headers, json=data, verify=False, timeout=300)
         if r.status_code == 202:
             logger.debug("%s - MTN MoMo: Request to pay submitted. "
                          "Amt: %s, Uname: %s, Phone: %s" % (weblet.ikwen_name, amount, username, tx.phone))
@@ -124,7 +124,7 @@ def init_momo_payment(request, *args, **kwargs):
                 'X-Target-Environment': 'mtncameroon'
             })
             data.update({'currency': 'XAF'})
-            r = requests.post(endpoint, headers=headers, json=data, verify=False)
+            r = http_client.post(endpoint, headers=headers, json=data, verify=False)
             if r.status_code == 202:
                 logger.debug("%s - MoMo: Request to pay submitted. "
                              "Amt: %s, Uname: %s, Phone: %s" % (weblet.ikwen_name, amount, username, tx.phone))
@@ -200,7 +200,7 @@ def query_transaction_status(request, weblet, momo_credentials, tx):
                 'Content-Type': 'application/json',
                 'Ocp-Apim-Subscription-Key': subscription_key
             }
-            r = requests.get(query_url, headers=headers, verify=False)
+            r = http_client.get(query_url, headers=headers, verify=False, idempotent=True)
             resp = r.json()
             if resp['status'] == 'PENDING':
                 continue
@@ -314,7 +314,7 @@ def send_money(request, cashout_request):
     elif getattr(settings, 'DEBUG', False):
         headers.update({'X-Target-Environment': 'sandbox'})
         data.update({'currency': 'EUR'})
-        r = requests.post(endpoint, headers=headers, json=data, verify=False, timeout=300)
+        r = http_client.post(endpoint, headers=headers, json=data, verify=False, timeout=300)
         if r.status_code == 202:
             logger.debug("%s - MoMo: Request to cashin submitted. "
                          "Amt: %s, Uname: %s, Phone: %s" % (weblet.ikwen_name, amount, username, tx.phone))
@@ -333,7 +333,7 @@ def send_money(request, cashout_request):
                 'X-Target-Environment': 'mtncameroon'
             })
             data.update({'currency': 'XAF'})
-            r = requests.post(endpoint, headers=headers, json=data, verify=False)
+            r = http_client.post(endpoint, headers=headers, json=data, verify=False)
             if r.status_code == 202:
                 logger.debug("%s - MoMo: Request to cashin submitted. "
                              "Amt: %s, Uname: %s, Phone: %s" % (weblet.ikwen_name, amount, username, tx.phone))
@@ -374,7 +374,7 @@ def refresh_collection_token(payment_mean):
     endpoint = _OPEN_API_URL + "/collection/token/"
     logger.debug("MoMo: Updating Access Token")
     try:
-        r = requests.post(endpoint, headers=headers, verify=False)
+        r = http_client.post(endpoint, headers=headers, verify=False)
         resp = r.json()
         access_token = resp['access_token']
         momo['access_token'] = access_token
@@ -391,7 +391,7 @@ def generate_disbursement_token(payment_mean):
     headers = {'Authorization': 'Basic ' + auth_header, 'Ocp-Apim-Subscription-Key': subscription_key}
     endpoint = _OPEN_API_URL + "/disbursement/token/"
     logger.debug("MoMo: Requesting Disbursement Access Token")
-    r = requests.post(endpoint, headers=headers, verify=False)
+    r = http_client.post(endpoint, headers=headers, verify=False)
     resp = r.json()
     momo['disbursement_access_token'] = resp['access_token']
     payment_mean.credentials = json.dumps(momo)
@@ -421,7 +421,7 @@ def test_request_payment():
         'Ocp-Apim-Subscription-Key': mtn_momo['subscription_key']
     }
     endpoint = 'https://sandbox.momodeveloper.mtn.com/collection/v1_0/requesttopay'
-    r = requests.post(endpoint, headers=headers, json=data, verify=False, timeout=300)
+    r = http_client.post(endpoint, headers=headers, json=data, verify=False, timeout=300)
     if r.status_code == 202:
         print("MTN MoMo: Request to pay submitted. Amt: %s, Phone: %s" % (amount, phone))
     else:
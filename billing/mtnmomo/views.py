@@ -3,7 +3,6 @@ import traceback
 import xml.etree.ElementTree as ET
 from threading import Thread
 
-import requests
 from django.conf import settings
 from django.db import transaction
 from django.http import HttpResponse
@@ -15,6 +14,7 @@ from requests.exceptions import SSLError
 from requests import RequestException
 from requests import Timeout
 
+from ikwen.core import http_client
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.core.utils import get_service_instance
 
@@ -92,7 +92,7 @@ def request_payment(request, tx):
     elif getattr(settings, 'DEBUG', False):
         mtn_momo = json.loads(PaymentMean.objects.get(slug=MTN_MOMO).credentials)
         data.update({'_email': mtn_momo['merchant_email']})
-        r = requests.get(cashout_url, params=data, verify=False, timeout=300)
+        r = http_client.get(cashout_url, params=data, verify=False, timeout=300)
         resp = r.json()
         tx.task_id = resp['ProcessingNumber']
         if resp['StatusCode'] == '01':
@@ -116,7 +116,7 @@ def request_payment(request, tx):
             username = request.user.username if request.user.is_authenticated() else '<Anonymous>'
             data.update({'_email': mtn_momo['merchant_email']})
             logger.debug("MTN MoMo: Initiating payment of %dF from %s: %s" % (amount, username, tx.phone))
-            r = requests.get(cashout_url, params=data, verify=False, timeout=300)
+            r = http_client.get(cashout_url, params=data, verify=False, timeout=300)
             tx.is_running = False
             resp = r.json()
             tx.task_id = resp['ProcessingNumber']
@@ -6,7 +6,6 @@ import time
 from datetime import datetime
 from threading import Thread
 
-import requests
 from requests.exceptions import SSLError
 from requests import RequestException
 from requests import Timeout
@@ -20,6 +19,7 @@ from django.template.defaultfilters import slugify
 from django.utils.module_loading import import_by_path
 from django.views.decorators.csrf import csrf_exempt
 
+from ikwen.core import http_client
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.core.utils import get_service_instance
 from ikwen.billing.mobile_payment import get_username_and_callback
@@ -56,7 +56,7 @@ def init_om_payment(request, *args, **kwargs):
     endpoint = _OM_API_URL + BASE_PATH + '/mp/init'
     headers = build_query_headers(payment_mean)
     try:
-        r = requests.post(endpoint, headers=headers, verify=False)
+        r = http_client.post(endpoint, headers=headers, verify=False)
         resp = r.json()
         pay_token = resp['data']['payToken']
     except:
@@ -96,7 +96,7 @@ def init_om_payment(request, *args, **kwargs):
     }
     endpoint = _OM_API_URL + BASE_PATH + '/mp/pay'
     if getattr(settings, 'DEBUG', False):
-        r = requests.post(endpoint, headers=headers, json=data, verify=False)
+        r = http_client.post(endpoint, headers=headers, json=data, verify=False)
         resp = r.json()
         tx.message = resp['message']
         tx.processor_tx_id = resp['data']['txnid']
@@ -108,7 +108,7 @@ def init_om_payment(request, *args, **kwargs):
     else:
         try:
             logger.debug("OM: Initiating payment of %dF from %s" % (amount, username))
-            r = requests.post(endpoint, headers=headers, json=data, verify=False)
+            r = http_client.post(endpoint, headers=headers, json=data, verify=False)
             resp = r.json()
             tx.message = resp['message']
             tx.processor_tx_id = resp['data']['txnid']
@@ -164,7 +164,7 @@ def query_transaction_status(request, weblet, payment_mean, tx):
             logger.debug("%s - OM: %s %s of %dF from %s timed out after waiting for 7mn" % (weblet.ikwen_name, op_label, tx.task_id, tx.amount, tx.username))
             break
         try:
-            r = requests.get(query_url, headers=headers, verify=False)
+            r = http_client.get(query_url, headers=headers, verify=False, idempotent=True)
             resp = r.json()
             status = resp['data']['status']
             if status == 'PENDING':
@@ -258,7 +258,7 @@ def send_money(request, cashout_request):
     try:
         generate_access_token(payment_mean)
         headers = build_query_headers(payment_mean)
-        r = requests.post(endpoint, headers=headers, verify=False)
+        r = http_client.post(endpoint, headers=headers, verify=False)
         resp = r.json()
         pay_token = resp['data']['payToken']
         with transaction.atomic(using='wallets'):
@@ -280,7 +280,7 @@ def send_money(request, cashout_request):
     }
     endpoint = _OM_API_URL + BASE_PATH + '/cashin/pay'
     if getattr(settings, 'DEBUG', False):
-        r = requests.post(endpoint, headers=headers, json=data, verify=False)
+        r = http_client.post(endpoint, headers=headers, json=data, verify=False)
         resp = r.json()
         tx.message = resp['message']
         status = resp['data']['status']
@@ -292,7 +292,7 @@ def send_money(request, cashout_request):
     else:
         try:
             logger.debug("OM: Initiating cashin of %dF to %s:%s. Token: %s" % (amount, username, phone, pay_token))
-            r = requests.post(endpoint, headers=headers, json=data, verify=False)
+            r = http_client.post(endpoint, headers=headers, json=data, verify=False)
             resp = r.json()
             tx.message = resp['message']
             status = resp['data']['status']
@@ -347,7 +347,7 @@ def generate_access_token(payment_mean):
     data = {'grant_type': 'client_credentials'}
     endpoint = _OM_API_URL + '/token'
     logger.debug("OM: Requesting Access Token")
-    r = requests.post(endpoint, headers=headers, data=data, verify=False)
+    r = http_client.post(endpoint, headers=headers, data=data, verify=False)
     resp = r.json()
     om['access_token'] = resp['access_token']
     payment_mean.credentials = json.dumps(om)
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 from django.conf import settings
 from django.core.management import call_command
@@ -13,8 +16,13 @@ setattr(settings, 'BILLING_SUBSCRIPTION_MODEL', 'billing.Subscription')
 
 from ikwen.billing.crons import send_invoices, send_invoice_reminders, send_invoice_overdue_notices, \
     suspend_customers_services
-from ikwen.billing.utils import get_invoicing_config_instance
-from ikwen.billing.models import Invoice, InvoicingConfig, Subscription
+from ikwen.billing.utils import get_invoicing_config_instance, claim_invoice_notice, get_next_invoice_number, \
+    InvoiceNumberAllocator, claim_due_subscription_ids, complete_expiry_event, release_expiry_event, \
+    EXPIRY_EVENT_CLAIM_TIMEOUT, get_pdf_assets_signature, generate_pdf_invoice, generate_pdf_invoices
+from ikwen.billing import utils as billing_utils
+from ikwen.conf import settings as ikwen_settings
+from ikwen.core.utils import get_service_instance
+from ikwen.billing.models import Invoice, InvoicingConfig, Subscription, InvoiceNotice, ExpiryEvent
 from ikwen.billing.tests_views import wipe_test_data
 
 __author__ = "Kom Sihon"
@@ -52,6 +60,27 @@ class BillingUtilsTest(TestCase):
         sent = Invoice.objects.all().count()
         self.assertEqual(sent, 3)
 
+    @override_settings(IKWEN_SERVICE_ID='54ad2bd9b37b335a18fe5801',
+                       EMAIL_BACKEND='django.core.mail.backends.filebased.EmailBackend',
+                       EMAIL_FILE_PATH='test_emails/billing/', IS_IKWEN=False)
+    def test_send_invoices_notifies_invoices_issued_by_interrupted_run(self):
+        """
+        An Invoice issued by a run that crashed before notifying it is notified by the next run, once.
+        """
+        Invoice.objects.all().delete()
+        invoicing_config = get_invoicing_config_instance()
+        expiry = datetime.now() + timedelta(days=invoicing_config.gap)
+        Subscription.objects.all().update(expiry=expiry)
+        subscription = Subscription.objects.all()[0]
+        invoice = Invoice.objects.create(subscription=subscription, member=subscription.member, amount=1000,
+                                         number=get_next_invoice_number(), due_date=subscription.expiry)
+        send_invoices()
+        self.assertEqual(Invoice.objects.all().count(), 3)
+        self.assertEqual(InvoiceNotice.objects.filter(type=InvoiceNotice.INVOICE).count(), 3)
+        self.assertFalse(claim_invoice_notice(invoice, InvoiceNotice.INVOICE))
+        send_invoices()
+        self.assertEqual(InvoiceNotice.objects.filter(type=InvoiceNotice.INVOICE).count(), 3)
+
     @override_settings(IKWEN_SERVICE_ID='54ad2bd9b37b335a18fe5801',
                        EMAIL_BACKEND='django.core.mail.backends.filebased.EmailBackend',
                        EMAIL_FILE_PATH='test_emails/billing/', IS_IKWEN=False)
@@ -64,6 +93,117 @@ class BillingUtilsTest(TestCase):
         sent = Invoice.objects.filter(reminders_sent=2).count()
         self.assertEqual(sent, 3)
 
+    def test_invoice_number_allocation(self):
+        suffix = datetime.now().strftime('%m%y')
+        count = Invoice.objects.all().count()
+        self.assertEqual(get_next_invoice_number(), 'A%d-%s' % (count + 1, suffix))
+        number_allocator = InvoiceNumberAllocator(block_size=3)
+        number_list = [number_allocator.next() for i in range(4)]
+        self.assertEqual(number_list, ['A%d-%s' % (count + i, suffix) for i in (2, 3, 4, 5)])
+        self.assertEqual(get_next_invoice_number(auto=False), 'M%d-%s' % (count + 8, suffix))
+        number_allocator = InvoiceNumberAllocator()
+        number_allocator.expect(2)
+        number_list = [number_allocator.next() for i in range(2)]
+        self.assertEqual(number_list, ['A%d-%s' % (count + i, suffix) for i in (9, 10)])
+        self.assertEqual(get_next_invoice_number(), 'A%d-%s' % (count + 11, suffix))
+
+    def test_claim_due_subscription_ids(self):
+        invoicing_config = get_invoicing_config_instance()
+        subscription = Subscription.objects.all()[0]
+        subscription.expiry = (datetime.now() + timedelta(days=invoicing_config.gap)).date()
+        subscription.save()  # Schedules ExpiryEvents as expiry changed
+        self.assertEqual(ExpiryEvent.objects.filter(subscription_id=subscription.id).count(), 2)
+        self.assertEqual(claim_due_subscription_ids(ExpiryEvent.SUSPENSION), [])
+        self.assertEqual(claim_due_subscription_ids(ExpiryEvent.INVOICE), [subscription.id])
+        self.assertEqual(claim_due_subscription_ids(ExpiryEvent.INVOICE), [])
+        release_expiry_event(subscription.id, ExpiryEvent.INVOICE)
+        self.assertEqual(claim_due_subscription_ids(ExpiryEvent.INVOICE), [subscription.id])
+        later = datetime.now() + timedelta(seconds=EXPIRY_EVENT_CLAIM_TIMEOUT + 60)
+        self.assertEqual(claim_due_subscription_ids(ExpiryEvent.INVOICE, later), [subscription.id])
+        complete_expiry_event(subscription.id, ExpiryEvent.INVOICE)
+        self.assertEqual(claim_due_subscription_ids(ExpiryEvent.INVOICE, later), [])
+        self.assertEqual(ExpiryEvent.objects.filter(subscription_id=subscription.id).count(), 1)
+
+    def test_expiry_events_scheduled_again_when_status_or_cost_changes(self):
+        subscription = Subscription.objects.all()[0]
+        subscription.expiry = (datetime.now() + timedelta(days=30)).date()
+        subscription.status = Subscription.ACTIVE
+        subscription.save()
+        ExpiryEvent.objects.filter(subscription_id=subscription.id).delete()
+        subscription.save()  # Nothing changed
+        self.assertEqual(ExpiryEvent.objects.filter(subscription_id=subscription.id).count(), 0)
+        subscription.status = Subscription.SUSPENDED
+        subscription.save()
+        self.assertEqual(ExpiryEvent.objects.filter(subscription_id=subscription.id).count(), 2)
+        ExpiryEvent.objects.filter(subscription_id=subscription.id).delete()
+        subscription.monthly_cost = (subscription.monthly_cost or 0) + 1000
+        subscription.save()
+        self.assertEqual(ExpiryEvent.objects.filter(subscription_id=subscription.id).count(), 2)
+
+    def test_claim_invoice_notice(self):
+        invoice = Invoice.objects.all()[0]
+        self.assertTrue(claim_invoice_notice(invoice, InvoiceNotice.REMINDER, '2020-01-01'))
+        self.assertFalse(claim_invoice_notice(invoice, InvoiceNotice.REMINDER, '2020-01-01'))
+        self.assertTrue(claim_invoice_notice(invoice, InvoiceNotice.REMINDER, '2020-01-08'))
+        self.assertTrue(claim_invoice_notice(invoice, InvoiceNotice.OVERDUE, '2020-01-08'))
+        self.assertEqual(InvoiceNotice.objects.filter(invoice_id=invoice.id).count(), 3)
+
+    def test_get_pdf_assets_signature(self):
+        folder = tempfile.mkdtemp()
+        try:
+            stamp = folder + '/stamp.jpg'
+            with open(stamp, 'w') as fh:
+                fh.write('stamp')
+            signature = get_pdf_assets_signature(stamp, folder + '/missing.png', None)
+            self.assertEqual(signature, get_pdf_assets_signature(stamp))
+            os.utime(stamp, (1500000000, 1500000000))
+            self.assertNotEqual(get_pdf_assets_signature(stamp), signature)
+            self.assertEqual(get_pdf_assets_signature(None), '')
+        finally:
+            shutil.rmtree(folder)
+
+    @override_settings(IKWEN_SERVICE_ID='54ad2bd9b37b335a18fe5801', IS_IKWEN=False)
+    def test_generate_pdf_invoices(self):
+        generated = []
+
+        def parse_string(xmlstring, filename):
+            generated.append(filename)
+            with open(filename, 'w') as fh:
+                fh.write(xmlstring.encode('utf-8'))
+
+        folder = tempfile.mkdtemp()
+        parse_string_before, cluster_media_root_before = billing_utils.trml2pdf.parseString, \
+            ikwen_settings.CLUSTER_MEDIA_ROOT
+        billing_utils.trml2pdf.parseString = parse_string
+        ikwen_settings.CLUSTER_MEDIA_ROOT = folder + '/'
+        try:
+            service = get_service_instance()
+            service.home_folder = folder
+            service.save()
+            os.makedirs(folder + '/' + service.project_name_slug)
+            with open(folder + '/stamp.jpg', 'w') as fh:
+                fh.write('stamp')
+            invoicing_config = get_invoicing_config_instance()
+            invoice = Invoice.objects.all()[0]
+            pdf_file = generate_pdf_invoice(invoicing_config, invoice)
+            self.assertTrue(os.path.exists(pdf_file))
+            self.assertEqual(generate_pdf_invoice(invoicing_config, invoice), pdf_file)
+            self.assertEqual(len(generated), 1)  # Unchanged, so not generated again
+            os.utime(folder + '/stamp.jpg', (1500000000, 1500000000))
+            generate_pdf_invoice(invoicing_config, invoice)
+            self.assertEqual(len(generated), 2)  # Stamp replaced, so generated again
+
+            invoice_id_list = [invoice.id for invoice in Invoice.objects.all()]
+            pdf_file_list = generate_pdf_invoices(invoice_id_list, workers=2, chunk_size=2)
+            self.assertEqual(len(pdf_file_list), len(invoice_id_list))
+            for pdf_file in pdf_file_list:
+                self.assertTrue(os.path.exists(pdf_file))
+            self.assertEqual(generate_pdf_invoices([]), [])
+        finally:
+            billing_utils.trml2pdf.parseString = parse_string_before
+            ikwen_settings.CLUSTER_MEDIA_ROOT = cluster_media_root_before
+            shutil.rmtree(folder)
+
     @override_settings(IKWEN_SERVICE_ID='54ad2bd9b37b335a18fe5801',
                        EMAIL_BACKEND='django.core.mail.backends.filebased.EmailBackend',
                        EMAIL_FILE_PATH='test_emails/billing/', IS_IKWEN=False)
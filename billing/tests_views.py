@@ -48,7 +48,8 @@ def wipe_test_data():
             model = getattr(ikwen.core.models, name)
             model.objects.using(alias).all().delete()
         for name in ('Product', 'Subscription', 'Payment', 'Invoice', 'InvoicingConfig',
-                     'PaymentMean', 'MoMoTransaction', 'SupportBundle', 'SupportCode'):
+                     'PaymentMean', 'MoMoTransaction', 'SupportBundle', 'SupportCode',
+                     'InvoicingCheckpoint', 'InvoiceNotice', 'InvoiceSequence', 'ExpiryEvent'):
             model = getattr(ikwen.billing.models, name)
             model.objects.using(alias).all().delete()
 
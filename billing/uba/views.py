@@ -2,7 +2,6 @@ import json
 import traceback
 from datetime import datetime
 
-import requests
 from requests.exceptions import SSLError, RequestException
 from requests import Timeout
 from django.conf import settings
@@ -11,6 +10,7 @@ from django.db import transaction
 from django.http.response import HttpResponseRedirect
 from django.utils.module_loading import import_by_path
 
+from ikwen.core import http_client
 from ikwen.core.utils import get_service_instance
 from ikwen.billing.models import PaymentMean, MoMoTransaction
 
@@ -57,7 +57,7 @@ def init_uba_web_payment(request, *args, **kwargs):
     })
     try:
         endpoint = API_URL + '/regptran'
-        resp = requests.post(endpoint, data, verify=False, timeout=130)
+        resp = http_client.post(endpoint, data, verify=False, timeout=130)
     except SSLError:
         momo_tx.status = MoMoTransaction.SSL_ERROR
         messages.error(request, 'SSL Error.')
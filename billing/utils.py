@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import logging
 import os
@@ -6,24 +7,28 @@ from datetime import datetime, timedelta
 from threading import Thread
 from xml.sax.saxutils import escape
 
-import requests
 from django.contrib.humanize.templatetags.humanize import intcomma
 from django.core.urlresolvers import reverse
-from django.template import Context
-from django.template.loader import get_template
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from requests.exceptions import SSLError, Timeout, RequestException
 
 from django.conf import settings
 from django.db import transaction as db_transaction
 from django.db.models import get_model
-from django.utils.translation import ugettext as _, activate
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext as _, ugettext_lazy, activate
 from trml2pdf import trml2pdf
 
+from ikwen.core import http_client
 from ikwen.accesscontrol.backends import UMBRELLA
-from ikwen.billing.models import InvoicingConfig, Invoice, AbstractSubscription, Payment
+from ikwen.billing.models import InvoicingConfig, Invoice, AbstractSubscription, Payment, InvoicingCheckpoint, \
+    InvoiceNotice, InvoiceSequence, ExpiryEvent, MoMoTransaction
+from ikwen.core.mail_campaign import MailCampaign, render_cached
 from ikwen.core.models import Service, OperatorWallet
-from ikwen.core.utils import get_service_instance, get_mail_content, XEmailMessage
-from ikwen.core.utils import set_counters, increment_history_field, add_database_to_settings
+from ikwen.core.utils import get_service_instance, get_mail_content, XEmailMessage, get_collection, get_mongo_query
+from ikwen.core.utils import set_counters, increment_history_fields, add_database_to_settings
 from ikwen.partnership.models import ApplicationRetailConfig
 from daraja.models import DARAJA, DarajaConfig, Dara
 
@@ -128,14 +133,35 @@ def get_payment_model():
     return get_model(*model_name.split('.'))
 
 
+def allocate_invoice_numbers(quantity=1, using='default'):
+    """
+    Atomically takes *quantity* numbers off the InvoiceSequence of the current month
+    in database *using*. The sequence is created on the first allocation of the month
+    and starts after the count of Invoices so that numbers keep growing as before.
+
+    @return: the first number allocated, and the month suffix as '%m%y'
+    """
+    suffix = datetime.now().strftime('%m%y')
+    name = 'invoice-' + suffix
+    collection = get_collection(InvoiceSequence, using)
+    while True:
+        doc = collection.find_and_modify({'name': name}, {'$inc': {'value': quantity}}, new=True)
+        if doc:
+            return doc['value'] - quantity + 1, suffix
+        start = Invoice.objects.using(using).all().count()
+        try:
+            collection.insert({'name': name, 'value': start})
+        except DuplicateKeyError:  # Created by a concurrent process
+            pass
+
+
 def get_next_invoice_number(auto=True, using='default'):
     """
     Generates the number to use for the next invoice. Auto-generated numbers
     start with "A" whereas manually generated invoice (those generated from the admin panel)
-    start with  "M". This is to avoid collision whenever an Invoice is manually generated
-    when cron task is running.
+    start with  "M".
 
-    So said if there are currently 999 invoices in the database and the Invoice is
+    So said if the last invoice of the month in the database was number 999 and the Invoice is
     generated by the cron job, the generated number will be "A1000". If generated
     from the admin, it should be "M1000"
 
@@ -143,9 +169,193 @@ def get_next_invoice_number(auto=True, using='default'):
     @param using: target database
     @return: number identifying the Invoice
     """
-    d = datetime.now().strftime('%m%y')
-    number = Invoice.objects.using(using).all().count() + 1
-    return "A%d-%s" % (number, d) if auto else "M%d-%s" % (number, d)
+    number, suffix = allocate_invoice_numbers(1, using)
+    return "A%d-%s" % (number, suffix) if auto else "M%d-%s" % (number, suffix)
+
+
+class InvoiceNumberAllocator(object):
+    """
+    Hands out invoice numbers to a batch like a cron run, reserving them by blocks of
+    *block_size* so that the InvoiceSequence is hit once per block rather than once per
+    Invoice. Numbers of the last block not used are lost, leaving a gap in the sequence,
+    so callers that know how many Invoices they may issue tell it with expect(). Eg:
+        number_allocator = InvoiceNumberAllocator()
+        number_allocator.expect(len(subscription_list))
+        for subscription in subscription_list:
+            number = number_allocator.next()
+    """
+    def __init__(self, auto=True, block_size=50, using='default'):
+        self.auto = auto
+        self.block_size = block_size
+        self.using = using
+        self.suffix = None
+        self.current = 0
+        self.last = 0
+        self.expected = None
+
+    def expect(self, count):
+        """
+        Tells that at most *count* more numbers will be asked, so that no block is larger.
+        """
+        self.expected = count
+
+    def next(self):
+        if self.current > self.last or self.suffix != datetime.now().strftime('%m%y'):
+            block_size = self.block_size
+            if self.expected is not None:
+                block_size = max(min(block_size, self.expected), 1)
+            self.current, self.suffix = allocate_invoice_numbers(block_size, self.using)
+            self.last = self.current + block_size - 1
+        number = self.current
+        self.current += 1
+        if self.expected:
+            self.expected -= 1
+        return "A%d-%s" % (number, self.suffix) if self.auto else "M%d-%s" % (number, self.suffix)
+
+
+def get_pending_invoice_subscription_ids(subscription_list, using='default'):
+    """
+    Returns the set of ids of Subscriptions in *subscription_list* having a Pending
+    Invoice. They are fetched in a single query projected on subscription_id, that
+    runs on the (subscription_id, status) index of the Invoice collection.
+    """
+    id_list = [ObjectId(subscription.id) for subscription in subscription_list]
+    if not id_list:
+        return set()
+    spec = {'subscription_id': {'$in': id_list}, 'status': Invoice.PENDING}
+    cursor = get_collection(Invoice, using).find(spec, {'subscription_id': 1, '_id': 0})
+    return set([str(doc['subscription_id']) for doc in cursor])
+
+
+EXPIRY_EVENT_CLAIM_TIMEOUT = 6 * 3600  # Seconds after which a claimed ExpiryEvent can be claimed again
+
+
+def _get_database_invoicing_config(using='default'):
+    """
+    InvoicingConfig of the Service whose database is *using*. Defaults to that of the current Service.
+    """
+    if using not in ('default', UMBRELLA):
+        try:
+            service = Service.objects.using(UMBRELLA).get(database=using)
+            return InvoicingConfig.objects.using(UMBRELLA).get(service=service)
+        except (Service.DoesNotExist, InvoicingConfig.DoesNotExist):
+            pass
+    return get_invoicing_config_instance()
+
+
+def schedule_expiry_events(subscription, invoicing_config=None, using='default'):
+    """
+    Schedules the ExpiryEvents of *subscription* from its expiry: issuance of its next
+    Invoice *gap* days before and its suspension *tolerance* days after. Events already
+    scheduled are moved, so it must be called whenever the expiry of a Subscription changes.
+    """
+    collection = get_collection(ExpiryEvent, using)
+    subscription_id = str(subscription.id)
+    if not subscription.expiry:
+        collection.remove({'subscription_id': subscription_id})
+        return
+    if not invoicing_config:
+        invoicing_config = _get_database_invoicing_config(using)
+    expiry = subscription.expiry
+    expiry = datetime(expiry.year, expiry.month, expiry.day)
+    tolerance = max(invoicing_config.tolerance, getattr(subscription, 'invoice_tolerance', 0) or 0)
+    now = timezone.now()
+    for event_type, due_on in ((ExpiryEvent.INVOICE, expiry - timedelta(days=invoicing_config.gap)),
+                               (ExpiryEvent.SUSPENSION, expiry + timedelta(days=tolerance))):
+        collection.update({'subscription_id': subscription_id, 'type': event_type},
+                          {'$set': {'due_on': due_on, 'claimed_on': None, 'updated_on': now},
+                           '$setOnInsert': {'created_on': now}},
+                          upsert=True)
+
+
+def claim_due_subscription_ids(event_type, now=None, using='default'):
+    """
+    Claims ExpiryEvents of *event_type* due by *now*, earliest first, and returns the ids of
+    their Subscriptions. Each event is claimed atomically, so concurrent crons never get the
+    same Subscription. Claimed events stay until :func:`complete_expiry_event` removes them
+    once the work is done. Claims older than EXPIRY_EVENT_CLAIM_TIMEOUT are taken again,
+    so that work interrupted by an error is retried by a later run.
+    """
+    if not now:
+        now = datetime.now()
+    collection = get_collection(ExpiryEvent, using)
+    query = {'type': event_type, 'due_on': {'$lte': now},
+             '$or': [{'claimed_on': None},
+                     {'claimed_on': {'$lt': now - timedelta(seconds=EXPIRY_EVENT_CLAIM_TIMEOUT)}}]}
+    subscription_id_list = []
+    while True:
+        doc = collection.find_and_modify(query, {'$set': {'claimed_on': now}}, sort=[('due_on', 1)],
+                                         fields={'subscription_id': 1})
+        if not doc:
+            break
+        subscription_id_list.append(doc['subscription_id'])
+    return subscription_id_list
+
+
+def complete_expiry_event(subscription_id, event_type, using='default'):
+    """
+    Removes the claimed ExpiryEvent of *event_type* of a Subscription once its work is done.
+    An event re-scheduled meanwhile is not claimed anymore and is kept.
+    """
+    get_collection(ExpiryEvent, using).remove({'subscription_id': str(subscription_id), 'type': event_type,
+                                               'claimed_on': {'$ne': None}})
+
+
+def release_expiry_event(subscription_id, event_type, due_on=None, using='default'):
+    """
+    Gives back the claimed ExpiryEvent of *event_type* of a Subscription skipped by a cron,
+    so that it is processed again when due, at *due_on* if set.
+    """
+    update = {'claimed_on': None}
+    if due_on:
+        update['due_on'] = due_on
+    get_collection(ExpiryEvent, using).update({'subscription_id': str(subscription_id), 'type': event_type,
+                                               'claimed_on': {'$ne': None}}, {'$set': update})
+
+
+TRANSACTION_STATS_BUCKETS = ('successful', 'running', 'failed', 'dropped')
+
+
+def get_transaction_stats(queryset):
+    """
+    Computes count and sums of amount, fees and dara_fees of MoMoTransactions of *queryset*
+    in a single $group aggregation, in total and for each of TRANSACTION_STATS_BUCKETS:
+    successful: status Success, running: is_running True, dropped: status Dropped,
+    failed: all others.
+
+    :return: dict of dict(count=..., amount=..., fees=..., dara_fees=...) keyed by 'total' and bucket name
+    """
+    successful = {'$eq': ['$status', MoMoTransaction.SUCCESS]}
+    running = {'$eq': ['$is_running', True]}
+    dropped = {'$eq': ['$status', MoMoTransaction.DROPPED]}
+    conditions = {
+        'total': None,
+        'successful': successful,
+        'running': running,
+        'failed': {'$not': [{'$or': [successful, dropped, running]}]},
+        'dropped': dropped,
+    }
+    group = {'_id': None}
+    for bucket, condition in conditions.items():
+        for field in ('count', 'amount', 'fees', 'dara_fees'):
+            value = 1 if field == 'count' else {'$ifNull': ['$' + field, 0]}
+            group[bucket + '__' + field] = {'$sum': value if condition is None else {'$cond': [condition, value, 0]}}
+    collection = get_collection(queryset.model, queryset.db)
+    result = collection.aggregate([{'$match': get_mongo_query(queryset)}, {'$group': group}])
+    docs = result['result'] if isinstance(result, dict) else list(result)
+    doc = docs[0] if docs else {}
+    stats = {}
+    for bucket in conditions.keys():
+        stats[bucket] = dict((field, doc.get(bucket + '__' + field, 0))
+                             for field in ('count', 'amount', 'fees', 'dara_fees'))
+    return stats
+
+
+def get_net_amount(stats):
+    """
+    Amount left to the merchant out of *stats* of a bucket of :func:`get_transaction_stats`.
+    """
+    return stats['amount'] - stats['fees'] - stats['dara_fees']
 
 
 def get_subscription_registered_message(subscription):
@@ -436,7 +646,148 @@ def get_payment_confirmation_message(payment, member):
     return subject, message, sms
 
 
-def generate_pdf_invoice(invoicing_config, invoice, template_name='billing/invoice.rml.html'):
+INVOICE_NOTICE_FIELDS = ('subject', 'message', 'member_name', 'invoice_url', 'invoice_details')
+
+
+def get_invoice_notice_campaign(service, config=None, extra_context=None):
+    """
+    Returns a MailCampaign rendering billing/mails/notice.html for Invoices of *service*,
+    to be used with render_invoice_notice() when sending notices to many members.
+    """
+    if not config:
+        config = service.basic_config
+    context = {'cta': ugettext_lazy("Pay now"), 'currency': config.currency_symbol, 'service': service,
+               'config': config, 'logo': config.logo, 'project_name': service.project_name,
+               'company_name': config.company_name}
+    if extra_context:
+        context.update(extra_context)
+    return MailCampaign('billing/mails/notice.html', service=service, extra_context=context,
+                        fields=INVOICE_NOTICE_FIELDS)
+
+
+def render_invoice_notice(campaign, member, subject, message, invoice, invoice_url):
+    """
+    Renders the notice of *invoice* to *member* out of a campaign
+    obtained with get_invoice_notice_campaign()
+    """
+    invoice_details = render_cached('billing/mails/snippets/invoice_details.html',
+                                    {'invoice': invoice, 'currency': campaign.context['currency']})
+    return campaign.render(subject=subject, message=mark_safe(message or ''), member_name=member.first_name,
+                           invoice_url=invoice_url, invoice_details=mark_safe(invoice_details))
+
+
+INVOICING_PAGE_SIZE = 200
+
+
+def get_invoicing_checkpoint(task, service, run_on):
+    """
+    Returns the InvoicingCheckpoint of the billing cron *task* on *service*
+    for the day *run_on*, creating it if it does not exist yet.
+    """
+    checkpoint, created = InvoicingCheckpoint.objects.get_or_create(task=task, service=service, run_on=run_on)
+    return checkpoint
+
+
+def iter_checkpointed(queryset, checkpoint, page_size=INVOICING_PAGE_SIZE):
+    """
+    Iterates over *queryset* in pages of *page_size* objects ordered by id, starting
+    after checkpoint.last_id. The checkpoint is saved after each page along with the
+    count and total_amount the caller updated, and marked Complete once all objects
+    are processed. Objects of a page interrupted midway are processed again on resume,
+    so the caller must be idempotent. See claim_invoice_notice()
+    """
+    while True:
+        page_qs = queryset.order_by('id')
+        if checkpoint.last_id:
+            page_qs = page_qs.filter(id__gt=checkpoint.last_id)
+        page = list(page_qs[:page_size])
+        for obj in page:
+            yield obj
+        if page:
+            checkpoint.last_id = page[-1].id
+        if len(page) < page_size:
+            break
+        checkpoint.save()
+    checkpoint.status = InvoicingCheckpoint.COMPLETE
+    checkpoint.save()
+
+
+def claim_invoice_notice(invoice, notice_type, tag='', using='default'):
+    """
+    Atomically records that the notice *notice_type* of *invoice* is being sent. *tag*
+    distinguishes notices of a type that are sent many times, like reminders.
+
+    :return: True if that notice was not sent yet, False otherwise
+    """
+    key = '%s:%s:%s' % (invoice.id, notice_type, tag)
+    now = timezone.now()
+    notice = {'key': key, 'invoice_id': str(invoice.id), 'type': notice_type, 'created_on': now, 'updated_on': now}
+    try:
+        previous = get_collection(InvoiceNotice, using).find_and_modify({'key': key}, {'$setOnInsert': notice},
+                                                                       upsert=True, new=False)
+    except DuplicateKeyError:  # Claimed by a concurrent process
+        return False
+    return previous is None
+
+
+def get_invoice_sms_callback(notice, sms_credit=None, log=logger):
+    """
+    Returns the callback of an SMSDispatcher sending the *notice* SMS of Invoices, each
+    submitted with tag=(invoice_number, charged). Failed SMS are logged on *log* with
+    their Invoice number and those *charged* get their credit refunded to *sms_credit*.
+    """
+    def on_sms_result(result):
+        number, charged = result.tag
+        if result.sent:
+            log.debug(u"%s for invoice #%s sent to %s" % (notice, number, result.recipient))
+            return
+        if charged and sms_credit is not None:
+            sms_credit.refund()
+        log.error(u"%s for invoice #%s not sent to %s: %s" % (notice, number, result.recipient, result.error))
+    return on_sms_result
+
+
+def get_pdf_assets_signature(*path_list):
+    """
+    Returns a string made of the modification time and size of files of *path_list*, so
+    that hashes of invoice PDFs change when the logo or the stamp is replaced, even by
+    a file with the same name. Missing files are left out.
+    """
+    signature = []
+    for path in path_list:
+        if path and os.path.exists(path):
+            stat = os.stat(path)
+            signature.append('%s:%d:%d' % (path, int(stat.st_mtime), stat.st_size))
+    return '|'.join(signature)
+
+
+def _get_pdf_vendor_context(invoicing_config, vendor_weblet):
+    from ikwen.conf.settings import MEDIA_ROOT
+    config = vendor_weblet.config
+    context = {
+        'vendor': config,
+        'vendor_address': escape(config.address).encode('ascii', 'xmlcharrefreplace'),
+        'vendor_name': escape(config.company_name).encode('ascii', 'xmlcharrefreplace')
+    }
+    if invoicing_config.logo.name and os.path.exists(MEDIA_ROOT + invoicing_config.logo.name):
+        context['weblet_logo'] = MEDIA_ROOT + invoicing_config.logo.name
+    if os.path.exists(vendor_weblet.home_folder + '/stamp.jpg'):
+        context['stamp'] = vendor_weblet.home_folder + '/stamp.jpg'
+    context['assets_signature'] = get_pdf_assets_signature(context.get('weblet_logo'), context.get('stamp'))
+    return context
+
+
+def generate_pdf_invoice(invoicing_config, invoice, template_name='billing/invoice.rml.html', vendor_cache=None):
+    """
+    Generates the PDF of *invoice* and returns the path of the file. The PDF is written
+    straight to disk by trml2pdf, next to a .sha1 file holding the hash of the RML it
+    was generated from and of the logo and stamp files, so that it is not generated
+    again if neither the Invoice nor those images changed.
+
+    :param vendor_cache: dict in which the vendor config, logo and stamp are kept between
+        calls. Pass the same one for all Invoices of a batch, so that they are only loaded
+        once per vendor weblet.
+    """
     from ikwen.conf.settings import CLUSTER_MEDIA_ROOT, MEDIA_ROOT
     vendor_weblet = get_service_instance()
     context = {
@@ -469,32 +820,81 @@ def generate_pdf_invoice(invoicing_config, invoice, template_name='billing/invoi
     context['customer_name'] = escape(member.get_full_name()).encode('ascii', 'xmlcharrefreplace')
     context['invoiced_to'] = escape(invoice.get_invoiced_to()).encode('ascii', 'xmlcharrefreplace')
     context['invoice_status'] = escape(_(invoice.status)).encode('ascii', 'xmlcharrefreplace')
-    config = vendor_weblet.config
-    context['vendor'] = config
-    context['vendor_address'] = escape(config.address).encode('ascii', 'xmlcharrefreplace')
-    context['vendor_name'] = escape(config.company_name).encode('ascii', 'xmlcharrefreplace')
     for entry in invoice.entries:
         entry.label = escape(entry.item.label).encode('ascii', 'xmlcharrefreplace')
         entry.short_description = escape(entry.short_description).encode('ascii', 'xmlcharrefreplace')
-    if invoicing_config.logo.name and os.path.exists(MEDIA_ROOT + invoicing_config.logo.name):
-        context['weblet_logo'] = MEDIA_ROOT + invoicing_config.logo.name
-    if os.path.exists(vendor_weblet.home_folder + '/stamp.jpg'):
-        context['stamp'] = vendor_weblet.home_folder + '/stamp.jpg'
+    if vendor_cache is None:
+        vendor_context = _get_pdf_vendor_context(invoicing_config, vendor_weblet)
+    else:
+        key = (vendor_weblet.id, invoicing_config.id)
+        vendor_context = vendor_cache.get(key)
+        if vendor_context is None:
+            vendor_context = _get_pdf_vendor_context(invoicing_config, vendor_weblet)
+            vendor_cache[key] = vendor_context
+    context.update(vendor_context)
     media_root = CLUSTER_MEDIA_ROOT + vendor_weblet.project_name_slug + '/'
 
-    invoice_tpl = get_template(template_name)
     invoice_pdf_file = media_root + '%s_Invoice_%s_%s.pdf' % (vendor_weblet.project_name_slug.upper(), invoice.number,
                                                               invoice.date_issued.strftime("%Y-%m-%d"))
-    d = Context(context)
-    xmlstring = invoice_tpl.render(d)
+    xmlstring = render_cached(template_name, context)
     xmlstring = xmlstring.replace(u'\xa0', ' ').replace(u'\xe9', 'e')
-    pdfstr = trml2pdf.parseString(xmlstring)
-    fh = open(invoice_pdf_file, 'w')
-    fh.write(pdfstr)
-    fh.close()
+    content_hash = hashlib.sha1(xmlstring.encode('utf-8'))
+    content_hash.update(context['assets_signature'].encode('utf-8'))
+    content_hash = content_hash.hexdigest()
+    hash_file = invoice_pdf_file + '.sha1'
+    if os.path.exists(invoice_pdf_file) and os.path.exists(hash_file):
+        with open(hash_file) as fh:
+            if fh.read() == content_hash:
+                return invoice_pdf_file
+    tmp_file = invoice_pdf_file + '.tmp'
+    trml2pdf.parseString(xmlstring, tmp_file)
+    os.rename(tmp_file, invoice_pdf_file)
+    with open(hash_file, 'w') as fh:
+        fh.write(content_hash)
     return invoice_pdf_file
 
 
+def _generate_pdf_invoice_list(args):
+    invoice_id_list, using, template_name = args
+    invoicing_config = get_invoicing_config_instance(using)
+    vendor_cache = {}
+    pdf_file_list = []
+    for invoice in Invoice.objects.using(using).filter(pk__in=invoice_id_list):
+        try:
+            pdf_file_list.append(generate_pdf_invoice(invoicing_config, invoice, template_name, vendor_cache))
+        except:
+            logger.error(u"Could not generate PDF of Invoice %s" % invoice.id, exc_info=True)
+    return pdf_file_list
+
+
+def generate_pdf_invoices(invoice_id_list, workers=4, chunk_size=50, using='default',
+                          template_name='billing/invoice.rml.html'):
+    """
+    Generates PDF of many Invoices at once, like at the end of the month, in a pool of
+    *workers* processes. Each process gets Invoices by chunks of *chunk_size* and keeps
+    vendor configs, logos and stamps for the whole chunk.
+
+    :return: list of paths of PDF files generated
+    """
+    if not invoice_id_list:
+        return []
+    from multiprocessing import Pool
+    from django.db import connections
+    chunk_list = [(invoice_id_list[i:i + chunk_size], using, template_name)
+                  for i in range(0, len(invoice_id_list), chunk_size)]
+    for connection in connections.all():
+        connection.close()  # Connections must not be shared with worker processes
+    pool = Pool(workers)
+    pdf_file_list = []
+    try:
+        for chunk_file_list in pool.imap_unordered(_generate_pdf_invoice_list, chunk_list):
+            pdf_file_list.extend(chunk_file_list)
+    finally:
+        pool.close()
+        pool.join()
+    return pdf_file_list
+
+
 def pay_with_wallet_balance(invoice):
     service = invoice.subscription
     amount0 = invoice.amount
@@ -526,7 +926,7 @@ def pay_with_wallet_balance(invoice):
 def notify_event(service, url, params):
     project_name = service.project_name
     try:
-        r = requests.get(url, params)
+        r = http_client.get(url, params)
         message = "%s: HTTP %s - Notification using %s" % (project_name, r.status_code, r.url)
         print(message)
         logger.debug(message)
@@ -600,57 +1000,57 @@ def _share_payment_and_set_stats_ikwen(invoice, total_months, payment_mean_slug=
             app_partner = service_partner.app
 
             set_counters(partner_original)
-            increment_history_field(partner_original, 'turnover_history', invoice.amount)
-            increment_history_field(partner_original, 'invoice_earnings_history', partner_earnings)
-            increment_history_field(partner_original, 'earnings_history', partner_earnings)
-            increment_history_field(partner_original, 'invoice_count_history')
+            increment_history_fields(partner_original, {'turnover_history': invoice.amount,
+                                                        'invoice_earnings_history': partner_earnings,
+                                                        'earnings_history': partner_earnings,
+                                                        'invoice_count_history': 1})
 
             set_counters(service_partner)
-            increment_history_field(service_partner, 'invoice_earnings_history', partner_earnings)
-            increment_history_field(service_partner, 'earnings_history', partner_earnings)
-            increment_history_field(service_partner, 'invoice_count_history')
+            increment_history_fields(service_partner, {'invoice_earnings_history': partner_earnings,
+                                                       'earnings_history': partner_earnings,
+                                                       'invoice_count_history': 1})
 
             set_counters(app_partner)
-            increment_history_field(app_partner, 'invoice_earnings_history', partner_earnings)
-            increment_history_field(app_partner, 'earnings_history', partner_earnings)
-            increment_history_field(app_partner, 'invoice_count_history')
+            increment_history_fields(app_partner, {'invoice_earnings_history': partner_earnings,
+                                                   'earnings_history': partner_earnings,
+                                                   'invoice_count_history': 1})
 
         set_counters(partner)
-        increment_history_field(partner, 'turnover_history', invoice.amount)
-        increment_history_field(partner, 'invoice_earnings_history', ikwen_earnings)
-        increment_history_field(partner, 'earnings_history', ikwen_earnings)
-        increment_history_field(partner, 'invoice_count_history')
+        increment_history_fields(partner, {'turnover_history': invoice.amount,
+                                           'invoice_earnings_history': ikwen_earnings,
+                                           'earnings_history': ikwen_earnings,
+                                           'invoice_count_history': 1})
 
         partner_app = partner.app  # This is going to be the ikwen core/retail app
         set_counters(partner_app)
-        increment_history_field(partner_app, 'turnover_history', invoice.amount)
-        increment_history_field(partner_app, 'invoice_earnings_history', ikwen_earnings)
-        increment_history_field(partner_app, 'earnings_history', ikwen_earnings)
-        increment_history_field(partner_app, 'invoice_count_history')
+        increment_history_fields(partner_app, {'turnover_history': invoice.amount,
+                                               'invoice_earnings_history': ikwen_earnings,
+                                               'earnings_history': ikwen_earnings,
+                                               'invoice_count_history': 1})
 
     set_counters(service_umbrella)
-    increment_history_field(service_umbrella, 'turnover_history', invoice.amount)
-    increment_history_field(service_umbrella, 'invoice_earnings_history', ikwen_earnings)
-    increment_history_field(service_umbrella, 'earnings_history', ikwen_earnings)
-    increment_history_field(service_umbrella, 'invoice_count_history')
+    increment_history_fields(service_umbrella, {'turnover_history': invoice.amount,
+                                                'invoice_earnings_history': ikwen_earnings,
+                                                'earnings_history': ikwen_earnings,
+                                                'invoice_count_history': 1})
 
     app_umbrella = service_umbrella.app  # The app powering the site that is paying the invoice
     set_counters(app_umbrella)
-    increment_history_field(app_umbrella, 'turnover_history', invoice.amount)
-    increment_history_field(app_umbrella, 'invoice_earnings_history', ikwen_earnings)
-    increment_history_field(app_umbrella, 'earnings_history', ikwen_earnings)
-    increment_history_field(app_umbrella, 'invoice_count_history')
+    increment_history_fields(app_umbrella, {'turnover_history': invoice.amount,
+                                            'invoice_earnings_history': ikwen_earnings,
+                                            'earnings_history': ikwen_earnings,
+                                            'invoice_count_history': 1})
 
 
 def set_dara_stats(partner_original, service_partner, invoice, dara_earnings):
     set_counters(partner_original)
-    increment_history_field(partner_original, 'turnover_history', dara_earnings)
-    increment_history_field(partner_original, 'earnings_history', dara_earnings)
-    increment_history_field(partner_original, 'transaction_count_history')
+    increment_history_fields(partner_original, {'turnover_history': dara_earnings,
+                                                'earnings_history': dara_earnings,
+                                                'transaction_count_history': 1})
 
     set_counters(service_partner)
-    increment_history_field(service_partner, 'earnings_history', dara_earnings)
-    increment_history_field(service_partner, 'transaction_count_history')
+    increment_history_fields(service_partner, {'earnings_history': dara_earnings,
+                                               'transaction_count_history': 1})
 
     ikwen_service = get_service_instance()
     try:
@@ -692,9 +1092,9 @@ def _share_payment_and_set_stats_other(invoice, payment_mean_slug='mtn-momo', tr
     service.raise_balance(service_earnings, payment_mean_slug)
 
     set_counters(service)
-    increment_history_field(service, 'turnover_history', invoice.amount)
-    increment_history_field(service, 'earnings_history', service_earnings)
-    increment_history_field(service, 'invoice_count_history')
+    increment_history_fields(service, {'turnover_history': invoice.amount,
+                                       'earnings_history': service_earnings,
+                                       'invoice_count_history': 1})
 
     if ikwen_earnings == 0:
         return
@@ -710,43 +1110,43 @@ def _share_payment_and_set_stats_other(invoice, payment_mean_slug='mtn-momo', tr
         partner.raise_balance(partner_earnings, payment_mean_slug)
 
         set_counters(service_partner)
-        increment_history_field(service_partner, 'turnover_history', invoice.amount)
-        increment_history_field(service_partner, 'earnings_history', partner_earnings)
-        increment_history_field(service_partner, 'transaction_earnings_history', partner_earnings)
-        increment_history_field(service_partner, 'transaction_count_history')
+        increment_history_fields(service_partner, {'turnover_history': invoice.amount,
+                                                   'earnings_history': partner_earnings,
+                                                   'transaction_earnings_history': partner_earnings,
+                                                   'transaction_count_history': 1})
 
         app_partner = service_partner.app
         set_counters(app_partner)
-        increment_history_field(app_partner, 'turnover_history', invoice.amount)
-        increment_history_field(app_partner, 'earnings_history', partner_earnings)
-        increment_history_field(app_partner, 'transaction_earnings_history', partner_earnings)
-        increment_history_field(app_partner, 'transaction_count_history')
+        increment_history_fields(app_partner, {'turnover_history': invoice.amount,
+                                               'earnings_history': partner_earnings,
+                                               'transaction_earnings_history': partner_earnings,
+                                               'transaction_count_history': 1})
 
         set_counters(partner_umbrella)
-        increment_history_field(partner_umbrella, 'turnover_history', invoice.amount)
-        increment_history_field(partner_umbrella, 'earnings_history', ikwen_earnings)
-        increment_history_field(partner_umbrella, 'transaction_earnings_history', ikwen_earnings)
-        increment_history_field(partner_umbrella, 'transaction_count_history')
+        increment_history_fields(partner_umbrella, {'turnover_history': invoice.amount,
+                                                    'earnings_history': ikwen_earnings,
+                                                    'transaction_earnings_history': ikwen_earnings,
+                                                    'transaction_count_history': 1})
 
         partner_app_umbrella = partner_umbrella.app
         set_counters(partner_app_umbrella)
-        increment_history_field(partner_app_umbrella, 'turnover_history', invoice.amount)
-        increment_history_field(partner_app_umbrella, 'earnings_history', ikwen_earnings)
-        increment_history_field(partner_app_umbrella, 'transaction_earnings_history', ikwen_earnings)
-        increment_history_field(partner_app_umbrella, 'transaction_count_history')
+        increment_history_fields(partner_app_umbrella, {'turnover_history': invoice.amount,
+                                                        'earnings_history': ikwen_earnings,
+                                                        'transaction_earnings_history': ikwen_earnings,
+                                                        'transaction_count_history': 1})
 
     set_counters(service_umbrella)
-    increment_history_field(service_umbrella, 'turnover_history', invoice.amount)
-    increment_history_field(service_umbrella, 'earnings_history', ikwen_earnings)
-    increment_history_field(service_umbrella, 'transaction_earnings_history', ikwen_earnings)
-    increment_history_field(service_umbrella, 'transaction_count_history')
+    increment_history_fields(service_umbrella, {'turnover_history': invoice.amount,
+                                                'earnings_history': ikwen_earnings,
+                                                'transaction_earnings_history': ikwen_earnings,
+                                                'transaction_count_history': 1})
 
     app_umbrella = service_umbrella.app
     set_counters(app_umbrella)
-    increment_history_field(app_umbrella, 'turnover_history', invoice.amount)
-    increment_history_field(app_umbrella, 'earnings_history', ikwen_earnings)
-    increment_history_field(app_umbrella, 'transaction_earnings_history', ikwen_earnings)
-    increment_history_field(app_umbrella, 'transaction_count_history')
+    increment_history_fields(app_umbrella, {'turnover_history': invoice.amount,
+                                            'earnings_history': ikwen_earnings,
+                                            'transaction_earnings_history': ikwen_earnings,
+                                            'transaction_count_history': 1})
 
 
 def refresh_currencies_exchange_rates():
@@ -762,7 +1162,7 @@ def refresh_currencies_exchange_rates():
     url = 'https://openexchangerates.org/api/latest.json'
     params = {'app_id': OPENEXCHANGE_APP_ID, 'base': 'USD'}
     if getattr(settings, 'DEBUG', False):
-        r = requests.get(url, params=params)
+        r = http_client.get(url, params=params, idempotent=True)
         rates = r.json()['rates']
         base = Currency.active.base()
         ub_factor = rates[base.code]  # USD factor against base currency
@@ -774,7 +1174,7 @@ def refresh_currencies_exchange_rates():
         config.save()
     else:
         try:
-            r = requests.get(url, params=params)
+            r = http_client.get(url, params=params, idempotent=True)
             rates = r.json()['rates']
             base = Currency.active.base()
             ub_factor = rates[base.code]  # USD factor against base currency
@@ -799,10 +1199,11 @@ def detect_and_set_currency_by_ip(request):
         else:
             ip = request.META['REMOTE_ADDR']
         from ikwen.conf import settings as ikwen_settings
-        r = requests.get('http://api.ipstack.com/%s?access_key=%s' % (ip, ikwen_settings.IP_STACK_API_KEY))
+        r = http_client.get('http://api.ipstack.com/%s?access_key=%s' % (ip, ikwen_settings.IP_STACK_API_KEY),
+                            idempotent=True)
         result = json.loads(r.content.decode('utf-8'))
         country_code = result['country_code']
-        r = requests.get('http://country.io/currency.json')
+        r = http_client.get('http://country.io/currency.json', idempotent=True)
         result = json.loads(r.content)
         currency_code = result[country_code]
         try:
@@ -8,7 +8,7 @@ from datetime import datetime, timedelta
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.core.urlresolvers import reverse
-from django.db.models import Q, Sum
+from django.db.models import Q
 from django.http import HttpResponse
 from django.http import HttpResponseForbidden
 from django.http import HttpResponseRedirect
@@ -30,8 +30,10 @@ from ikwen.billing.models import PaymentMean, CloudBillingPlan, IkwenInvoiceItem
 from ikwen.billing.orangemoney.views import init_web_payment, ORANGE_MONEY
 from ikwen.billing.yup.views import YUP, init_yup_web_payment
 from ikwen.billing.uba.views import UBA, init_uba_web_payment
-from ikwen.billing.utils import get_subscription_model, get_product_model
+from ikwen.billing.utils import get_subscription_model, get_product_model, get_transaction_stats, get_net_amount, \
+    TRANSACTION_STATS_BUCKETS
 from ikwen.core.models import Service, Application
+from ikwen.core.pagination import CACHED_COUNT
 from ikwen.core.utils import get_service_instance
 from ikwen.core.views import HybridListView
 from ikwen.partnership.models import ApplicationRetailConfig
@@ -114,6 +116,8 @@ class TransactionLog(HybridListView):
     html_results_template_name = 'billing/snippets/transaction_log_results.html'
     page_size = 200
     search_field = 'processor_tx_id'
+    keyset_pagination = True
+    count_mode = CACHED_COUNT
 
     def get_filter_criteria(self):
         criteria = {}
@@ -168,7 +172,6 @@ class TransactionLog(HybridListView):
         start_date = criteria.pop('start_date')
         end_date = criteria.pop('end_date')
         queryset = queryset.filter(created_on__range=(start_date, end_date))
-        self.mark_dropped(queryset)
         if criteria.get('status') == MoMoTransaction.FAILURE:
             criteria.pop('status')
             queryset = queryset.exclude(Q(status=MoMoTransaction.SUCCESS) |
@@ -177,52 +180,17 @@ class TransactionLog(HybridListView):
         return queryset.filter(**criteria)
 
     def sum_transactions(self, queryset, **criteria):
-        count_successful, count_running, count_failed, count_dropped = 0, 0, 0, 0
-        amount_successful, amount_running, amount_failed, amount_dropped, amount_total = 0, 0, 0, 0, 0
-        if criteria.get('status') is None and criteria.get('is_running') is None:
-            count_successful = queryset.filter(status=MoMoTransaction.SUCCESS).count()
-            aggr = queryset.filter(status=MoMoTransaction.SUCCESS).aggregate(Sum('amount'))
-            aggr_fees = queryset.filter(status=MoMoTransaction.SUCCESS).aggregate(Sum('fees'))
-            aggr_dara_fees = queryset.filter(status=MoMoTransaction.SUCCESS).aggregate(Sum('dara_fees'))
-            if aggr['amount__sum']:
-                amount_successful = aggr['amount__sum'] - aggr_fees['fees__sum'] - aggr_dara_fees['dara_fees__sum']
-            count_running = queryset.filter(is_running=True).count()
-            aggr = queryset.filter(is_running=True).aggregate(Sum('amount'))
-            if aggr['amount__sum']:
-                amount_running = aggr['amount__sum']
-            count_failed = queryset.exclude(Q(status=MoMoTransaction.SUCCESS) |
-                                             Q(status=MoMoTransaction.DROPPED) |
-                                             Q(is_running=True)).count()
-            aggr = queryset.exclude(Q(status=MoMoTransaction.SUCCESS) |
-                                    Q(status=MoMoTransaction.DROPPED) |
-                                    Q(is_running=True)).aggregate(Sum('amount'))
-            if aggr['amount__sum']:
-                amount_failed = aggr['amount__sum']
-            count_dropped = queryset.filter(status=MoMoTransaction.DROPPED).count()
-            aggr = queryset.filter(status=MoMoTransaction.DROPPED).aggregate(Sum('amount'))
-            if aggr['amount__sum']:
-                amount_dropped = aggr['amount__sum']
-        aggr = queryset.aggregate(Sum('amount'))
-        if aggr['amount__sum']:
-            amount_total += aggr['amount__sum']
-        count_total = queryset.count()
-        meta = {
-            'total': {'count': count_total, 'amount': amount_total},
-            'successful': {'count': count_successful, 'amount': amount_successful},
-            'running': {'count': count_running, 'amount': amount_running},
-            'failed': {'count': count_failed, 'amount': amount_failed},
-            'dropped': {'count': count_dropped, 'amount': amount_dropped},
-        }
+        stats = get_transaction_stats(queryset)
+        meta = {'total': {'count': stats['total']['count'], 'amount': stats['total']['amount']}}
+        for bucket in TRANSACTION_STATS_BUCKETS:
+            meta[bucket] = {'count': 0, 'amount': 0}
+            if criteria.get('status') is None and criteria.get('is_running') is None:
+                meta[bucket]['count'] = stats[bucket]['count']
+                meta[bucket]['amount'] = stats[bucket]['amount']
+        if meta['successful']['amount']:
+            meta['successful']['amount'] = get_net_amount(stats['successful'])
         return meta
 
-    def mark_dropped(self, queryset):
-        for tx in queryset.filter(is_running=True):
-            diff = datetime.now() - tx.created_on
-            if diff.total_seconds() > 660:
-                tx.is_running = False
-                tx.status = MoMoTransaction.DROPPED
-                tx.save()
-
     def get_context_data(self, **kwargs):
         context = super(TransactionLog, self).get_context_data(**kwargs)
         queryset = context['queryset']
@@ -10,6 +10,7 @@ from django.shortcuts import render
 from django.template.defaultfilters import slugify
 from django.utils.module_loading import import_by_path
 
+from ikwen.core import http_client
 from ikwen.core.utils import get_service_instance
 from ikwen.billing.models import PaymentMean, MoMoTransaction
 
@@ -41,7 +42,7 @@ def init_yup_web_payment(request, *args, **kwargs):
     # Request a session id
     try:
         params = {'merchantid': yup['merchant_id']}
-        session_id_request = requests.get(api_url, params=params, verify=False)
+        session_id_request = http_client.get(api_url, params=params, verify=False)
     except requests.exceptions.HTTPError as errh:
         logger.error("YUP: Http Error:", errh)
         return HttpResponseRedirect(request.session['cancel_url'])
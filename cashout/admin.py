@@ -5,15 +5,16 @@ from django.conf import settings
 from django.contrib import messages
 from django.core.mail import EmailMessage
 from django.db import transaction
-from django.db.models import Sum
 from djangotoolbox.admin import admin
 from django.utils.translation import gettext as _
 from ikwen.accesscontrol.backends import UMBRELLA
 
 from ikwen.billing.models import MoMoTransaction
+from ikwen.billing.utils import get_transaction_stats, get_net_amount
 
 from ikwen.core.models import Service, Config, CASH_OUT_REQUEST_PAID
 from ikwen.core.models import OperatorWallet
+from ikwen.core.rollups import refresh_rollup_wallets
 from ikwen.core.utils import get_mail_content, add_event, set_counters, increment_history_field
 from ikwen.cashout.models import CashOutMethod, CashOutRequest, CashOutAddress
 
@@ -56,12 +57,7 @@ class CashOutRequestAdmin(admin.ModelAdmin):
                 queryset = MoMoTransaction.objects.using('wallets') \
                     .filter(service_id=service.id, created_on__gt=obj.paid_on,
                             is_running=False, status=MoMoTransaction.SUCCESS, wallet=obj.provider)
-                aggr = queryset.aggregate(Sum('amount'))
-                aggr_fees = queryset.aggregate(Sum('fees'))
-                aggr_dara_fees = queryset.aggregate(Sum('dara_fees'))
-                amount_successful = 0
-                if aggr['amount__sum']:
-                    amount_successful = aggr['amount__sum'] - aggr_fees['fees__sum'] - aggr_dara_fees['dara_fees__sum']
+                amount_successful = get_net_amount(get_transaction_stats(queryset)['total'])
                 wallet.balance = amount_successful
                 wallet.save(using='wallets')
                 iao = service.member
@@ -90,6 +86,8 @@ class CashOutRequestAdmin(admin.ModelAdmin):
                 increment_history_field(ikwen_service, 'cash_out_history', obj.amount)
                 increment_history_field(ikwen_service, 'cash_out_count_history')
         super(CashOutRequestAdmin, self).save_model(request, obj, form, change)
+        if obj.status == CashOutRequest.PAID:
+            refresh_rollup_wallets(Service.objects.get(pk=obj.service_id))
 
 
 if getattr(settings, 'IS_UMBRELLA', False):
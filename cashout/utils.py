@@ -5,15 +5,17 @@ from threading import Thread
 from django.conf import settings
 from django.core.mail import EmailMessage
 from django.db import transaction as db_transaction
-from django.db.models import Sum
 from django.http import HttpResponse
 from django.utils.translation import ugettext as _
 
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.core.models import Service, Config, CASH_OUT_REQUEST_PAID, OperatorWallet, CASH_OUT_REQUEST_EVENT
+from ikwen.core.outbox import enqueue_event, enqueue_mail
+from ikwen.core.rollups import refresh_rollup_wallets
 from ikwen.core.utils import add_event, get_mail_content, XEmailMessage, set_counters, increment_history_field, \
     get_config_model
 from ikwen.billing.models import MoMoTransaction
+from ikwen.billing.utils import get_transaction_stats, get_net_amount
 from ikwen.cashout.models import CashOutRequest, CashOutAddress, CashOutMethod
 
 from daraja.models import DARAJA, Dara
@@ -35,18 +37,15 @@ def create_cashout_request(config, cashout_method, cashout_address):
     if weblet.app.slug == DARAJA:
         dara = Dara.objects.get(member=weblet.member)
         queryset = queryset.filter(dara_id=dara.id)
-        if queryset.count() <= 0:
-            return
-        aggr_dara_fees = queryset.aggregate(Sum('dara_fees'))
-        amount_successful = aggr_dara_fees['dara_fees__sum']
     else:
         queryset = queryset.filter(service_id=weblet.id)
-        if queryset.count() <= 0:
-            return
-        aggr = queryset.aggregate(Sum('amount'))
-        aggr_fees = queryset.aggregate(Sum('fees'))
-        aggr_dara_fees = queryset.aggregate(Sum('dara_fees'))
-        amount_successful = aggr['amount__sum'] - aggr_fees['fees__sum'] - aggr_dara_fees['dara_fees__sum']
+    stats = get_transaction_stats(queryset)['total']
+    if stats['count'] <= 0:
+        return
+    if weblet.app.slug == DARAJA:
+        amount_successful = stats['dara_fees']
+    else:
+        amount_successful = get_net_amount(stats)
 
     cor = CashOutRequest(service_id=weblet.id, member_id=weblet.member.id, amount=amount_successful, paid_on=now,
                          method=cashout_method.name, account_number=cashout_address.account_number, provider=provider,
@@ -87,20 +86,10 @@ def notify_cashout_and_reset_counters(request, transaction, *args, **kwargs):
         if weblet.app.slug == DARAJA:
             dara = Dara.objects.get(member=iao)
             queryset = queryset.filter(dara_id=dara.id)
-            if queryset.count() > 0:
-                aggr = queryset.aggregate(Sum('dara_fees'))
-                amount_successful = aggr['dara_fees__sum']
-            else:
-                amount_successful = 0
+            amount_successful = get_transaction_stats(queryset)['total']['dara_fees']
         else:
             queryset = queryset.filter(service_id=weblet.id)
-            if queryset.count() > 0:
-                aggr = queryset.aggregate(Sum('amount'))
-                aggr_fees = queryset.aggregate(Sum('fees'))
-                aggr_dara_fees = queryset.aggregate(Sum('dara_fees'))
-                amount_successful = aggr['amount__sum'] - aggr_fees['fees__sum'] - aggr_dara_fees['dara_fees__sum']
-            else:
-                amount_successful = 0
+            amount_successful = get_net_amount(get_transaction_stats(queryset)['total'])
         wallet.balance = amount_successful
         wallet.save(using='wallets')
         if getattr(settings, 'TESTING', False):
@@ -111,7 +100,7 @@ def notify_cashout_and_reset_counters(request, transaction, *args, **kwargs):
             ikwen_service = Service.objects.using(UMBRELLA).get(pk=IKWEN_SERVICE_ID)
         sender = 'ikwen <no-reply@ikwen.com>'
         event_originator = ikwen_service
-        add_event(event_originator, CASH_OUT_REQUEST_PAID, member=iao, object_id=cashout_request.id)
+        enqueue_event(event_originator, CASH_OUT_REQUEST_PAID, member=iao, object_id=cashout_request.id)
 
         subject = _("Money transfer confirmation")
         html_content = get_mail_content(subject, '', template_name='cashout/mails/payment_notice.html',
@@ -122,11 +111,12 @@ def notify_cashout_and_reset_counters(request, transaction, *args, **kwargs):
         msg.service = ikwen_service
         msg.bcc = ['rsihon@gmail.com', 'admin@ikwen.com']
         msg.content_subtype = "html"
-        Thread(target=lambda m: m.send(), args=(msg,)).start()
+        enqueue_mail(msg)
 
         set_counters(ikwen_service)
         increment_history_field(ikwen_service, 'cash_out_history', cashout_request.amount)
         increment_history_field(ikwen_service, 'cash_out_count_history')
+    refresh_rollup_wallets(weblet)
 
 
 def submit_cashout_request_for_manual_processing(**kwargs):
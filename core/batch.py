@@ -356,6 +356,75 @@ def create_sent_mail_collection():
         db.ikwen_sent_mail.create_index([('created_on', pymongo.ASCENDING)])
 
 
+def create_index_on_invoices():
+    """
+    Index used by billing crons to find Subscriptions having a Pending Invoice.
+    """
+    client = MongoClient('46.101.107.75', 27017)
+
+    for service in Service.objects.all():
+        if not service.database:
+            continue
+        print "Creating index for %s" % service.database
+        db = client[service.database]
+        db.billing_invoice.create_index([('subscription_id', pymongo.ASCENDING), ('status', pymongo.ASCENDING)])
+
+    db = client['ikwen_umbrella_prod']
+    db.billing_invoice.create_index([('subscription_id', pymongo.ASCENDING), ('status', pymongo.ASCENDING)])
+
+
+def create_index_on_momo_transactions():
+    """
+    Indexes used by the transaction log and cash-out summaries of MoMoTransactions,
+    and by billing/momo_sweeper.py to find stale running transactions.
+    """
+    from ikwen.billing.models import MoMoTransaction
+    collection = get_collection(MoMoTransaction, 'wallets')
+    collection.create_index([('is_running', pymongo.ASCENDING), ('created_on', pymongo.ASCENDING)])
+    collection.create_index([('service_id', pymongo.ASCENDING), ('type', pymongo.ASCENDING),
+                             ('created_on', pymongo.ASCENDING)])
+    collection.create_index([('service_id', pymongo.ASCENDING), ('wallet', pymongo.ASCENDING),
+                             ('status', pymongo.ASCENDING), ('created_on', pymongo.ASCENDING)])
+    collection.create_index([('dara_id', pymongo.ASCENDING), ('wallet', pymongo.ASCENDING),
+                             ('status', pymongo.ASCENDING), ('created_on', pymongo.ASCENDING)])
+
+
+def create_expiry_events():
+    """
+    Schedules ExpiryEvents of all Subscriptions, which billing crons rely on
+    to find Subscriptions to invoice or suspend.
+    """
+    from ikwen.billing.models import InvoicingConfig
+    from ikwen.billing.utils import get_subscription_model, schedule_expiry_events
+    Subscription = get_subscription_model()
+    for invoicing_config in InvoicingConfig.objects.all():
+        db = invoicing_config.service.database
+        if not db:
+            continue
+        print "Scheduling expiry events for %s" % db
+        add_database(db)
+        for subscription in Subscription.objects.using(db).filter(expiry__isnull=False):
+            schedule_expiry_events(subscription, invoicing_config, using=db)
+
+
+def create_member_search_index():
+    """
+    Sets search_tokens of Members that were saved before they existed and indexes them.
+    """
+    client = MongoClient('46.101.107.75', 27017)
+
+    for service in Service.objects.all():
+        db = service.database
+        if not db:
+            continue
+        print "Creating search index for %s" % db
+        add_database(db)
+        for member in Member.objects.using(db).filter(search_tokens__isnull=True):
+            member.save(using=db)
+        dbh = client[db]
+        dbh.ikwen_member.create_index([('search_tokens', pymongo.ASCENDING)])
+
+
 def create_go_links():
     app_list = list(Application.objects.filter(slug__in=['kakocase', 'shavida', 'webnode']))
     for service in Service.objects.filter(app__in=app_list):
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Facets of :meth:`ikwen.core.generic.HybridListView.get_filter`.
+
+Choices of a filter on a model field are the distinct values of that field in the
+list. Rather than loading all objects to collect them in Python, :func:`get_facets`
+computes distinct values and their counts for all fields at once in a single Mongo
+$facet aggregation run on the query of the queryset. For date fields, only the
+latest date is computed, which tells whether the list has future dates.
+
+Facets are cached FACET_CACHE_TIMEOUT seconds per model, tenant and query, so that
+browsing pages of a list does not run the aggregation over and over.
+"""
+import hashlib
+import logging
+
+from bson import json_util
+from bson.objectid import ObjectId
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import DateField, ForeignKey
+from django.utils.translation import ugettext as _
+
+from ikwen.core.utils import get_collection, get_mongo_query
+
+logger = logging.getLogger('ikwen')
+
+FACET_CACHE_TIMEOUT = 120
+MAX_FACET_VALUES = 200
+
+
+def _get_mongo_query(queryset):
+    try:
+        return get_mongo_query(queryset)
+    except:
+        logger.error("Could not build Mongo query of %s" % queryset.model, exc_info=True)
+
+
+def is_date_field(field):
+    # DateTimeField is a subclass of DateField
+    return isinstance(field, DateField)
+
+
+def _get_column(field):
+    return '_id' if field.primary_key else field.column
+
+
+def get_facets(queryset, field_list, timeout=FACET_CACHE_TIMEOUT):
+    """
+    Computes facets of fields of *field_list*, which are model fields of the queryset.
+
+    :return: dict keyed by field name. For date fields, value is the latest date in the queryset,
+    else the list of (value, count) of the MAX_FACET_VALUES first distinct values. Values of
+    ForeignKey are ids. None if facets could not be computed with an aggregation.
+    """
+    if not field_list:
+        return {}
+    match = _get_mongo_query(queryset)
+    if match is None:
+        return None
+    model = queryset.model
+    key_data = json_util.dumps([match, [field.name for field in field_list]], sort_keys=True)
+    cache_key = 'facets:%s:%s:%s:%s' % (queryset.db, model._meta.db_table, getattr(settings, 'IKWEN_SERVICE_ID', ''),
+                                        hashlib.md5(key_data).hexdigest())
+    facets = cache.get(cache_key)
+    if facets is not None:
+        return facets
+    stages = {}
+    for field in field_list:
+        column = '$' + _get_column(field)
+        if is_date_field(field):
+            stages[field.name] = [{'$group': {'_id': None, 'max': {'$max': column}}}]
+        else:
+            stages[field.name] = [{'$group': {'_id': column, 'count': {'$sum': 1}}},
+                                  {'$sort': {'_id': 1}}, {'$limit': MAX_FACET_VALUES}]
+    collection = get_collection(model, queryset.db)
+    try:
+        result = collection.aggregate([{'$match': match}, {'$facet': stages}])
+    except:
+        logger.error("Could not aggregate facets of %s" % model, exc_info=True)
+        return None
+    docs = result['result'] if isinstance(result, dict) else list(result)
+    doc = docs[0] if docs else {}
+    facets = {}
+    for field in field_list:
+        groups = doc.get(field.name, [])
+        if is_date_field(field):
+            facets[field.name] = groups[0]['max'] if groups else None
+        else:
+            facets[field.name] = [(str(group['_id']) if isinstance(group['_id'], ObjectId) else group['_id'],
+                                   group['count']) for group in groups]
+    cache.set(cache_key, facets, timeout)
+    return facets
+
+
+def get_facet_choices(field, facet):
+    """
+    Returns the filter choices of a facet of a non date *field*: Yes/No for booleans,
+    (id, object) for ForeignKey, else (value, value), with None values left out.
+    """
+    values = [value for value, count in facet if value is not None]
+    if not values:
+        return []
+    if set(values) == {True, False}:
+        return [("__true__", _("Yes")), ("__false__", _("No"))]
+    if isinstance(field, ForeignKey):
+        obj_list = field.rel.to._default_manager.filter(pk__in=values)
+        return [(obj.id, obj) for obj in sorted(obj_list, key=lambda obj: values.index(obj.id))]
+    return [(value, value) for value in values]
+
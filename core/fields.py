@@ -3,7 +3,12 @@ from django.core.files.images import ImageFile as DjangoImageFile
 
 __author__ = 'Kom Sihon'
 
+from array import array
+import struct
+
+from django.db import models
 from django.db.models.fields.files import FieldFile as DjangoFieldFile, FileField as DjangoFileField
+from djangotoolbox.fields import ListField
 from PIL import Image
 import os
 
@@ -164,3 +169,174 @@ class MultiImageField(ImageField):
         self.required_width = required_width
         self.required_height = required_height
         super(MultiImageField, self).__init__(*args, **kwargs)
+
+
+class HistoryRingBuffer(object):
+    """
+    Fixed capacity ring buffer of daily values used as storage for *history* fields
+    of Watch Objects. Values are kept in an array of doubles with one slot per day.
+    :attr:`head` points to the slot of the most recent day. Like history lists, the
+    buffer does not know which day that is: it is the day of *counters_reset_on* of
+    the Watch Object, which drives roll(). Incrementing today and rolling over to new
+    days are O(1) per day and never move the other values.
+
+    It reads like the list it replaces: values come oldest first, so that
+    `history[-1]` is today, `history[-30:]` is the last 30 days, etc.
+
+    It is stored as an array of [head, length, slot0, slot1, ...], so that the slot of a
+    day stays at the same position in the database: today's value is incremented with a
+    Mongo $inc on <history_field>.<storage index>, without reading the buffer first.
+    """
+    CAPACITY = 366
+    HEADER = struct.Struct('<HH')  # head, length
+    HEADER_SIZE = 2  # Number of header items preceding the slots in the stored array
+
+    def __init__(self, value_list=None, capacity=CAPACITY):
+        self.capacity = capacity
+        self.data = array('d', [0.0] * capacity)
+        self.head = capacity - 1
+        self.length = 0
+        if value_list:
+            for val in list(value_list)[-capacity:]:
+                self.append(val)
+
+    @classmethod
+    def from_bytes(cls, raw):
+        head, length = cls.HEADER.unpack_from(raw)
+        data = array('d')
+        data.fromstring(raw[cls.HEADER.size:])
+        buf = cls(capacity=len(data))
+        buf.data, buf.head, buf.length = data, head, length
+        return buf
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.head, self.length) + self.data.tostring()
+
+    @classmethod
+    def from_storage(cls, value_list):
+        buf = cls(capacity=len(value_list) - cls.HEADER_SIZE)
+        buf.data = array('d', value_list[cls.HEADER_SIZE:])
+        buf.head, buf.length = int(value_list[0]), int(value_list[1])
+        return buf
+
+    def to_storage(self):
+        return [self.head, self.length] + self.data.tolist()
+
+    def get_storage_index(self, index=-1):
+        """
+        Position in the stored array of the slot of logical *index*
+        """
+        return self.HEADER_SIZE + self._slot(index)
+
+    def _slot(self, index):
+        """
+        Converts a logical index (0 being the oldest day) into a slot of :attr:`data`
+        """
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("history index out of range")
+        return (self.head - self.length + 1 + index) % self.capacity
+
+    def _push(self, value):
+        self.head = (self.head + 1) % self.capacity
+        self.data[self.head] = value
+        self.length = min(self.length + 1, self.capacity)
+
+    def increment(self, value=1):
+        """
+        Increments value of the current day.
+        """
+        if self.length == 0:
+            self.append(value)
+        else:
+            self.data[self.head] += value
+
+    def roll(self, gap=1):
+        """
+        Moves the head *gap* days forward, opening a slot valued 0 for each day.
+        """
+        for i in range(min(gap, self.capacity)):
+            self._push(0)
+
+    def clear(self):
+        self.data = array('d', [0.0] * self.capacity)
+        self.length = 0
+
+    def to_list(self):
+        return [self.data[self._slot(i)] for i in range(self.length)]
+
+    # List API kept for compatibility with code and templates
+    # written when history fields were plain ListField
+
+    def append(self, value):
+        self._push(value)
+
+    def extend(self, value_list):
+        for val in value_list:
+            self.append(val)
+
+    def insert(self, index, value):
+        """
+        Only insertion on the left (older days) is supported. Used by extend_left()
+        """
+        if index != 0:
+            raise ValueError("HistoryRingBuffer only supports insertion at index 0")
+        if self.length < self.capacity:
+            self.length += 1
+            self.data[self._slot(0)] = value
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.to_list()[item]
+        return self.data[self._slot(item)]
+
+    def __setitem__(self, index, value):
+        self.data[self._slot(index)] = value
+
+    def __eq__(self, other):
+        if isinstance(other, HistoryRingBuffer):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+
+class HistoryField(ListField):
+    """
+    Stores a :class:`HistoryRingBuffer` as an array of doubles with fixed positions,
+    see :meth:`HistoryRingBuffer.to_storage`. Legacy values saved as a list of days
+    by a ListField or as a binary string are converted upon load.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def __init__(self, capacity=HistoryRingBuffer.CAPACITY, *args, **kwargs):
+        self.capacity = capacity
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('default', lambda: HistoryRingBuffer(capacity=capacity))
+        super(HistoryField, self).__init__(models.FloatField(), *args, **kwargs)
+
+    def to_python(self, value):
+        if isinstance(value, HistoryRingBuffer):
+            return value
+        if not value:
+            return HistoryRingBuffer(capacity=self.capacity)
+        if isinstance(value, (list, tuple)):
+            if len(value) == self.capacity + HistoryRingBuffer.HEADER_SIZE:
+                return HistoryRingBuffer.from_storage(value)
+            return HistoryRingBuffer(value, capacity=self.capacity)  # Legacy list of at most capacity days
+        return HistoryRingBuffer.from_bytes(str(value))
+
+    def get_db_prep_save(self, value, connection):
+        value = self.to_python(value)
+        return super(HistoryField, self).get_db_prep_save(value.to_storage(), connection)
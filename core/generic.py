@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import os
 import logging
@@ -15,6 +16,7 @@ from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.core.urlresolvers import reverse
 from django.db import models
 from django.db.models import get_model
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.fields.files import ImageFieldFile as DjangoImageFieldFile, FieldFile
 from django.forms.models import modelform_factory
 from django.http.response import HttpResponseRedirect, HttpResponse
@@ -31,7 +33,11 @@ from import_export.formats.base_formats import XLS, CSV
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.accesscontrol.models import Member
 from ikwen.core.fields import MultiImageFieldFile, ImageFieldFile
+from ikwen.core.facets import get_facets, get_facet_choices, is_date_field
 from ikwen.core.models import Service, AbstractConfig
+from ikwen.core.pagination import EXACT_COUNT, CACHED_COUNT, COUNT_CACHE_TIMEOUT, InvalidCursor, KeysetPage, \
+    KeysetPaginator, count_objects, get_keyset_ordering, get_ordering_from_keyset, get_keyset_slice
+from ikwen.core.search import get_search_backend
 from ikwen.core.utils import get_service_instance, DefaultUploadBackend, generate_icons, get_model_admin_instance, \
     get_preview_from_extension
 from ikwen.revival.models import ProfileTag, Revival
@@ -45,16 +51,26 @@ class HybridListView(ListView):
     render HTML or JSON results for Ajax calls.
 
     :attr:search_field: Name of the default field it uses to filter Ajax requests. Defaults to *name*
+    :attr:search_backend: Search backend, dotted path or instance, used to filter on search_field.
+    Defaults to :class:`ikwen.core.search.ContainsSearchBackend`. See :mod:`ikwen.core.search`
     :attr:ordering: Tuple of model fields used to order object list when page is rendered in HTML
     :attr:ajax_ordering: Tuple of model fields used to order results of Ajax requests. It is similar to ordering of
     django admin
+    :attr:keyset_pagination: If True, pages are fetched after the opaque *cursor* of the previous page rather than
+    skipping objects of previous pages, so deep pages cost as much as the first one. See :mod:`ikwen.core.pagination`
+    :attr:count_mode: How objects are counted: EXACT_COUNT (default), CACHED_COUNT for an exact count cached
+    count_cache_timeout seconds or ESTIMATED_COUNT for a count that stops at ESTIMATED_COUNT_LIMIT
     """
     page_size = int(getattr(settings, 'HYBRID_LIST_PAGE_SIZE', '50'))
     max_visible_page_count = 5
     search_field = 'name'
+    search_backend = None
     ordering = ('-id', )
     list_filter = ()
     ajax_ordering = ('-id', )
+    keyset_pagination = False
+    count_mode = EXACT_COUNT
+    count_cache_timeout = COUNT_CACHE_TIMEOUT
     template_name = None
     html_results_template_name = 'core/snippets/object_list_results.html'
     embed_doc_template_name = None
@@ -89,7 +105,7 @@ class HybridListView(ListView):
         context['queryset'] = queryset
         context['page_size'] = self.get_page_size(self.request)
         context['max_visible_page_count'] = self.get_max_visible_page_count(queryset)
-        context['total_objects'] = self.get_queryset().count()
+        context['total_objects'] = self.count_objects(self.get_queryset(), 'total')
         context['filter'] = self.get_filter()
         model = queryset.model
         meta = model._meta
@@ -119,8 +135,18 @@ class HybridListView(ListView):
             queryset = queryset.order_by(*self.ajax_ordering)
             start = int(self.request.GET.get('start', 0))
             length = int(self.request.GET.get('length', self.page_size))
-            limit = start + length
-            queryset = queryset[start:limit]
+            next_cursor = None
+            if self.keyset_pagination:
+                keyset = get_keyset_ordering(queryset.model, self.ajax_ordering)
+                queryset = queryset.order_by(*get_ordering_from_keyset(keyset))
+                try:
+                    queryset, next_cursor = get_keyset_slice(queryset, keyset, length,
+                                                             self.request.GET.get('cursor'), start)
+                except InvalidCursor:
+                    queryset = []
+            else:
+                limit = start + length
+                queryset = queryset[start:limit]
             response = []
             for item in queryset:
                 try:
@@ -130,32 +156,40 @@ class HybridListView(ListView):
             callback = self.request.GET.get('callback')
             if callback:
                 response = {'object_list': response}
+                if self.keyset_pagination:
+                    response['next_cursor'] = next_cursor
                 jsonp = callback + '(' + json.dumps(response) + ')'
-                return HttpResponse(jsonp, content_type='application/json', **response_kwargs)
-            return HttpResponse(json.dumps(response), 'content-type: text/json', **response_kwargs)
+                response = HttpResponse(jsonp, content_type='application/json', **response_kwargs)
+            else:
+                response = HttpResponse(json.dumps(response), 'content-type: text/json', **response_kwargs)
+            if next_cursor:
+                response['X-Next-Cursor'] = next_cursor
+            return response
         else:
             queryset = queryset.order_by(*self.ordering)
             if self.request.GET.get('action') == 'export':
                 return self.export(queryset)
-            paginator = Paginator(queryset, self.page_size)
-            page = self.request.GET.get('page')
-            try:
-                objects_page = paginator.page(page)
-                page = int(page)
-            except PageNotAnInteger:
-                page = 1
-                objects_page = paginator.page(1)
-            except EmptyPage:
-                page = paginator.num_pages
-                objects_page = paginator.page(paginator.num_pages)
+            if self.keyset_pagination:
+                objects_page = self.get_keyset_page(queryset)
+            else:
+                paginator = Paginator(queryset, self.page_size)
+                page = self.request.GET.get('page')
+                try:
+                    objects_page = paginator.page(page)
+                except PageNotAnInteger:
+                    objects_page = paginator.page(1)
+                except EmptyPage:
+                    objects_page = paginator.page(paginator.num_pages)
+            page = objects_page.number
+            num_pages = objects_page.paginator.num_pages
             context['q'] = self.request.GET.get('q')
             context['objects_page'] = objects_page
             max_visible_page_count = context['max_visible_page_count']
             min_page = page - (page % max_visible_page_count)
             if min_page < max_visible_page_count:
                 min_page += 1
-            max_page = min(min_page + max_visible_page_count, paginator.num_pages)
-            if page == paginator.num_pages:
+            max_page = min(min_page + max_visible_page_count, num_pages)
+            if page == num_pages:
                 min_page = page - max_visible_page_count
             context['page_range'] = range(min_page, max_page + 1)
             context['max_page'] = max_page
@@ -165,6 +199,48 @@ class HybridListView(ListView):
             else:
                 return super(HybridListView, self).render_to_response(context, **response_kwargs)
 
+    def get_keyset_page(self, queryset):
+        """
+        Returns the :class:`ikwen.core.pagination.KeysetPage` of *page* number. Objects are taken after
+        the *cursor* issued with the previous page if any. Pages reached without cursor, like when jumping
+        to a page number, are still fetched by skipping objects of previous pages.
+        """
+        keyset = get_keyset_ordering(queryset.model, self.ordering)
+        queryset = queryset.order_by(*get_ordering_from_keyset(keyset))
+        count = self.count_objects(queryset, 'page')
+        paginator = KeysetPaginator(count, self.page_size)
+        try:
+            page = int(self.request.GET.get('page', 1))
+        except ValueError:
+            page = 1
+        cursor = self.request.GET.get('cursor')
+        if not cursor and not 1 <= page <= paginator.num_pages:
+            page = paginator.num_pages  # Same as Paginator on EmptyPage
+        page = max(page, 1)
+        try:
+            object_list, next_cursor = get_keyset_slice(queryset, keyset, self.page_size, cursor,
+                                                        (page - 1) * self.page_size)
+        except InvalidCursor:
+            page = 1
+            object_list, next_cursor = get_keyset_slice(queryset, keyset, self.page_size)
+        return KeysetPage(object_list, page, paginator, next_cursor)
+
+    def count_objects(self, queryset, name):
+        """
+        Counts objects of *queryset* according to count_mode. Counts cached are keyed
+        on *name*, the view and the filters of the request.
+
+        :param name: name of the count in the view. Eg: 'total' or 'page'
+        """
+        cache_key = None
+        if self.count_mode == CACHED_COUNT:
+            params = sorted([(key, value) for key, value in self.request.GET.items()
+                             if key not in ('page', 'cursor', 'start', 'length', 'format', 'callback', '_')])
+            cache_key = 'count:%s.%s:%s:%s:%s' % (self.__module__, type(self).__name__, name,
+                                                  getattr(settings, 'IKWEN_SERVICE_ID', ''),
+                                                  hashlib.md5(json.dumps(params)).hexdigest())
+        return count_objects(queryset, self.count_mode, cache_key, self.count_cache_timeout)
+
     def get(self, request, *args, **kwargs):
         action = request.GET.get('action')
         model_name = request.GET.get('model_name')
@@ -252,20 +328,13 @@ class HybridListView(ListView):
         the value of GET parameter q and the search_field.
         Only the first max_chars of the search string will be used
         to search. Setting it to none causes to search with the
-        input string exactly as such.
+        input string exactly as such. Filtering itself is done by
+        the search_backend.
         """
-        # TODO: Implement MongoDB native indexed text search instead of Django ORM one for better performance
         search_term = self.request.GET.get('q')
         if search_term and len(search_term) >= 2:
-            search_term = search_term.lower()
-            word = slugify(search_term).replace('-', ' ')
-            try:
-                word = word[:int(max_chars)]
-            except:
-                pass
-            if word:
-                kwargs = {self.search_field + '__icontains': word}
-                queryset = queryset.filter(**kwargs)
+            backend = get_search_backend(self.search_backend)
+            queryset = backend.search(queryset, search_term, self.search_field, max_chars)
         return queryset
 
     def get_list_filter(self):
@@ -273,9 +342,12 @@ class HybridListView(ListView):
 
     def get_filter(self):
         """
-        Generates the filter options based on self.get_list_filter()
+        Generates the filter options based on self.get_list_filter(). Choices of filters on
+        model fields are computed from facets of the queryset. See :mod:`ikwen.core.facets`
         """
         options = []
+        facet_fields = self.get_facet_fields()
+        facets = get_facets(self.get_queryset(), facet_fields.values()) if facet_fields else {}
         for item in self.get_list_filter():
             if callable(item) or (type(item) is str and item.find('.') > 0):
                 if type(item) is str:
@@ -299,45 +371,16 @@ class HybridListView(ListView):
                     item = item[0]
                 else:
                     item_title = item
-                elt = None
-                choices = []
-                is_date_filter = False
-                try:
-                    sample = self.get_queryset().order_by('-id')[0]  # Take last created object as they tend to have most updated fields
-                    elt = sample.__getattribute__(item)
-                except IndexError:
-                    pass
-                if isinstance(elt, datetime) or isinstance(elt, date):
-                    now = datetime.now()
-                    criterion = {item + '__gt': now}
-                    has_future_dates = self.get_queryset().filter(**criterion).count() > 0
-                    choices = [
-                        ('__period__today', _("Today")),
-                        ('__period__yesterday', _("Yesterday")),
-                        ('__period__last_7_days', _("Last 7 days")),
-                        ('__period__since_the_1st', _("Since the 1st")),
-                    ]
-                    if has_future_dates:
-                        choices.extend([
-                            ('__period__next_7_days', _("Next 7 days")),
-                            ('__period__next_30_days', _("Next 30 days")),
-                        ])
-                    is_date_filter = True
+                field = facet_fields.get(item)
+                if field is not None and facets is not None:
+                    is_date_filter = is_date_field(field)
+                    if is_date_filter:
+                        latest = facets[item]
+                        choices = self.get_date_filter_choices(latest is not None and latest > datetime.now())
+                    else:
+                        choices = get_facet_choices(field, facets[item])
                 else:
-                    item_values = set([obj.__getattribute__(item) for obj in self.get_queryset()])
-                    item_values = list(sorted(item_values))
-                    item_values = [val for val in item_values if val is not None]
-                    if set(item_values) == {True, False}:
-                        choices = [
-                            ("__true__", _("Yes")),
-                            ("__false__", _("No"))
-                        ]
-                    elif len(item_values) > 0:
-                        obj = item_values[0]
-                        if isinstance(obj, models.Model):
-                            choices = [(obj.id, obj) for obj in item_values]
-                        else:
-                            choices = [(val, val) for val in item_values]
+                    choices, is_date_filter = self.get_filter_choices_from_objects(item)
                 options.append({
                     'title': item_title.capitalize(),
                     'parameter_name': item,
@@ -346,6 +389,75 @@ class HybridListView(ListView):
                 })
         return options
 
+    def get_facet_fields(self):
+        """
+        Returns model fields of items of self.get_list_filter() keyed by name.
+        """
+        meta = self.get_queryset().model._meta
+        facet_fields = {}
+        for item in self.get_list_filter():
+            if callable(item) or (type(item) is str and item.find('.') > 0):
+                continue
+            if type(item) is tuple:
+                item = item[0]
+            try:
+                facet_fields[item] = meta.get_field(item)
+            except FieldDoesNotExist:
+                pass
+        return facet_fields
+
+    def get_date_filter_choices(self, has_future_dates=False):
+        choices = [
+            ('__period__today', _("Today")),
+            ('__period__yesterday', _("Yesterday")),
+            ('__period__last_7_days', _("Last 7 days")),
+            ('__period__since_the_1st', _("Since the 1st")),
+        ]
+        if has_future_dates:
+            choices.extend([
+                ('__period__next_7_days', _("Next 7 days")),
+                ('__period__next_30_days', _("Next 30 days")),
+            ])
+        return choices
+
+    def get_filter_choices_from_objects(self, item):
+        """
+        Collects choices of filter on *item* from objects of the queryset. Only used when *item*
+        is not a model field, as it loads all objects, or when facets could not be computed.
+
+        :return: choices and whether it is a date filter
+        """
+        elt = None
+        choices = []
+        is_date_filter = False
+        try:
+            sample = self.get_queryset().order_by('-id')[0]  # Take last created object as they tend to have most updated fields
+            elt = sample.__getattribute__(item)
+        except IndexError:
+            pass
+        if isinstance(elt, datetime) or isinstance(elt, date):
+            now = datetime.now()
+            criterion = {item + '__gt': now}
+            has_future_dates = self.get_queryset().filter(**criterion).count() > 0
+            choices = self.get_date_filter_choices(has_future_dates)
+            is_date_filter = True
+        else:
+            item_values = set([obj.__getattribute__(item) for obj in self.get_queryset()])
+            item_values = list(sorted(item_values))
+            item_values = [val for val in item_values if val is not None]
+            if set(item_values) == {True, False}:
+                choices = [
+                    ("__true__", _("Yes")),
+                    ("__false__", _("No"))
+                ]
+            elif len(item_values) > 0:
+                obj = item_values[0]
+                if isinstance(obj, models.Model):
+                    choices = [(obj.id, obj) for obj in item_values]
+                else:
+                    choices = [(val, val) for val in item_values]
+        return choices, is_date_filter
+
     def get_export_filename(self, file_format):
         date_str = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
         if self.model:
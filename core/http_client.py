@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP client for calls to SMS APIs, payment gateways and partner websites.
+
+Calls made through :func:`get`, :func:`post` and :func:`request` go through a
+process-wide requests.Session, so connections are pooled per host and kept alive
+instead of paying a TCP and TLS handshake on every call. Default timeouts apply to
+all calls. Calls are only retried when the connection could not be established, as
+the request was then never sent: many APIs, like MoMo cash-out or SMS submission,
+charge or send on a GET, so a slow or failed reply must not trigger the request again.
+True reads, like the status of a transaction, can be made with idempotent=True to
+also be retried on read errors and on 502, 503 and 504 responses. The last response
+is then returned rather than an exception. The latency of each call is recorded in a
+per-endpoint histogram, available with :func:`get_latency_histograms`.
+
+It is configured with the IKWEN_HTTP_CLIENT setting. Eg:
+
+    IKWEN_HTTP_CLIENT = {
+        'pool_connections': 10,  # Number of hosts kept in pool
+        'pool_maxsize': 20,  # Max number of connections kept alive per host
+        'timeout': (10, 300),  # (connect, read) timeouts in seconds
+        'max_retries': 2,
+        'backoff_factor': 0.5,  # Waits 0.5s, 1s, 2s ... between retries
+    }
+
+Arguments and return values are exactly those of the requests module, as are exceptions.
+"""
+import logging
+import re
+import threading
+import time
+from urlparse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    from urllib3.util.retry import Retry
+
+logger = logging.getLogger('ikwen')
+
+DEFAULT_CONFIG = {
+    'pool_connections': 10,
+    'pool_maxsize': 20,
+    'timeout': (10, 300),
+    'max_retries': 2,
+    'backoff_factor': 0.5,
+}
+RETRY_STATUS_LIST = (502, 503, 504)
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)  # Upper bounds in milliseconds
+SLOW_CALL_THRESHOLD = 10000  # Calls slower than this in milliseconds are logged
+
+_sessions = {}
+_session_lock = threading.Lock()
+_histograms = {}
+_histograms_lock = threading.Lock()
+_ID_SEGMENT = re.compile(r'^([0-9a-fA-F-]{8,}|\d+)$')
+
+
+def get_config():
+    config = dict(DEFAULT_CONFIG)
+    config.update(getattr(settings, 'IKWEN_HTTP_CLIENT', {}))
+    return config
+
+
+def get_retry(idempotent=False):
+    """
+    Returns the retry policy of calls: retries of connection errors only, or also of
+    read errors and RETRY_STATUS_LIST responses if *idempotent*.
+    """
+    config = get_config()
+    if idempotent:
+        return Retry(total=config['max_retries'], backoff_factor=config['backoff_factor'],
+                     status_forcelist=RETRY_STATUS_LIST, raise_on_status=False)
+    return Retry(total=config['max_retries'], connect=config['max_retries'], read=0, status=0,
+                 backoff_factor=config['backoff_factor'], raise_on_status=False)
+
+
+def get_session(idempotent=False):
+    """
+    Returns the Session shared by all threads of this process, creating it on first call.
+    Calls of the *idempotent* Session are also retried on read errors and 5xx responses.
+    """
+    session = _sessions.get(idempotent)
+    if session is None:
+        with _session_lock:
+            session = _sessions.get(idempotent)
+            if session is None:
+                config = get_config()
+                adapter = HTTPAdapter(pool_connections=config['pool_connections'],
+                                      pool_maxsize=config['pool_maxsize'], max_retries=get_retry(idempotent))
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _sessions[idempotent] = session
+    return session
+
+
+def reset_session():
+    """
+    Closes pooled connections. The next call creates new Sessions with the current configuration.
+    """
+    with _session_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_endpoint(method, url):
+    """
+    Name under which latency of a call is recorded: the method, host and path of *url*
+    without query string. Path segments looking like ids are replaced by ':id' so
+    that calls to the same API share a histogram. Eg:
+    https://ericssonbasicapi2.azure-api.net/collection/v1_0/requesttopay/5c3f6a1e-88b1-4a63
+    gives POST ericssonbasicapi2.azure-api.net/collection/v1_0/requesttopay/:id
+    """
+    parsed = urlparse(url)
+    segments = [':id' if _ID_SEGMENT.match(segment) else segment for segment in parsed.path.split('/')]
+    return '%s %s%s' % (method.upper(), parsed.netloc, '/'.join(segments))
+
+
+def record_latency(endpoint, duration, failed=False):
+    """
+    Adds a call of *duration* milliseconds to the histogram of *endpoint*.
+    """
+    with _histograms_lock:
+        histogram = _histograms.get(endpoint)
+        if histogram is None:
+            histogram = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+                         'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+            _histograms[endpoint] = histogram
+        histogram['count'] += 1
+        histogram['total'] += duration
+        histogram['max'] = max(histogram['max'], duration)
+        if failed:
+            histogram['errors'] += 1
+        i = 0
+        while i < len(LATENCY_BUCKETS) and duration > LATENCY_BUCKETS[i]:
+            i += 1
+        histogram['buckets'][i] += 1
+
+
+def get_latency_histograms(reset=False):
+    """
+    Returns a copy of latency histograms recorded in this process, keyed by endpoint.
+    Each histogram is a dict with keys count, errors, total and max in milliseconds, and
+    buckets: the number of calls at most as long as the matching LATENCY_BUCKETS bound.
+    The last bucket counts calls longer than all bounds.
+    """
+    with _histograms_lock:
+        histograms = dict((endpoint, dict(h, buckets=list(h['buckets']))) for endpoint, h in _histograms.items())
+        if reset:
+            _histograms.clear()
+    return histograms
+
+
+def request(method, url, **kwargs):
+    """
+    Same as requests.request() but through the shared Session. A default timeout is
+    set if none is given. *endpoint* can be passed to override the name under which
+    the latency is recorded. Pass idempotent=True only for calls that change nothing
+    on the server, so that they are also retried on read errors and 5xx responses.
+    """
+    endpoint = kwargs.pop('endpoint', None) or get_endpoint(method, url)
+    idempotent = kwargs.pop('idempotent', False)
+    kwargs.setdefault('timeout', get_config()['timeout'])
+    start = time.time()
+    failed = True
+    try:
+        response = get_session(idempotent).request(method, url, **kwargs)
+        failed = response.status_code >= 500
+        return response
+    finally:
+        duration = (time.time() - start) * 1000
+        record_latency(endpoint, duration, failed)
+        if duration > SLOW_CALL_THRESHOLD:
+            logger.warning("Slow HTTP call: %s took %dms" % (endpoint, duration))
+
+
+def get(url, params=None, **kwargs):
+    return request('get', url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    return request('post', url, data=data, json=json, **kwargs)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Process-local caching that sits in front of the shared Django cache.
+
+Objects read on nearly every request (the current Service, its Config) are kept in
+a per-process LRU so that most lookups do not even reach the shared cache. Like in
+the shared cache, values are stored pickled, so that requests never share a mutable
+instance. Entries of a Service are keyed by a version of that Service stored in the
+shared cache under service_cache_version:<service_id>. It is bumped by
+:func:`bump_service_cache_version` whenever the Service or its Config changes, so that
+all processes drop their copies of that Service only. Service.save() and Config.save()
+do it themselves; code changing them with a queryset update() must call it. A process checks the shared
+version at most every VERSION_CHECK_INTERVAL seconds.
+
+Values memoized with :func:`get_request_cache` live for the duration of the current
+request only. It requires :class:`ikwen.core.middleware.RequestCacheMiddleware`.
+Outside of a request (crons, shell), nothing is memoized.
+"""
+import cPickle as pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+SERVICE_CACHE_VERSION_KEY = 'service_cache_version:%s'
+VERSION_CHECK_INTERVAL = 5  # Seconds between two checks of the shared version
+LOCAL_CACHE_TIMEOUT = 300
+LOCAL_CACHE_MAX_SIZE = 256
+
+
+class LocalCache(object):
+    """
+    Thread safe LRU cache with per entry timeout. Once *max_size* entries are
+    reached, the least recently used is evicted.
+    """
+    def __init__(self, max_size=LOCAL_CACHE_MAX_SIZE, timeout=LOCAL_CACHE_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                return default
+            if expires < time.time():
+                return default
+            self._entries[key] = value, expires  # Re-insert as most recently used
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value, time.time() + timeout
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_cache = LocalCache()
+_request_local = threading.local()
+
+
+def get_service_cache_version(service_id):
+    """
+    Current version of cached copies of the Service *service_id* and its Config.
+    """
+    key = SERVICE_CACHE_VERSION_KEY % service_id
+    version = local_cache.get(key)
+    if version is None:
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, int(time.time()), 30 * 86400)
+            version = cache.get(key, int(time.time()))
+        local_cache.set(key, version, VERSION_CHECK_INTERVAL)
+    return version
+
+
+def bump_service_cache_version(service_id):
+    """
+    Invalidates cached copies of the Service *service_id* and its Config in all processes.
+    """
+    key = SERVICE_CACHE_VERSION_KEY % service_id
+    try:
+        version = cache.incr(key)
+    except ValueError:  # Key missing from the shared cache
+        version = int(time.time())
+        cache.set(key, version, 30 * 86400)
+    local_cache.set(key, version, VERSION_CHECK_INTERVAL)
+    request_cache = get_request_cache()
+    if request_cache is not None:
+        request_cache.clear()
+    return version
+
+
+def get_two_tier(key, service_id, timeout=3600):
+    """
+    Gets *key* from the local cache, then from the shared cache. Returns None if not
+    found in either. *key* is automatically versioned with that of Service *service_id*.
+    """
+    key = '%s:%s:v%s' % (key, service_id, get_service_cache_version(service_id))
+    pickled = local_cache.get(key)
+    if pickled is not None:
+        return pickle.loads(pickled)
+    value = cache.get(key)
+    if value is not None:
+        local_cache.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), min(timeout, LOCAL_CACHE_TIMEOUT))
+    return value
+
+
+def set_two_tier(key, value, service_id, timeout=3600):
+    """
+    Sets *key* in both the local and the shared cache. *key* is automatically
+    versioned with that of Service *service_id*.
+    """
+    key = '%s:%s:v%s' % (key, service_id, get_service_cache_version(service_id))
+    cache.set(key, value, timeout)
+    local_cache.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), min(timeout, LOCAL_CACHE_TIMEOUT))
+
+
+def start_request_cache():
+    _request_local.cache = {}
+
+
+def end_request_cache():
+    _request_local.cache = None
+
+
+def get_request_cache():
+    """
+    Returns the dict used to memoize values during the current request,
+    or None if not within a request handled by RequestCacheMiddleware.
+    """
+    return getattr(_request_local, 'cache', None)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of mails sent in bulk by crons: invoices, reminders, revivals.
+
+get_mail_content() loads the template, builds a Context and renders the whole
+layout for every single recipient, although only a few fields actually change
+from one recipient to the other. A :class:`MailCampaign` rather renders the layout
+once per language, with markers in place of per-recipient fields, and then only
+substitutes those fields for each recipient. Eg:
+
+    campaign = MailCampaign('billing/mails/notice.html', service=service,
+                            extra_context={'cta': ugettext_lazy("Pay now")},
+                            fields=('subject', 'message', 'member_name', 'invoice_url'))
+    for invoice in invoice_list:
+        html_content = campaign.render(subject=subject, message=mark_safe(message),
+                                       member_name=member.first_name, invoice_url=invoice_url)
+
+Fields are output as is in the layout, so a field must not be used in a template tag
+or transformed by a filter other than |safe. Values are HTML escaped unless marked safe,
+just like Django does in templates.
+"""
+import threading
+
+from django.conf import settings
+from django.template import Context
+from django.template.loader import get_template
+from django.utils.html import conditional_escape
+from django.utils.translation import get_language
+
+from ikwen.core.utils import get_mail_context
+
+FIELD_MARKER = u'\x00'
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_cached_template(template_name):
+    """
+    Same as django.template.loader.get_template(), but the compiled Template is
+    kept for the lifetime of the process. Templates are not cached in DEBUG mode.
+    """
+    if settings.DEBUG:
+        return get_template(template_name)
+    template = _templates.get(template_name)
+    if template is None:
+        template = get_template(template_name)
+        with _templates_lock:
+            _templates[template_name] = template
+    return template
+
+
+def render_cached(template_name, context):
+    """
+    Renders *template_name* with the dict *context* using the compiled template cache.
+    """
+    return get_cached_template(template_name).render(Context(context))
+
+
+class MailCampaign(object):
+    """
+    Renders the same mail layout for many recipients.
+
+    :param template_name: template of the mail
+    :param subject: subject if the same for all recipients, else list 'subject' in *fields*
+    :param message: message if the same for all recipients, else list 'message' in *fields*
+    :param service: Service sending the mail. Defaults to the current one
+    :param extra_context: context variables that do not change from one recipient to the other
+    :param fields: names of context variables that change from one recipient to the other
+    """
+    def __init__(self, template_name, subject=None, message=None, service=None, extra_context=None, fields=()):
+        self.template_name = template_name
+        self.fields = tuple(fields)
+        self.context = get_mail_context(subject, message, extra_context, service)
+        self._skeletons = {}
+
+    def get_skeleton(self):
+        """
+        Returns the layout rendered in the current language as a list of strings.
+        Items at odd indexes are names of fields to substitute.
+        """
+        language = get_language()
+        skeleton = self._skeletons.get(language)
+        if skeleton is None:
+            context = dict(self.context)
+            for name in self.fields:
+                context[name] = FIELD_MARKER + name + FIELD_MARKER
+            html = render_cached(self.template_name, context)
+            skeleton = html.split(FIELD_MARKER)
+            self._skeletons[language] = skeleton
+        return skeleton
+
+    def render(self, **values):
+        """
+        Returns the mail content for a recipient with the given values of fields.
+        """
+        output = []
+        for i, token in enumerate(self.get_skeleton()):
+            if i % 2 == 0:
+                output.append(token)
+            else:
+                value = values.get(token)
+                output.append(conditional_escape(value) if value is not None else u'')
+        return u''.join(output)
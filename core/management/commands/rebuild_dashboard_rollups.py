@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.core.models import Service
+from ikwen.core.rollups import rebuild_rollup
+
+logger = logging.getLogger('ikwen')
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds DashboardRollup of services from their history fields and wallets.
+    Run it once after deployment to seed rollups, then whenever they are suspected to drift.
+
+    Eg: ./manage.py rebuild_dashboard_rollups
+        ./manage.py rebuild_dashboard_rollups 56eb6d04b37b3379b531e011 --database=umbrella
+    """
+    args = '[service_id service_id ...]'
+    help = "Rebuilds dashboard rollups of the given services, or of all active services if none is given."
+    option_list = BaseCommand.option_list + (
+        make_option('--database', dest='database', default=None,
+                    help="Database where to write rollups. Defaults to the own database of each service."),
+    )
+
+    def handle(self, *args, **options):
+        queryset = Service.objects.using(UMBRELLA)
+        if args:
+            queryset = queryset.filter(pk__in=args)
+        else:
+            queryset = queryset.filter(status=Service.ACTIVE)
+        count = 0
+        for service in queryset:
+            try:
+                rebuild_rollup(service, options.get('database'))
+                count += 1
+            except:
+                logger.error("Could not rebuild dashboard rollup of %s" % service.project_name, exc_info=True)
+        self.stdout.write("%d dashboard rollup(s) rebuilt." % count)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Reservation of the mail and SMS credit of a Service for bulk sending.
+
+Crons used to decrement echo.models.Balance and save it for every single mail or SMS,
+which costs a write on the wallets database each time and lets two crons sending for
+the same Service overwrite each other's decrements. A :class:`CreditReservation`
+rather takes credits off the Balance by blocks, each with a single atomic $inc that
+never lets the balance go negative. Credits are then consumed locally as messages go
+out and those left are given back to the Balance with release(). Eg:
+
+    mail_credit = CreditReservation(service, MAIL_CREDIT)
+    mail_credit.reserve(target_count)
+    try:
+        for target in target_list:
+            if not mail_credit.consume():
+                notify_for_empty_messaging_credit(service, mail_credit.balance)
+                break
+            if not msg.send():
+                mail_credit.refund()
+    finally:
+        mail_credit.release()
+"""
+import logging
+import threading
+
+from bson import ObjectId
+
+from ikwen.conf.settings import WALLETS_DB_ALIAS
+from ikwen.core.utils import get_collection
+
+logger = logging.getLogger('ikwen')
+
+MAIL_CREDIT = 'mail_count'
+SMS_CREDIT = 'sms_count'
+DEFAULT_CHUNK = 100  # Credits reserved at once when a consume() exhausts the reservation
+MAX_RESERVE_ATTEMPTS = 5
+
+
+class CreditReservation(object):
+    """
+    Credits of type *field* (MAIL_CREDIT or SMS_CREDIT) reserved on the Balance of *service*.
+    A reservation can be shared between threads, Eg: consumed in the loop submitting
+    SMS to an SMSDispatcher and refunded in the dispatcher callback.
+
+    :param chunk: Number of credits reserved at once when consume() needs more than available
+    :param balance: Balance of *service* if already loaded
+    """
+    def __init__(self, service, field=MAIL_CREDIT, chunk=DEFAULT_CHUNK, balance=None):
+        from echo.models import Balance
+        self.service = service
+        self.field = field
+        self.chunk = chunk
+        if balance is None:
+            balance, update = Balance.objects.using(WALLETS_DB_ALIAS).get_or_create(service_id=service.id)
+        self.balance = balance
+        self.collection = get_collection(Balance, WALLETS_DB_ALIAS)
+        self.reserved = 0
+        self.consumed = 0
+        self._lock = threading.RLock()
+
+    @property
+    def available(self):
+        return self.reserved - self.consumed
+
+    @property
+    def remaining(self):
+        """
+        Credits left to the Service: those on the Balance plus those reserved but not consumed.
+        """
+        return (getattr(self.balance, self.field) or 0) + self.available
+
+    def reserve(self, quantity):
+        """
+        Atomically takes up to *quantity* credits off the Balance. Less are taken
+        if the Balance does not have as many.
+
+        :return: Number of credits actually reserved
+        """
+        with self._lock:
+            if quantity <= 0:
+                return 0
+            spec = {'_id': ObjectId(self.balance.id)}
+            for i in range(MAX_RESERVE_ATTEMPTS):
+                doc = self.collection.find_one(spec, {self.field: 1})
+                count = min(quantity, (doc or {}).get(self.field) or 0)
+                if count <= 0:
+                    setattr(self.balance, self.field, 0)
+                    break
+                query = {'_id': spec['_id'], self.field: {'$gte': count}}  # Fails if another process took credits meanwhile
+                doc = self.collection.find_and_modify(query, {'$inc': {self.field: -count}}, new=True,
+                                                      fields={self.field: 1})
+                if doc:
+                    self.reserved += count
+                    setattr(self.balance, self.field, doc[self.field])
+                    return count
+            return 0
+
+    def ensure(self, quantity=1):
+        """
+        Makes sure that *quantity* credits are available, reserving more if needed.
+
+        :return: False if credits are exhausted
+        """
+        with self._lock:
+            if self.available < quantity:
+                self.reserve(max(quantity - self.available, self.chunk))
+            return self.available >= quantity
+
+    def consume(self, quantity=1):
+        """
+        Consumes *quantity* reserved credits, reserving more if needed.
+
+        :return: False if credits are exhausted
+        """
+        with self._lock:
+            if not self.ensure(quantity):
+                return False
+            self.consumed += quantity
+            return True
+
+    def refund(self, quantity=1):
+        """
+        Gives back consumed credits to the reservation. Eg: when a message could not be sent.
+        """
+        with self._lock:
+            self.consumed -= min(quantity, self.consumed)
+
+    def release(self):
+        """
+        Gives credits reserved but not consumed back to the Balance.
+        """
+        with self._lock:
+            remainder = self.available
+            if remainder <= 0:
+                return
+            try:
+                doc = self.collection.find_and_modify({'_id': ObjectId(self.balance.id)},
+                                                      {'$inc': {self.field: remainder}}, new=True, fields={self.field: 1})
+                self.reserved = self.consumed
+                setattr(self.balance, self.field, doc[self.field])
+            except:
+                logger.error("Could not release %d %s to Balance of %s" % (remainder, self.field, self.service),
+                             exc_info=True)
@@ -10,10 +10,28 @@ from django.http.response import HttpResponseRedirect
 from ikwen.core.urls import SERVICE_DETAIL, SIGN_IN, DO_SIGN_IN, SERVICE_EXPIRED, LOAD_EVENT, LOGOUT
 
 from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.core.local_cache import start_request_cache, end_request_cache
 from ikwen.core.models import Service
 from ikwen.core.utils import get_service_instance
 
 
+class RequestCacheMiddleware(object):
+    """
+    Enables memoization of values like the current Service and its Config for the
+    duration of a request. See :mod:`ikwen.core.local_cache`. It should come first
+    in MIDDLEWARE_CLASSES so that other middlewares benefit from it.
+    """
+    def process_request(self, request):
+        start_request_cache()
+
+    def process_response(self, request, response):
+        end_request_cache()
+        return response
+
+    def process_exception(self, request, exception):
+        end_request_cache()
+
+
 class ServiceStatusCheckMiddleware(object):
     """
     This middleware checks that the Service implemented by this platform is Active.
@@ -18,10 +18,11 @@ from django.utils.translation import gettext_lazy as _
 from django.template.loader import get_template
 from django.template import Context
 from django_mongodb_engine.contrib import MongoDBManager
-from djangotoolbox.fields import ListField
+from djangotoolbox.fields import ListField, DictField
 
 from ikwen.conf.settings import STATIC_ROOT, STATIC_URL, CLUSTER_MEDIA_ROOT, CLUSTER_MEDIA_URL
-from ikwen.core.fields import MultiImageField
+from ikwen.core.fields import MultiImageField, HistoryField
+from ikwen.core.local_cache import get_request_cache, bump_service_cache_version
 from ikwen.accesscontrol.templatetags.auth_tokens import ikwenize
 from ikwen.core.utils import add_database_to_settings, to_dict, get_service_instance, get_config_model
 
@@ -59,6 +60,11 @@ class AbstractWatchModel(Model):
     """
     A Watch model is a model with history fields used to keep progression
     of some data on a daily basis, so to ease the report visualizations.
+
+    History fields of Watch models are declared as :class:`ikwen.core.fields.HistoryField`.
+    Each is stored as a ring buffer of one slot per day at a fixed position, so that today's
+    value is incremented in place with a Mongo $inc and rolling over to a new day does not
+    rebuild the whole list of values.
     """
     counters_reset_on = models.DateTimeField(default=timezone.now, editable=False)
 
@@ -104,19 +110,19 @@ class Application(AbstractWatchModel):
                                     help_text=_("If true, the <em>Deploy</em> button appears on the "
                                                 "application's description page on ikwen website."))
 
-    turnover_history = ListField(editable=False)
-    earnings_history = ListField(editable=False)
-    deployment_earnings_history = ListField(editable=False)
-    transaction_earnings_history = ListField(editable=False)
-    invoice_earnings_history = ListField(editable=False)
-    custom_service_earnings_history = ListField(editable=False)
-    cash_out_history = ListField(editable=False)
+    turnover_history = HistoryField()
+    earnings_history = HistoryField()
+    deployment_earnings_history = HistoryField()
+    transaction_earnings_history = HistoryField()
+    invoice_earnings_history = HistoryField()
+    custom_service_earnings_history = HistoryField()
+    cash_out_history = HistoryField()
 
-    deployment_count_history = ListField(editable=False)
-    transaction_count_history = ListField(editable=False)
-    invoice_count_history = ListField(editable=False)
-    custom_service_count_history = ListField(editable=False)
-    cash_out_count_history = ListField(editable=False)
+    deployment_count_history = HistoryField()
+    transaction_count_history = HistoryField()
+    invoice_count_history = HistoryField()
+    custom_service_count_history = HistoryField()
+    cash_out_count_history = HistoryField()
 
     total_turnover = models.IntegerField(default=0)
     total_earnings = models.IntegerField(default=0)
@@ -231,22 +237,22 @@ class Service(models.Model):
     updated_on = models.DateTimeField(default=timezone.now, auto_now_add=True)
     retailer = models.ForeignKey('self', blank=True, null=True, related_name='+')
 
-    community_history = ListField(editable=False)
-    turnover_history = ListField(editable=False)
-    earnings_history = ListField(editable=False)
-    transaction_earnings_history = ListField(editable=False)
-    invoice_earnings_history = ListField(editable=False)
-    custom_service_earnings_history = ListField(editable=False)
-    cash_out_history = ListField(editable=False)
+    community_history = HistoryField()
+    turnover_history = HistoryField()
+    earnings_history = HistoryField()
+    transaction_earnings_history = HistoryField()
+    invoice_earnings_history = HistoryField()
+    custom_service_earnings_history = HistoryField()
+    cash_out_history = HistoryField()
 
-    transactional_email_history = ListField(editable=False)
-    rewarding_email_history = ListField(editable=False)
-    revival_email_history = ListField(editable=False)
+    transactional_email_history = HistoryField()
+    rewarding_email_history = HistoryField()
+    revival_email_history = HistoryField()
 
-    transaction_count_history = ListField(editable=False)
-    invoice_count_history = ListField(editable=False)
-    custom_service_count_history = ListField(editable=False)
-    cash_out_count_history = ListField(editable=False)
+    transaction_count_history = HistoryField()
+    invoice_count_history = HistoryField()
+    custom_service_count_history = HistoryField()
+    cash_out_count_history = HistoryField()
 
     total_community = models.IntegerField(default=0)
     total_turnover = models.IntegerField(default=0)
@@ -321,9 +327,15 @@ class Service(models.Model):
         Gets the Service configuration based on the model
         stated in IKWEN_CONFIG_MODEL setting.
         """
-        config_model = get_config_model()
         db = router.db_for_read(self.__class__, instance=self)
+        request_cache = get_request_cache()
+        key = 'config:%s:%s' % (self.id, db)
+        if request_cache is not None and key in request_cache:
+            return request_cache[key]
+        config_model = get_config_model()
         config = config_model.objects.using(db).get(service=self)
+        if request_cache is not None:
+            request_cache[key] = config
         return config
     config = property(_get_config)
 
@@ -331,7 +343,13 @@ class Service(models.Model):
         """
         Gets the Config object in UMBRELLA database for this Service
         """
+        request_cache = get_request_cache()
+        key = 'basic_config:%s' % self.id
+        if request_cache is not None and key in request_cache:
+            return request_cache[key]
         config = Config.objects.using('umbrella').get(service=self)
+        if request_cache is not None:
+            request_cache[key] = config
         return config
     basic_config = property(_get_basic_config)
 
@@ -343,6 +361,30 @@ class Service(models.Model):
                                                                                'url': self.url}
     details = property(_get_details)
 
+    def _get_cached_fields(self):
+        """
+        Fields that cached copies of the Service must reflect. Counters and histories,
+        updated on every transaction, are left out so that their saves do not invalidate
+        the cache. See :mod:`ikwen.core.local_cache`
+        """
+        return [field for field in self._meta.fields
+                if not (field.name.endswith('_history') or field.name.startswith('total_')
+                        or field.name in ('updated_on', 'counters_reset_on'))]
+
+    def _get_stored_state(self, using):
+        """
+        Dict of the values of cached fields of this Service as currently stored in the
+        database *using*, or None if it is not stored there yet. Read on save rather than
+        kept from the load, so that instantiating a Service costs nothing more.
+        """
+        if not self.id:
+            return None
+        name_list = [field.name for field in self._get_cached_fields()]
+        stored = list(Service.objects.using(using).filter(pk=self.id).values_list(*name_list)[:1])
+        if not stored:
+            return None
+        return dict(zip(name_list, stored[0]))
+
     def get_profile_url(self):
         url = reverse('ikwen:company_profile', args=(self.project_name_slug,))
         return ikwenize(url)
@@ -358,6 +400,7 @@ class Service(models.Model):
         save(using=database).
         """
         using = kwargs.pop('using', 'default')
+        stored_state = self._get_stored_state(using)
         if getattr(settings, 'IS_IKWEN', False) and using != self.database and self.id:
             # If we are on Ikwen itself, replicate save or update on the current Service database
             add_database_to_settings(self.database)
@@ -369,6 +412,15 @@ class Service(models.Model):
                 self.app.operators_count += 1
                 self.app.save()
         super(Service, self).save(using=using, *args, **kwargs)
+        if stored_state is not None:
+            for field in self._get_cached_fields():
+                if getattr(self, field.attname) != stored_state[field.name]:
+                    bump_service_cache_version(self.id)
+                    break
+        if getattr(settings, 'IS_IKWEN', False) and self.expiry != (stored_state or {}).get('expiry'):
+            # Services are Subscriptions to ikwen, invoiced and suspended by billing crons
+            from ikwen.billing.utils import schedule_expiry_events
+            schedule_expiry_events(self, using=using)
 
     def _get_wallet(self, provider):
         try:
@@ -386,15 +438,18 @@ class Service(models.Model):
 
     def raise_balance(self, amount, provider=None):
         from ikwen.billing.mtnmomo.views import MTN_MOMO
+        from ikwen.core.rollups import invalidate_rollup_wallets
         if not provider:
             provider = MTN_MOMO
         wallet = self._get_wallet(provider)
         with transaction.atomic():
             wallet.balance += amount
             wallet.save(using='wallets')
+        invalidate_rollup_wallets(self)
 
     def lower_balance(self, amount, provider=None):
         from ikwen.billing.mtnmomo.views import MTN_MOMO
+        from ikwen.core.rollups import invalidate_rollup_wallets
         if not provider:
             provider = MTN_MOMO
         wallet = self._get_wallet(provider)
@@ -403,6 +458,7 @@ class Service(models.Model):
         with transaction.atomic():
             wallet.balance -= amount
             wallet.save(using='wallets')
+        invalidate_rollup_wallets(self)
 
     def update_domain(self, new_domain, is_naked_domain=True, web_server_config_template=None):
         """
@@ -778,6 +834,7 @@ class AbstractConfig(Model):
 
     def save(self, *args, **kwargs):
         super(AbstractConfig, self).save(*args, **kwargs)
+        bump_service_cache_version(self.service_id)  # Config is cached along with its Service
         if type(self) is not Config:  # If it is any descending class
             from ikwen.accesscontrol.backends import UMBRELLA
             base_config = self.get_base_config()
@@ -841,6 +898,30 @@ class OperatorWallet(Model):
     payment_mean = property(_get_payment_mean)
 
 
+class DashboardRollup(Model):
+    """
+    Pre-aggregated dashboard figures of a Service, so that DashboardBase
+    renders from this single document rather than from the Service history
+    fields and the wallets database.
+
+    *daily*, *weekly* and *monthly* map a period key (2018-05-31, 2018-W22
+    and 2018-05 respectively) to a dict of counters named after the Service
+    history fields without the *_history* suffix. Eg: {'earnings': 12500, 'transaction_count': 3}
+
+    It is kept up to date by :mod:`ikwen.core.rollups` and can be rebuilt with the
+    *rebuild_dashboard_rollups* management command.
+    """
+    service_id = models.CharField(max_length=24, unique=True)
+    daily = DictField()
+    weekly = DictField()
+    monthly = DictField()
+    balance = models.FloatField(blank=True, null=True)
+    last_cash_out = DictField()
+
+    class Meta:
+        db_table = 'ikwen_dashboard_rollup'
+
+
 class Country(Model):
     name = models.CharField(max_length=100, unique=True, db_index=True)
     iso2 = models.CharField(max_length=2, unique=True, db_index=True)
@@ -949,9 +1030,47 @@ class ConsoleEvent(Model):
         return var
 
 
+class OutboxJob(Model):
+    """
+    Mail, SMS, push notification or console event to be processed in background by
+    the outbox worker rather than within a web request. See :mod:`ikwen.core.outbox`
+
+    :attr:`payload` holds the arguments of the job, depending on its :attr:`type`.
+    A failed job is retried :attr:`max_attempts` times, waiting longer after each failure.
+    """
+    MAIL = 'Mail'
+    SMS = 'SMS'
+    PUSH = 'Push'
+    EVENT = 'Event'
+
+    PENDING = 'Pending'
+    RUNNING = 'Running'
+    DONE = 'Done'
+    FAILED = 'Failed'
+
+    type = models.CharField(max_length=15, db_index=True)
+    payload = DictField()
+    status = models.CharField(max_length=15, default=PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    next_try_on = models.DateTimeField(default=timezone.now, db_index=True)
+    lease_expires_on = models.DateTimeField(blank=True, null=True, db_index=True)
+    last_error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'ikwen_outbox_job'
+
+
 class QueuedSMS(Model):
+    PENDING = 'Pending'
+    DISPATCHED = 'Dispatched'
+
     recipient = models.CharField(max_length=18)
     text = models.TextField()
+    status = models.CharField(max_length=15, default=PENDING, db_index=True)
+    dispatched_on = models.DateTimeField(blank=True, null=True)
+    dispatched_to = models.CharField(max_length=60, blank=True, null=True,
+                                     help_text="Identifier of the device that pulled the SMS for sending.")
 
     class Meta:
         db_table = 'ikwen_queued_sms'
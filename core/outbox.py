@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent outbox of mails, SMS, push notifications and console events.
+
+Web requests only enqueue jobs with the enqueue_* functions below, which costs a single
+insert in the *ikwen_outbox_job* collection. Jobs of all Services go to the umbrella
+database, whatever the database of the weblet enqueuing them, so that a single outbox
+worker (ikwen/core/outbox_worker.py) drains them all with :func:`process_outbox`.
+As the worker runs with its own settings, mail jobs carry the id of the Service that
+enqueued them and its SMTP settings, so that mails are still sent through the server
+and logged on the Service of the weblet they come from.
+Jobs are claimed with an atomic find_and_modify and a lease, so that many workers can
+run side by side and jobs of a crashed worker are picked up again once the lease expires.
+"""
+import logging
+import traceback
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from threading import Thread
+
+from bson.binary import Binary
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.accesscontrol.models import Member
+from ikwen.core.models import OutboxJob, Service
+from ikwen.core.utils import get_collection, get_service_instance, get_sms_label, XEmailMessage, send_sms, \
+    send_push, add_event
+
+logger = logging.getLogger('ikwen')
+
+RETRY_DELAY = 60  # Seconds before the first retry. It doubles after each failure
+LEASE_DURATION = 300  # Seconds a worker has to process a batch before another one can claim its jobs
+
+
+def _enqueue(job_type, payload, max_attempts=5, using=UMBRELLA):
+    now = timezone.now()
+    job = {
+        'type': job_type,
+        'payload': payload,
+        'status': OutboxJob.PENDING,
+        'attempts': 0,
+        'max_attempts': max_attempts,
+        'next_try_on': now,
+        'lease_expires_on': None,
+        'last_error': None,
+        'created_on': now,
+        'updated_on': now
+    }
+    get_collection(OutboxJob, using).insert(job)
+    return job['_id']
+
+
+def get_mail_connection_settings():
+    """
+    Returns the settings of the mail connection of the current weblet, with which
+    the outbox worker rebuilds it.
+    """
+    return {
+        'backend': getattr(settings, 'EMAIL_BACKEND', None),
+        'host': getattr(settings, 'EMAIL_HOST', None),
+        'port': getattr(settings, 'EMAIL_PORT', None),
+        'username': getattr(settings, 'EMAIL_HOST_USER', None),
+        'password': getattr(settings, 'EMAIL_HOST_PASSWORD', None),
+        'use_tls': getattr(settings, 'EMAIL_USE_TLS', False),
+        'use_ssl': getattr(settings, 'EMAIL_USE_SSL', False)
+    }
+
+
+def enqueue_mail(msg, using=UMBRELLA):
+    """
+    Enqueues an EmailMessage or an XEmailMessage for background sending. Attributes
+    *service* and *type* of an XEmailMessage are kept. *service* defaults to the
+    current Service, and the mail connection settings of the weblet are saved along.
+
+    Attachments made of a MIMEBase object cannot be stored, so such a message
+    is rather sent right away in a thread, as it used to be.
+    """
+    attachments = []
+    for attachment in msg.attachments:
+        if not isinstance(attachment, tuple):
+            Thread(target=lambda m: m.send(), args=(msg,)).start()
+            return
+        filename, content, mimetype = attachment
+        if isinstance(content, str):
+            content = Binary(content)
+        attachments.append({'filename': filename, 'content': content, 'mimetype': mimetype})
+    payload = {
+        'subject': msg.subject,
+        'body': msg.body,
+        'from_email': msg.from_email,
+        'to': list(msg.to),
+        'cc': list(msg.cc),
+        'bcc': list(msg.bcc),
+        'content_subtype': msg.content_subtype,
+        'attachments': attachments,
+        'is_x_email': isinstance(msg, XEmailMessage),
+        'connection': get_mail_connection_settings()
+    }
+    service = getattr(msg, 'service', None)
+    payload['service_id'] = service.id if service else get_service_instance().id
+    email_type = getattr(msg, 'type', None)
+    if email_type:
+        payload['email_type'] = email_type
+    return _enqueue(OutboxJob.MAIL, payload, using=using)
+
+
+def enqueue_sms(recipient, text, label=None, script_url=None, using=UMBRELLA):
+    """
+    Enqueues an SMS. As with send_sms(), *label* and *script_url* default
+    to those of the current Service. They are resolved right away.
+    """
+    if not (recipient and text):
+        return
+    if not (label and script_url):
+        config = get_service_instance().config
+        if not label:
+            label = get_sms_label(config)
+        if not script_url:
+            script_url = config.sms_api_script_url
+    payload = {'recipient': recipient, 'text': text, 'label': label, 'script_url': script_url}
+    return _enqueue(OutboxJob.SMS, payload, using=using)
+
+
+def enqueue_push(sender_weblet, subscription_or_member, title, body, target_page=None, image_url=None, using=UMBRELLA):
+    """
+    Enqueues a push notification. Same arguments as send_push()
+    """
+    if not sender_weblet:
+        sender_weblet = get_service_instance()
+    payload = {'service_id': sender_weblet.id, 'title': title, 'body': body,
+               'target_page': target_page, 'image_url': image_url}
+    if isinstance(subscription_or_member, Member):
+        payload['member_id'] = subscription_or_member.id
+    else:
+        payload['push_subscription'] = subscription_or_member
+    return _enqueue(OutboxJob.PUSH, payload, using=using)
+
+
+def enqueue_event(service, codename, member=None, group_id=None, object_id=None, model=None, object_id_list=[],
+                  using=UMBRELLA):
+    """
+    Enqueues a console event. Same arguments as add_event(), which the worker eventually runs.
+    """
+    payload = {'service_id': service.id, 'codename': codename, 'member_id': member.id if member else None,
+               'group_id': group_id, 'object_id': object_id, 'model': model, 'object_id_list': list(object_id_list)}
+    return _enqueue(OutboxJob.EVENT, payload, using=using)
+
+
+def claim_jobs(batch_size=50, using=UMBRELLA):
+    """
+    Atomically claims up to *batch_size* jobs due for processing: pending jobs whose
+    *next_try_on* is past and running jobs whose lease expired.
+    """
+    collection = get_collection(OutboxJob, using)
+    now = timezone.now()
+    query = {'$or': [{'status': OutboxJob.PENDING, 'next_try_on': {'$lte': now}},
+                     {'status': OutboxJob.RUNNING, 'lease_expires_on': {'$lt': now}}]}
+    update = {'$set': {'status': OutboxJob.RUNNING, 'lease_expires_on': now + timedelta(seconds=LEASE_DURATION),
+                       'updated_on': now},
+              '$inc': {'attempts': 1}}
+    job_list = []
+    for i in range(batch_size):
+        job = collection.find_and_modify(query, update, sort=[('next_try_on', 1)], new=True)
+        if not job:
+            break
+        job_list.append(job)
+    return job_list
+
+
+def _build_mail(payload):
+    if payload.get('is_x_email'):
+        msg = XEmailMessage(payload['subject'], payload['body'], payload['from_email'], payload['to'],
+                            bcc=payload['bcc'], cc=payload['cc'])
+        if payload.get('service_id'):
+            msg.service = Service.objects.using(UMBRELLA).get(pk=payload['service_id'])
+        if payload.get('email_type'):
+            msg.type = payload['email_type']
+    else:
+        msg = EmailMessage(payload['subject'], payload['body'], payload['from_email'], payload['to'],
+                           bcc=payload['bcc'], cc=payload['cc'])
+    msg.content_subtype = payload['content_subtype']
+    for attachment in payload['attachments']:
+        content = attachment['content']
+        if isinstance(content, Binary):
+            content = str(content)
+        msg.attach(attachment['filename'], content, attachment['mimetype'])
+    return msg
+
+
+def _run_job(job):
+    payload = job['payload']
+    if job['type'] == OutboxJob.SMS:
+        send_sms(payload['recipient'], payload['text'], label=payload['label'],
+                 script_url=payload['script_url'], fail_silently=False)
+    elif job['type'] == OutboxJob.PUSH:
+        sender_weblet = Service.objects.using(UMBRELLA).get(pk=payload['service_id'])
+        if payload.get('member_id'):
+            subscription_or_member = Member.objects.using(UMBRELLA).get(pk=payload['member_id'])
+        else:
+            subscription_or_member = payload['push_subscription']
+        send_push(sender_weblet, subscription_or_member, payload['title'], payload['body'],
+                  payload['target_page'], payload['image_url'])
+    elif job['type'] == OutboxJob.EVENT:
+        service = Service.objects.using(UMBRELLA).get(pk=payload['service_id'])
+        member = Member.objects.using(UMBRELLA).get(pk=payload['member_id']) if payload['member_id'] else None
+        add_event(service, payload['codename'], member=member, group_id=payload['group_id'],
+                  object_id=payload['object_id'], model=payload['model'], object_id_list=payload['object_id_list'])
+    else:
+        raise ValueError("Unknown outbox job type %s" % job['type'])
+
+
+def _get_mail_connection(connection_settings):
+    if not connection_settings:  # Job enqueued before settings were saved along
+        return get_connection()
+    connection_settings = dict(connection_settings)
+    backend = connection_settings.pop('backend')
+    return get_connection(backend, **connection_settings)
+
+
+def _get_connection_key(job):
+    return tuple(sorted((job['payload'].get('connection') or {}).items()))
+
+
+def _run_mail_jobs(mail_job_list):
+    """
+    Sends mails of the batch through a single connection per weblet SMTP settings.
+    Returns a list of (job, error) tuples, error being None on success.
+    """
+    job_list_by_connection = {}
+    for job in mail_job_list:
+        job_list_by_connection.setdefault(_get_connection_key(job), []).append(job)
+    result_list = []
+    for job_list in job_list_by_connection.values():
+        result_list.extend(_run_connection_mail_jobs(job_list))
+    return result_list
+
+
+def _run_connection_mail_jobs(mail_job_list):
+    result_list = []
+    connection = _get_mail_connection(mail_job_list[0]['payload'].get('connection'))
+    try:
+        connection.open()
+        for job in mail_job_list:
+            try:
+                msg = _build_mail(job['payload'])
+                msg.connection = connection
+                msg.send()
+                result_list.append((job, None))
+            except:
+                result_list.append((job, traceback.format_exc()))
+    except:  # Connection could not be opened
+        error = traceback.format_exc()
+        done = set(result[0]['_id'] for result in result_list)
+        result_list.extend((job, error) for job in mail_job_list if job['_id'] not in done)
+    finally:
+        connection.close()
+    return result_list
+
+
+def _run_other_job(job):
+    try:
+        _run_job(job)
+        return job, None
+    except:
+        return job, traceback.format_exc()
+
+
+def _save_result(job, error, using=UMBRELLA):
+    collection = get_collection(OutboxJob, using)
+    now = timezone.now()
+    if error is None:
+        collection.update({'_id': job['_id']}, {'$set': {'status': OutboxJob.DONE, 'lease_expires_on': None,
+                                                         'updated_on': now}})
+        return
+    logger.error("Outbox %s job %s failed on attempt %d:\n%s" % (job['type'], job['_id'], job['attempts'], error))
+    if job['attempts'] >= job['max_attempts']:
+        update = {'status': OutboxJob.FAILED, 'lease_expires_on': None, 'last_error': error, 'updated_on': now}
+    else:
+        next_try_on = now + timedelta(seconds=RETRY_DELAY * 2 ** (job['attempts'] - 1))
+        update = {'status': OutboxJob.PENDING, 'next_try_on': next_try_on, 'lease_expires_on': None,
+                  'last_error': error, 'updated_on': now}
+    collection.update({'_id': job['_id']}, {'$set': update})
+
+
+def process_outbox(batch_size=50, concurrency=4, using=UMBRELLA):
+    """
+    Claims a batch of jobs and processes them with at most *concurrency* threads.
+    All mails of the batch go through one of them, with a single SMTP connection per weblet.
+    Failed jobs are scheduled for a retry, or marked Failed after their max_attempts.
+
+    :return: Number of jobs processed
+    """
+    job_list = claim_jobs(batch_size, using)
+    if not job_list:
+        return 0
+    mail_job_list = [job for job in job_list if job['type'] == OutboxJob.MAIL]
+    other_job_list = [job for job in job_list if job['type'] != OutboxJob.MAIL]
+    pool = ThreadPool(concurrency)
+    try:
+        mail_result = pool.apply_async(_run_mail_jobs, (mail_job_list,)) if mail_job_list else None
+        result_list = pool.map(_run_other_job, other_job_list)
+        if mail_result:
+            result_list.extend(mail_result.get())
+    finally:
+        pool.close()
+        pool.join()
+    for job, error in result_list:
+        _save_result(job, error, using)
+    return len(job_list)
+
+
+def purge_outbox(days=7, using=UMBRELLA):
+    """
+    Deletes jobs done for more than *days* days. Failed jobs are kept for investigation.
+    """
+    limit = timezone.now() - timedelta(days=days)
+    get_collection(OutboxJob, using).remove({'status': OutboxJob.DONE, 'updated_on': {'$lt': limit}})
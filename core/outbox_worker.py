@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Drains the outbox of mails, SMS, push notifications and console events. See ikwen.core.outbox
+
+Run it as a daemon: python outbox_worker.py
+Or from the crontab every minute to process all due jobs and exit: python outbox_worker.py --once
+"""
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ikwen.conf.settings")
+
+import sys
+import time
+
+from django.utils.log import AdminEmailHandler
+
+from ikwen.core.outbox import process_outbox, purge_outbox
+
+import logging.handlers
+logger = logging.getLogger('crons.error')
+logger.setLevel(logging.DEBUG)
+file_handler = logging.handlers.RotatingFileHandler('outbox_worker.log', 'w', 1000000, 4)
+file_handler.setLevel(logging.INFO)
+f = logging.Formatter('%(levelname)-10s %(asctime)-27s %(message)s')
+file_handler.setFormatter(f)
+email_handler = AdminEmailHandler()
+email_handler.setLevel(logging.ERROR)
+email_handler.setFormatter(f)
+logger.addHandler(file_handler)
+logger.addHandler(email_handler)
+
+POLL_INTERVAL = 2  # Seconds to wait when the outbox is empty
+PURGE_INTERVAL = 3600
+
+
+def run(once=False, batch_size=50, concurrency=4):
+    last_purge = 0
+    while True:
+        try:
+            if time.time() - last_purge > PURGE_INTERVAL:
+                purge_outbox()
+                last_purge = time.time()
+            processed = process_outbox(batch_size, concurrency)
+        except:
+            logger.error(u"Outbox processing failed", exc_info=True)
+            processed = 0
+        if processed:
+            logger.debug(u"%d outbox job(s) processed" % processed)
+            continue
+        if once:
+            break
+        time.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    run(once='--once' in sys.argv)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Keyset pagination of :class:`ikwen.core.generic.HybridListView`.
+
+Django Paginator and slices like queryset[start:start+length] run as Mongo skip/limit,
+so the server walks over all objects of previous pages before returning those of the
+page asked: the deeper the page, the slower. Keyset pagination rather remembers the
+values of ordering fields of the last object of a page in an opaque cursor and filters
+the next page on objects coming after those values, which an index on the ordering
+fields resolves as fast for the last page as for the first. Eg: with ordering ('-id', ),
+the page after the cursor of object 5f3a... is queryset.filter(id__lt='5f3a...')[:page_size]
+
+Counting objects is also expensive on large collections, so lists can rather use a
+count cached for a few minutes or an estimated count, which stops counting after
+ESTIMATED_COUNT_LIMIT objects.
+"""
+import base64
+import json
+from datetime import datetime, date
+from math import ceil
+
+from django.core.cache import cache
+from django.db.models import Q
+
+EXACT_COUNT = 'exact'
+CACHED_COUNT = 'cached'
+ESTIMATED_COUNT = 'estimated'
+COUNT_CACHE_TIMEOUT = 300
+ESTIMATED_COUNT_LIMIT = 10000
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+_DATE_FORMAT = '%Y-%m-%d'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return ['dt', value.strftime(_DATETIME_FORMAT)]
+    if isinstance(value, date):
+        return ['d', value.strftime(_DATE_FORMAT)]
+    return ['v', value]
+
+
+def _load_value(item):
+    kind, value = item
+    if kind == 'dt':
+        return datetime.strptime(value, _DATETIME_FORMAT)
+    if kind == 'd':
+        return datetime.strptime(value, _DATE_FORMAT).date()
+    return value
+
+
+def encode_cursor(values):
+    """
+    Returns the opaque cursor of the list of ordering *values* of an object.
+    """
+    data = json.dumps([_dump_value(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the list of ordering values held by *cursor*.
+
+    :raise InvalidCursor: if the cursor was not issued by :func:`encode_cursor`
+    """
+    try:
+        cursor = str(cursor)
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return [_load_value(item) for item in json.loads(data)]
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor("Invalid cursor %s" % cursor)
+
+
+def get_keyset_ordering(model, ordering):
+    """
+    Returns *ordering* as a list of (attname, descending) where attname is the name of the
+    model attribute holding the value of the field. The primary key is appended to make
+    the ordering unique if not there already. Eg: ('-created_on', ) gives
+    [('created_on', True), ('id', True)]
+    """
+    keyset = []
+    pk_name = model._meta.pk.attname
+    for name in ordering:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == 'pk':
+            name = pk_name
+        keyset.append((model._meta.get_field(name).attname, descending))
+    if pk_name not in [attname for attname, descending in keyset]:
+        descending = keyset[-1][1] if keyset else True
+        keyset.append((pk_name, descending))
+    return keyset
+
+
+def get_ordering_from_keyset(keyset):
+    """
+    Returns the order_by() arguments of *keyset*.
+    """
+    return [('-' if descending else '') + attname for attname, descending in keyset]
+
+
+def get_cursor(obj, keyset):
+    """
+    Returns the cursor pointing right after *obj* in a list ordered by *keyset*.
+    """
+    return encode_cursor([getattr(obj, attname) for attname, descending in keyset])
+
+
+def filter_after_cursor(queryset, keyset, cursor):
+    """
+    Filters *queryset* on objects coming after *cursor* in the *keyset* ordering. For
+    ordering (a, b, id) that is: a > va OR (a = va AND b > vb) OR (a = va AND b = vb AND id > vid)
+    """
+    values = decode_cursor(cursor)
+    if len(values) != len(keyset):
+        raise InvalidCursor("Cursor %s does not match ordering %s" % (cursor, keyset))
+    criteria = None
+    for i, (attname, descending) in enumerate(keyset):
+        lookup = '__lt' if descending else '__gt'
+        kwargs = dict((keyset[j][0], values[j]) for j in range(i))
+        kwargs[attname + lookup] = values[i]
+        criteria = Q(**kwargs) if criteria is None else criteria | Q(**kwargs)
+    return queryset.filter(criteria)
+
+
+def count_objects(queryset, mode=EXACT_COUNT, cache_key=None, timeout=COUNT_CACHE_TIMEOUT):
+    """
+    Counts objects of *queryset* according to *mode*:
+        EXACT_COUNT: plain queryset.count()
+        CACHED_COUNT: exact count kept *timeout* seconds in the cache under *cache_key*
+        ESTIMATED_COUNT: exact count up to ESTIMATED_COUNT_LIMIT, which is returned beyond
+    """
+    if mode == ESTIMATED_COUNT:
+        return queryset[:ESTIMATED_COUNT_LIMIT].count()
+    if mode == CACHED_COUNT and cache_key:
+        count = cache.get(cache_key)
+        if count is None:
+            count = queryset.count()
+            cache.set(cache_key, count, timeout)
+        return count
+    return queryset.count()
+
+
+class KeysetPaginator(object):
+    """
+    Stands for django.core.paginator.Paginator in templates of keyset paginated lists.
+    *count* can be estimated, so num_pages is never less than pages actually browsed.
+    """
+    def __init__(self, count, per_page):
+        self.count = count
+        self.per_page = per_page
+        self.num_pages = max(int(ceil(count / float(per_page))), 1)
+
+    @property
+    def page_range(self):
+        return range(1, self.num_pages + 1)
+
+
+class KeysetPage(object):
+    """
+    Page of a keyset paginated list. Has the attributes of django.core.paginator.Page
+    used in templates, plus next_cursor which points to the following page.
+    """
+    def __init__(self, object_list, number, paginator, next_cursor=None):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        if next_cursor and paginator.num_pages <= number:
+            paginator.num_pages = number + 1
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def start_index(self):
+        if not self.object_list:
+            return 0
+        return (self.number - 1) * self.paginator.per_page + 1
+
+    def end_index(self):
+        return (self.number - 1) * self.paginator.per_page + len(self.object_list)
+
+
+def get_keyset_slice(queryset, keyset, length, cursor=None, start=0):
+    """
+    Returns the list of *length* objects of *queryset* coming after *cursor*, or after the
+    *start* first objects if no cursor, and the cursor of the following page, None if last.
+    *queryset* must already be ordered by *keyset*.
+    """
+    if cursor:
+        queryset = filter_after_cursor(queryset, keyset, cursor)
+        start = 0
+    object_list = list(queryset[start:start + length + 1])
+    next_cursor = None
+    if len(object_list) > length:
+        object_list = object_list[:length]
+        next_cursor = get_cursor(object_list[-1], keyset)
+    return object_list, next_cursor
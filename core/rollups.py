@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Maintenance of :class:`ikwen.core.models.DashboardRollup` documents.
+
+Each time counters of a Service are incremented, the same increments are
+$inc'ed in the daily, weekly and monthly buckets of its rollup, in the same
+database as the Service. Dashboards then read a single document rather than
+computing reports out of the Service history fields and the wallets database.
+"""
+import logging
+from datetime import datetime, timedelta
+from time import strptime
+
+from django.utils import timezone
+
+from ikwen.core.utils import get_collection, calculate_watch_info
+
+logger = logging.getLogger('ikwen')
+
+DAILY_ROLLUP_DAYS = 90  # Number of days kept in the daily buckets
+
+
+def get_day_key(dt):
+    return dt.strftime('%Y-%m-%d')
+
+
+def get_week_key(dt):
+    year, week, weekday = dt.isocalendar()
+    return '%d-W%02d' % (year, week)
+
+
+def get_month_key(dt):
+    return dt.strftime('%Y-%m')
+
+
+def get_metric(history_field):
+    """
+    Name of the rollup counter matching *history_field*. Eg: earnings_history -> earnings
+    """
+    return history_field.replace('_history', '')
+
+
+def _get_rollup_collection(using):
+    from ikwen.core.models import DashboardRollup
+    return get_collection(DashboardRollup, using)
+
+
+def update_rollup(service, increments, using='default', days_ago=0):
+    """
+    $inc's the rollup buckets of *service* with *increments* in a single upsert.
+
+    :param service: Service whose counters were incremented
+    :param increments: dict mapping history fields to their increment value
+    :param using: database of the Service copy that was incremented
+    :param days_ago: 0 if increments apply to today, 1 if to yesterday, etc.
+    """
+    now = timezone.now()
+    day = now - timedelta(days=days_ago)
+    inc = {}
+    for history_field, increment_value in increments.items():
+        metric = get_metric(history_field)
+        inc['daily.%s.%s' % (get_day_key(day), metric)] = increment_value
+        inc['weekly.%s.%s' % (get_week_key(day), metric)] = increment_value
+        inc['monthly.%s.%s' % (get_month_key(day), metric)] = increment_value
+    update = {
+        '$inc': inc,
+        '$set': {'updated_on': now},
+        '$setOnInsert': {'created_on': now}
+    }
+    if days_ago < DAILY_ROLLUP_DAYS:
+        # Drop the day that just went out of the daily window to keep the document bounded
+        update['$unset'] = {'daily.%s' % get_day_key(now - timedelta(days=DAILY_ROLLUP_DAYS)): ''}
+    _get_rollup_collection(using).update({'service_id': service.id}, update, upsert=True)
+
+
+def refresh_rollup_wallets(service, using=None, fail_silently=True):
+    """
+    Sets the balance and last cash-out of *service* in its rollup. Called upon cash-out,
+    and by dashboards when the balance was invalidated by :func:`invalidate_rollup_wallets`.
+    Since those are global figures of the Service, they are kept by default in the rollup
+    of its own database.
+    """
+    from ikwen.core.models import OperatorWallet
+    from ikwen.core.utils import add_database
+    if not using:
+        using = service.database
+    try:
+        balance = 0
+        for wallet in OperatorWallet.objects.using('wallets').filter(nonrel_id=service.id):
+            balance += wallet.balance
+        now = timezone.now()
+        update = {'balance': balance, 'last_cash_out': get_last_cash_out(service), 'updated_on': now}
+        add_database(using)
+        _get_rollup_collection(using).update({'service_id': service.id},
+                                           {'$set': update, '$setOnInsert': {'created_on': now}}, upsert=True)
+    except:
+        if not fail_silently:
+            raise
+        logger.error("Could not refresh wallets in dashboard rollup of Service %s" % service.id, exc_info=True)
+
+
+def get_last_cash_out(service):
+    """
+    Returns the last paid CashOutRequest of *service* as a dict with keys
+    *amount* and *created_on*, or None if it never cashed out.
+    """
+    from ikwen.cashout.models import CashOutRequest
+    qs = CashOutRequest.objects.using('wallets').filter(service_id=service.id, status=CashOutRequest.PAID).order_by('-id')
+    if qs.count() == 0:
+        return None
+    cash_out = qs[0]
+    created_on = cash_out.created_on
+    # Re-transform created_on into a datetime object
+    try:
+        created_on = datetime(*strptime(created_on[:19], '%Y-%m-%d %H:%M:%S')[:6])
+    except TypeError:
+        pass
+    amount = cash_out.amount_paid if cash_out.amount_paid else cash_out.amount
+    return {'amount': amount, 'created_on': created_on}
+
+
+def get_rollup(service, using='default'):
+    """
+    Returns the raw rollup document of *service* in database *using*, or None.
+    """
+    return _get_rollup_collection(using).find_one({'service_id': service.id})
+
+
+def get_rollup_history(rollup, metric, days=DAILY_ROLLUP_DAYS):
+    """
+    Rebuilds the list of daily values of *metric* from the *rollup* document, oldest
+    first and today last, just like a Service history field. The list starts on the
+    first day found in the rollup, so that calculate_watch_info() reports no change
+    on periods older than the rollup.
+    """
+    daily = rollup.get('daily') or {}
+    today = timezone.now()
+    if daily:
+        first_day = datetime(*strptime(min(daily.keys()), '%Y-%m-%d')[:3])
+        days = max(min(days, (today.replace(tzinfo=None) - first_day).days + 1), 1)
+    else:
+        days = 1
+    history = []
+    for n in range(days - 1, -1, -1):
+        bucket = daily.get(get_day_key(today - timedelta(days=n)), {})
+        history.append(bucket.get(metric, 0))
+    return history
+
+
+def get_rollup_report(history, durations=(0, 1, 7, 28)):
+    """
+    Runs calculate_watch_info() on *history* for each of *durations* and returns
+    a dict keyed 'today', 'yesterday', 'last_week' and 'last_28_days' respectively.
+    """
+    keys = {0: 'today', 1: 'yesterday', 7: 'last_week', 28: 'last_28_days'}
+    return dict((keys[duration], calculate_watch_info(history, duration)) for duration in durations)
+
+
+def invalidate_rollup_wallets(service, using=None):
+    """
+    Drops the balance of *service* from its rollup, so that the next dashboard read refreshes
+    it with :func:`refresh_rollup_wallets`. Called whenever an OperatorWallet balance of
+    *service* changes, as it costs a single write where a refresh reads all the wallets
+    and the last cash-out.
+    """
+    from ikwen.core.utils import add_database
+    if not using:
+        using = service.database
+    try:
+        add_database(using)
+        _get_rollup_collection(using).update({'service_id': service.id}, {'$unset': {'balance': ''}})
+    except:
+        logger.error("Could not invalidate wallets in dashboard rollup of Service %s" % service.id, exc_info=True)
+
+
+def rebuild_rollup(service, using=None):
+    """
+    Recomputes the rollup of *service* from the history fields of its copy in database
+    *using*, which are incremented along with the rollup, then refreshes its wallets.
+
+    Only rebuilt counters are $set: those of daily buckets of the last DAILY_ROLLUP_DAYS
+    days, and of weekly and monthly buckets fully covered by the histories. Other counters,
+    like those of dropped transactions, are left as is. Daily buckets older than
+    DAILY_ROLLUP_DAYS are dropped in the process.
+    """
+    from ikwen.core.models import Service
+    from ikwen.core.utils import add_database, set_counters
+    if not using:
+        using = service.database
+    add_database(using)
+    try:
+        service = Service.objects.using(using).get(pk=service.id)
+    except Service.DoesNotExist:
+        pass
+    set_counters(service)
+    now = timezone.now()
+    values = {}
+    for field in service._meta.fields:
+        if not field.name.endswith('_history'):
+            continue
+        metric = get_metric(field.name)
+        history = service.__dict__[field.name]
+        length = len(history)
+        weekly, monthly = {}, {}
+        for i, value in enumerate(history):
+            days_ago = length - 1 - i
+            day = now - timedelta(days=days_ago)
+            if days_ago < DAILY_ROLLUP_DAYS:
+                values['daily.%s.%s' % (get_day_key(day), metric)] = value
+            week_key, month_key = get_week_key(day), get_month_key(day)
+            weekly[week_key] = weekly.get(week_key, 0) + value
+            monthly[month_key] = monthly.get(month_key, 0) + value
+        first_day = now - timedelta(days=length - 1)
+        if first_day.weekday() != 0:
+            weekly.pop(get_week_key(first_day), None)  # Week only partly covered by the history
+        if first_day.day != 1:
+            monthly.pop(get_month_key(first_day), None)
+        for key, value in weekly.items():
+            values['weekly.%s.%s' % (key, metric)] = value
+        for key, value in monthly.items():
+            values['monthly.%s.%s' % (key, metric)] = value
+    values['updated_on'] = now
+    update = {'$set': values, '$setOnInsert': {'created_on': now}}
+    collection = _get_rollup_collection(using)
+    previous = collection.find_one({'service_id': service.id}, {'daily': 1})
+    daily_limit = get_day_key(now - timedelta(days=DAILY_ROLLUP_DAYS - 1))
+    expired = [key for key in ((previous or {}).get('daily') or {}).keys() if key < daily_limit]
+    if expired:
+        update['$unset'] = dict(('daily.%s' % key, '') for key in expired)
+    collection.update({'service_id': service.id}, update, upsert=True)
+    refresh_rollup_wallets(service, using, fail_silently=False)
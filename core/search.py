@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Search backends of :class:`ikwen.core.generic.HybridListView`.
+
+The default :class:`ContainsSearchBackend` filters with *search_field*__icontains,
+which Mongo runs as an unanchored regex over the whole collection. Large collections
+should rather use one of the indexed backends:
+
+:class:`PrefixTokenSearchBackend` looks up words typed in a ListField of prefixes of
+the words of the object, maintained on save with :func:`get_prefix_tokens`, just like
+Member.search_tokens. It suits search as you type. Eg:
+
+    class MemberList(HybridListView):
+        search_backend = PrefixTokenSearchBackend()
+        search_field = 'search_tokens'
+
+:class:`TextSearchBackend` runs a Mongo $text query on the text index of the collection
+and keeps the best ranked objects. It only matches whole words, but can span many fields.
+
+Indexed backends get ids of matching objects from the raw collection, then filter the
+queryset on them, so at most MAX_SEARCH_RESULTS objects are returned.
+"""
+from django.template.defaultfilters import slugify
+from django.utils.module_loading import import_by_path
+
+from ikwen.core.utils import get_collection
+
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 15
+MAX_SEARCH_RESULTS = 500
+
+
+def tokenize(text):
+    """
+    Returns the list of lowercase ASCII words of *text*.
+    """
+    return [word for word in slugify(text or u'').split('-') if word]
+
+
+def get_prefix_tokens(*values):
+    """
+    Returns the sorted list of prefixes of MIN_TOKEN_LENGTH to MAX_TOKEN_LENGTH
+    characters of all words of *values*. Eg: 'Roddy Mbogning' gives
+    ['mb', 'mbo', 'mbog', ..., 'ro', 'rod', 'rodd', 'roddy']
+    """
+    tokens = set()
+    for value in values:
+        for word in tokenize(value):
+            for i in range(MIN_TOKEN_LENGTH, min(len(word), MAX_TOKEN_LENGTH) + 1):
+                tokens.add(word[:i])
+    return sorted(tokens)
+
+
+def get_member_search_tokens(first_name, last_name, email, phone):
+    """
+    Returns the search_tokens of a Member. Only the part of *email* before the @ is tokenized.
+    """
+    email = email.split('@')[0] if email else None
+    return get_prefix_tokens(first_name, last_name, email, phone)
+
+
+def get_search_backend(backend):
+    """
+    Returns a search backend instance out of *backend*, which can be
+    the dotted path of a backend class, a class or an instance already.
+    """
+    if not backend:
+        return ContainsSearchBackend()
+    if isinstance(backend, basestring):
+        backend = import_by_path(backend)
+    if isinstance(backend, type):
+        backend = backend()
+    return backend
+
+
+class ContainsSearchBackend(object):
+    """
+    Filters on *search_field*__icontains with the slugified search term. Only the first
+    max_chars of the term are used if set. Not indexed.
+    """
+    def search(self, queryset, search_term, search_field, max_chars=None):
+        word = slugify(search_term.lower()).replace('-', ' ')
+        try:
+            word = word[:int(max_chars)]
+        except:
+            pass
+        if word:
+            kwargs = {search_field + '__icontains': word}
+            queryset = queryset.filter(**kwargs)
+        return queryset
+
+
+class PrefixTokenSearchBackend(object):
+    """
+    Matches objects whose ListField *search_field* contains all words typed,
+    cut to MAX_TOKEN_LENGTH characters. The field must have a db_index.
+    """
+    def search(self, queryset, search_term, search_field, max_chars=None):
+        tokens = [word[:MAX_TOKEN_LENGTH] for word in tokenize(search_term) if len(word) >= MIN_TOKEN_LENGTH]
+        if not tokens:
+            return queryset
+        tokens.sort(key=len, reverse=True)  # Longest first, as it is the most selective
+        cursor = get_collection(queryset.model, queryset.db)\
+            .find({search_field: {'$all': tokens}}, {'_id': 1}).limit(MAX_SEARCH_RESULTS)
+        return queryset.filter(pk__in=[str(doc['_id']) for doc in cursor])
+
+
+class TextSearchBackend(object):
+    """
+    Runs a Mongo $text query and keeps the MAX_SEARCH_RESULTS best ranked objects.
+    The collection must have a text index. *search_field* is not used.
+    """
+    def search(self, queryset, search_term, search_field=None, max_chars=None):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset
+        score = {'score': {'$meta': 'textScore'}}
+        cursor = get_collection(queryset.model, queryset.db)\
+            .find({'$text': {'$search': search_term}}, dict(score, _id=1))\
+            .sort([('score', {'$meta': 'textScore'})]).limit(MAX_SEARCH_RESULTS)
+        return queryset.filter(pk__in=[str(doc['_id']) for doc in cursor])
+
+
+def search_members(search_term, using='default'):
+    """
+    Returns Members matching *search_term* on their search_tokens.
+    """
+    from ikwen.accesscontrol.models import Member
+    return PrefixTokenSearchBackend().search(Member.objects.using(using).all(), search_term, 'search_tokens')
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+SMS dispatch engine.
+
+:class:`SMSDispatcher` sends SMS through the HTTP API of the provider configured in
+the Service Config with a bounded pool of threads, rather than one blocking call after
+the other. Each provider, identified by the host of its script URL, is rate limited as
+set in the IKWEN_SMS_RATE_LIMITS setting. Eg:
+
+    IKWEN_SMS_RATE_LIMITS = {
+        'default': 10,  # SMS per second
+        'api.smsprovider.com': 5
+    }
+
+When a process-wide limiter is installed with :func:`ikwen.core.utils.set_sms_rate_limiter`,
+like the SharedRateLimiter of the billing runner, all dispatchers also go through it.
+
+:class:`SMSTemplate` parses a text with $placeholders once per campaign, then renders it
+for each recipient. :func:`claim_queued_sms` atomically hands out QueuedSMS to the devices
+that pull and send them, so that two concurrent pullers never get the same SMS.
+"""
+import logging
+import multiprocessing
+import re
+import threading
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from django.conf import settings
+from django.utils import timezone
+
+from ikwen.core import http_client
+from ikwen.core.utils import get_service_instance, get_sms_label, get_collection, build_sms_url, \
+    get_sms_rate_limiter
+
+logger = logging.getLogger('ikwen')
+
+DEFAULT_WORKERS = 8
+DEFAULT_RATE_LIMIT = 10  # SMS per second per provider
+
+
+def get_provider(script_url):
+    return urlparse(script_url).netloc
+
+
+class RateLimiter(object):
+    """
+    Thread safe limiter that lets at most *rate* calls to acquire() go through per second.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    RateLimiter shared by processes of a multiprocessing Pool. It must be created
+    before the Pool and handed to workers, like the SMTP slots semaphore.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next_slot = multiprocessing.Value('d', time.time())
+
+    def acquire(self):
+        with self._next_slot.get_lock():
+            now = time.time()
+            wait = self._next_slot.value - now
+            self._next_slot.value = max(now, self._next_slot.value) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SMSTemplate(object):
+    """
+    SMS text containing $placeholders, parsed once and rendered for each recipient. Eg:
+
+        template = SMSTemplate(revival.sms_text)
+        for member in member_list:
+            text = template.render(client=member.first_name)
+
+    Placeholders with no value given at render() are left as is.
+    """
+    PLACEHOLDER = re.compile(r'\$([a-zA-Z_]+)')
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = self.PLACEHOLDER.split(text)  # Even indexes are literals, odd ones are names
+
+    def render(self, **values):
+        output = []
+        for i, token in enumerate(self.tokens):
+            if i % 2 == 0:
+                output.append(token)
+            else:
+                value = values.get(token)
+                output.append(value if value is not None else '$' + token)
+        return ''.join(output)
+
+
+class SMSResult(object):
+    def __init__(self, recipient, text, label, tag=None):
+        self.recipient = recipient
+        self.text = text
+        self.label = label
+        self.tag = tag
+        self.sent = False
+        self.error = None
+
+
+class SMSDispatcher(object):
+    """
+    Sends SMS in background threads. submit() returns right away unless too many SMS are
+    already waiting, and join() waits for all of them to complete and returns their
+    :class:`SMSResult`, so that callers can do their bookkeeping on sent and failed SMS.
+    That bookkeeping can also be done as SMS complete with a *callback*.
+
+    Eg:
+        dispatcher = SMSDispatcher()
+        for member in member_list:
+            dispatcher.submit(member.phone, text, tag=member)
+        for result in dispatcher.join():
+            if result.sent:
+                ...
+
+    :param workers: Max number of SMS being sent at the same time
+    :param label: Sender label. Defaults to the one of the current Service
+    :param script_url: Provider script URL. Defaults to the one of the current Service
+    :param callback: Function called with the SMSResult of each SMS once processed. It runs
+                     in the sending threads, but never twice at the same time.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, label=None, script_url=None, callback=None):
+        self.workers = workers
+        self.label = label
+        self.script_url = script_url
+        self.callback = callback
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(workers * 4)  # Bounds SMS waiting in the pool
+        self._results = []
+        self._rate_limiters = {}
+        self._lock = threading.Lock()
+        self._callback_lock = threading.Lock()
+
+    def _get_defaults(self):
+        if not (self.label and self.script_url):
+            config = get_service_instance().config
+            if not self.label:
+                self.label = get_sms_label(config)
+            if not self.script_url:
+                self.script_url = config.sms_api_script_url
+
+    def _get_rate_limiter(self, provider):
+        with self._lock:
+            limiter = self._rate_limiters.get(provider)
+            if limiter is None:
+                rate_limits = getattr(settings, 'IKWEN_SMS_RATE_LIMITS', {})
+                rate = rate_limits.get(provider, rate_limits.get('default', DEFAULT_RATE_LIMIT))
+                limiter = RateLimiter(rate)
+                self._rate_limiters[provider] = limiter
+            return limiter
+
+    def submit(self, recipient, text, label=None, script_url=None, tag=None):
+        """
+        Queues an SMS for sending. *tag* is any object the caller wants to find
+        back on the matching SMSResult.
+        """
+        if not (recipient and text):
+            return
+        self._get_defaults()
+        label = label or self.label
+        script_url = script_url or self.script_url
+        result = SMSResult(recipient, text, label, tag)
+        self._results.append(result)
+        if not script_url:
+            result.error = "No SMS API script URL configured"
+            self._run_callback(result)
+            return
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        self._slots.acquire()
+        self._pool.apply_async(self._send, (result, script_url))
+
+    def _send(self, result, script_url):
+        try:
+            self._get_rate_limiter(get_provider(script_url)).acquire()
+            shared_limiter = get_sms_rate_limiter()
+            if shared_limiter is not None:
+                shared_limiter.acquire()
+            url = build_sms_url(script_url, result.label, result.recipient, result.text)
+            r = http_client.get(url)
+            r.raise_for_status()
+            result.sent = True
+            logger.debug('SMS submitted to %s through %s' % (result.recipient, url.split('?')[0]))
+        except Exception as e:
+            result.error = str(e)
+            logger.error('Failed to submit SMS to %s' % result.recipient, exc_info=True)
+        finally:
+            self._run_callback(result)
+            self._slots.release()
+
+    def _run_callback(self, result):
+        if self.callback is None:
+            return
+        with self._callback_lock:
+            try:
+                self.callback(result)
+            except:
+                logger.error('SMS callback failed for %s' % result.recipient, exc_info=True)
+
+    def join(self):
+        """
+        Waits for all submitted SMS to be processed and returns their SMSResult, in order
+        of submission. The dispatcher can be used again afterwards.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        results, self._results = self._results, []
+        return results
+
+
+def claim_queued_sms(quantity=100, puller=None, using='default'):
+    """
+    Atomically hands out up to *quantity* pending QueuedSMS, oldest first. Each is marked
+    Dispatched with the date and the *puller* it was handed to, so that it is never
+    handed out twice, even to concurrent pullers.
+
+    :return: list of QueuedSMS
+    """
+    from ikwen.core.models import QueuedSMS
+    collection = get_collection(QueuedSMS, using)
+    now = timezone.now()
+    query = {'status': {'$in': [None, QueuedSMS.PENDING]}}
+    update = {'$set': {'status': QueuedSMS.DISPATCHED, 'dispatched_on': now, 'dispatched_to': puller,
+                       'updated_on': now}}
+    id_list = []
+    for i in range(quantity):
+        doc = collection.find_and_modify(query, update, sort=[('_id', 1)], fields={'_id': 1})
+        if not doc:
+            break
+        id_list.append(str(doc['_id']))
+    if not id_list:
+        return []
+    return list(QueuedSMS.objects.using(using).filter(pk__in=id_list).order_by('id'))
+
+
+def purge_dispatched_sms(days=1, using='default'):
+    """
+    Deletes QueuedSMS dispatched more than *days* days ago.
+    """
+    from ikwen.core.models import QueuedSMS
+    limit = timezone.now() - timedelta(days=days)
+    get_collection(QueuedSMS, using).remove({'status': QueuedSMS.DISPATCHED, 'dispatched_on': {'$lt': limit}})
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django.utils import unittest, timezone
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.core import outbox
+from ikwen.core.models import OutboxJob
+from ikwen.core.outbox import enqueue_sms, enqueue_mail, claim_jobs, process_outbox, RETRY_DELAY
+
+from ikwen.accesscontrol.tests_auth import wipe_test_data
+
+
+class OutboxTestCase(unittest.TestCase):
+    """
+    This test derives django.utils.unittest.TestCate rather than the default django.test.TestCase.
+    Thus, self.client is not automatically created and fixtures not automatically loaded. This
+    will be achieved manually by a custom implementation of setUp()
+    """
+    fixtures = ['ikwen_members.yaml', 'setup_data.yaml']
+
+    def setUp(self):
+        for fixture in self.fixtures:
+            call_command('loaddata', fixture)
+
+    def tearDown(self):
+        OutboxJob.objects.using(UMBRELLA).all().delete()
+        wipe_test_data()
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b101')
+    def test_claim_jobs(self):
+        """
+        A job can be claimed only once, until its lease expires
+        """
+        enqueue_sms('677000001', 'Hello', label='ikwen', script_url='http://sms.test/?to=$recipient')
+        job_list = claim_jobs()
+        self.assertEqual(len(job_list), 1)
+        self.assertEqual(job_list[0]['status'], OutboxJob.RUNNING)
+        self.assertEqual(job_list[0]['attempts'], 1)
+        self.assertEqual(len(claim_jobs()), 0)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b101')
+    def test_process_outbox_with_failing_job(self):
+        """
+        A failing job is put back to Pending and retried later, until it reaches its max_attempts
+        """
+        def failing_send_sms(*args, **kwargs):
+            raise IOError("SMS gateway unreachable")
+        send_sms = outbox.send_sms
+        outbox.send_sms = failing_send_sms
+        try:
+            enqueue_sms('677000001', 'Hello', label='ikwen', script_url='http://sms.test/?to=$recipient')
+            self.assertEqual(process_outbox(), 1)
+            job = OutboxJob.objects.using(UMBRELLA).get()
+            self.assertEqual(job.status, OutboxJob.PENDING)
+            self.assertGreater(job.next_try_on, timezone.now() + timedelta(seconds=RETRY_DELAY - 5))
+            self.assertIn("SMS gateway unreachable", job.last_error)
+            OutboxJob.objects.using(UMBRELLA).all().update(attempts=job.max_attempts - 1, next_try_on=timezone.now())
+            process_outbox()
+            self.assertEqual(OutboxJob.objects.using(UMBRELLA).get().status, OutboxJob.FAILED)
+        finally:
+            outbox.send_sms = send_sms
+
+    def test_process_outbox_sends_mails_with_weblet_connection(self):
+        """
+        Mails are sent through the mail connection of the weblet that enqueued them,
+        not that of the worker, and keep the id of its Service
+        """
+        with override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b101',
+                               EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            enqueue_mail(EmailMessage('Welcome', 'Hello', 'no-reply@ikwen.com', ['member@ikwen.com']))
+        job = OutboxJob.objects.using(UMBRELLA).get()
+        self.assertEqual(job.payload['service_id'], '56eb6d04b37b3379b531b101')
+        self.assertEqual(job.payload['connection']['backend'], 'django.core.mail.backends.locmem.EmailBackend')
+        mail.outbox = []
+        with override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b101',
+                               EMAIL_BACKEND='django.core.mail.backends.filebased.EmailBackend',
+                               EMAIL_FILE_PATH='test_emails/outbox/'):
+            self.assertEqual(process_outbox(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(OutboxJob.objects.using(UMBRELLA).get().status, OutboxJob.DONE)
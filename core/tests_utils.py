@@ -1,18 +1,39 @@
-from datetime import timedelta
+import time
+from threading import Thread
+from datetime import datetime, timedelta
 from django.utils import unittest, timezone
 from django.db import models
+from django.template import Template
+from django.test.utils import override_settings
+from django.test.client import RequestFactory
+from django.utils.safestring import mark_safe
 from djangotoolbox.fields import ListField
-from ikwen.core.utils import set_counters
+from ikwen.core.fields import HistoryField, HistoryRingBuffer
+from ikwen.core.http_client import get_endpoint, record_latency, get_latency_histograms, get_retry, \
+    RETRY_STATUS_LIST
+from ikwen.core.local_cache import LocalCache, get_service_cache_version, bump_service_cache_version
+from ikwen.core import http_client, mail_campaign
+from ikwen.core.facets import get_facet_choices
+from ikwen.core.generic import HybridListView
+from ikwen.core.pagination import encode_cursor, decode_cursor, get_keyset_ordering, InvalidCursor, \
+    get_ordering_from_keyset, get_cursor, filter_after_cursor, get_keyset_slice
+from ikwen.core.search import get_prefix_tokens
+from ikwen.core.sms import SMSTemplate, SMSDispatcher, SharedRateLimiter
+from ikwen.core.utils import set_counters, set_sms_rate_limiter
 
 from ikwen.core.utils import increment_history_field, calculate_watch_info, rank_watch_objects, \
-    group_history_value_list
+    group_history_value_list, increment_history_fields
+from ikwen.core.rollups import get_rollup_history, get_rollup_report, get_day_key, get_week_key
+from ikwen.core.watch_analytics import WatchMatrix
 
 
 class WatchObject(models.Model):
     val1_history = models.CharField(max_length=20)
     val2_history = ListField()
+    val3_history = HistoryField()
     total_val1 = models.IntegerField(default=0)
     total_val2 = models.IntegerField(default=0)
+    total_val3 = models.IntegerField(default=0)
 
     class Meta:
         app_label = 'core'
@@ -53,6 +74,57 @@ class CoreUtilsTestCase(unittest.TestCase):
         self.assertEqual(watch_object.total_val1, 10)
         self.assertEqual(watch_object.total_val2, 10)
 
+    def test_increment_history_field_with_ring_buffer(self):
+        """
+        Incrementing a HistoryField only touches the slot of the current day
+        """
+        watch_object = init_watch_object()
+        watch_object.val3_history = [18, 9, 57, 23, 46]
+        self.assertIsInstance(watch_object.val3_history, HistoryRingBuffer)
+        increment_history_field(watch_object, 'val3_history', 10)
+        self.assertListEqual(watch_object.val3_history.to_list(), [18, 9, 57, 23, 56])
+        self.assertListEqual(watch_object.val3_history[-2:], [23, 56])
+        self.assertEqual(watch_object.total_val3, 10)
+
+    def test_increment_history_fields_never_loses_concurrent_increments(self):
+        """
+        Slots of a HistoryField are $inc'ed in place, so increments made at the
+        same time on different copies of a Watch Object are all kept
+        """
+        watch_object = init_watch_object()
+        watch_object.val3_history = [18, 9, 57, 23, 46]
+        watch_object.save()
+
+        def increment():
+            copy = WatchObject.objects.get(pk=watch_object.id)
+            for i in range(20):
+                increment_history_fields(copy, {'val3_history': 1})
+
+        thread_list = [Thread(target=increment) for i in range(5)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+        watch_object_db = WatchObject.objects.get(pk=watch_object.id)
+        self.assertListEqual(watch_object_db.val3_history.to_list(), [18, 9, 57, 23, 146])
+        self.assertEqual(watch_object_db.total_val3, 100)
+        watch_object.delete()
+
+    def test_history_ring_buffer_rollover(self):
+        history = HistoryRingBuffer(list(range(366)))
+        raw = history.to_bytes()
+        history.roll(2)
+        self.assertEqual(len(history), 366)
+        self.assertListEqual(history[-3:], [365, 0, 0])
+        self.assertEqual(history[0], 2)
+        self.assertEqual(len(history.to_bytes()), len(raw))
+        self.assertEqual(HistoryRingBuffer.from_bytes(history.to_bytes()), history)
+        storage = history.to_storage()
+        self.assertEqual(len(storage), 366 + HistoryRingBuffer.HEADER_SIZE)
+        self.assertEqual(storage[history.get_storage_index()], 0)
+        self.assertEqual(storage[history.get_storage_index(-3)], 365)
+        self.assertEqual(HistoryRingBuffer.from_storage(storage), history)
+
     def test_calculate_watch_info_with_less_history_values_than_period(self):
         watch_object = init_watch_object()
         watch_info0 = calculate_watch_info(watch_object.val2_history)
@@ -99,6 +171,54 @@ class CoreUtilsTestCase(unittest.TestCase):
         self.assertListEqual([wo3, wo1, wo2], ranked_watch_objects7)
         self.assertListEqual([wo3, wo1, wo2], ranked_watch_objects28)
 
+    def test_watch_matrix_rank_and_watch_info(self):
+        wo1 = WatchObject()
+        wo1.val2_history = list(range(57))
+        wo2 = WatchObject()
+        wo2.val2_history = list(range(56, -1, -1))
+        wo3 = WatchObject()
+        wo3.val2_history = list(range(0, 110, 2))
+
+        l = [wo1, wo2, wo3]
+        watch_matrix = WatchMatrix(l, 'val2_history')
+        for duration in (0, 1, 7, 28):
+            ranked = watch_matrix.rank(duration)
+            self.assertListEqual([wo3, wo1, wo2], [item.watch_object for item in ranked])
+            self.assertListEqual([item.total for item in rank_watch_objects(l, 'val2_history', duration)],
+                                 [item.total for item in ranked])
+            watch_info = watch_matrix.watch_info(duration)
+            expected = calculate_watch_info(wo1.val2_history, duration)
+            self.assertEqual(watch_info['total'][0], expected['total'])
+            if expected['change_rate'] is not None:
+                self.assertAlmostEqual(watch_info['change_rate'][0], expected['change_rate'])
+        self.assertListEqual([wo3], [item.watch_object for item in watch_matrix.rank(7, top=1)])
+
+    def test_watch_matrix_group(self):
+        watch_object = init_watch_object()
+        watch_object.val2_history = list(range(366))
+        watch_matrix = WatchMatrix([watch_object], 'val2_history')
+        for group_unit in ('month', 'week'):
+            self.assertListEqual(group_history_value_list(watch_object.val2_history, group_unit),
+                                 watch_matrix.group(group_unit)[0].tolist())
+
+    def test_watch_matrix_group_with_short_history(self):
+        """
+        Groups before the start of a history shorter than the matrix are not returned
+        """
+        watch_object1 = init_watch_object()
+        watch_object1.val2_history = list(range(55))
+        watch_object2 = init_watch_object()
+        watch_object2.val2_history = list(range(366))
+        watch_matrix = WatchMatrix([watch_object1, watch_object2], 'val2_history')
+        for group_unit in ('month', 'week'):
+            grouped_list = watch_matrix.group(group_unit)
+            self.assertListEqual(group_history_value_list(watch_object1.val2_history, group_unit),
+                                 grouped_list[0].tolist())
+            self.assertListEqual(group_history_value_list(watch_object2.val2_history, group_unit),
+                                 grouped_list[1].tolist())
+        self.assertIn(len(watch_matrix.group('month')[0]), (1, 2))
+        self.assertIn(len(watch_matrix.group('week')[0]), (7, 8))
+
     def test_set_counters(self):
         watch_object = init_watch_object()
         now = timezone.now()
@@ -112,6 +232,248 @@ class CoreUtilsTestCase(unittest.TestCase):
         self.assertEqual(watch_object.val1_history, '18,9,57,23,46,0')
         self.assertListEqual(watch_object.val2_history, [18, 9, 57, 23, 46, 0])
 
+    def test_set_counters_does_not_write(self):
+        """
+        Rollover is done in memory only. It reaches the database with the next increment
+        """
+        watch_object = init_watch_object()
+        watch_object.save = lambda *args, **kwargs: self.fail("set_counters() must not save the object")
+        watch_object.counters_reset_on = timezone.now() - timedelta(days=1)
+        set_counters(watch_object)
+        self.assertListEqual(watch_object.val2_history, [18, 9, 57, 23, 46, 0])
+        self.assertEqual(watch_object.counters_reset_on.date(), timezone.now().date())
+
+    def test_set_counters_with_ring_buffer(self):
+        watch_object = init_watch_object()
+        watch_object.val3_history = [18, 9, 57, 23, 46]
+        watch_object.counters_reset_on = timezone.now() - timedelta(days=2)
+        set_counters(watch_object)
+        self.assertListEqual(watch_object.val3_history.to_list(), [18, 9, 57, 23, 46, 0, 0])
+
+    def test_get_rollup_history(self):
+        """
+        Daily buckets of a rollup are turned back into a history list starting on the
+        first day found in the rollup, with 0 on days having no bucket
+        """
+        now = timezone.now()
+        rollup = {'daily': {
+            get_day_key(now - timedelta(days=9)): {'earnings': 5000, 'transaction_count': 2},
+            get_day_key(now - timedelta(days=1)): {'earnings': 1200, 'transaction_count': 1},
+            get_day_key(now): {'earnings': 300, 'transaction_count': 1}
+        }}
+        earnings_history = get_rollup_history(rollup, 'earnings')
+        self.assertListEqual(earnings_history, [5000, 0, 0, 0, 0, 0, 0, 0, 1200, 300])
+        self.assertListEqual(get_rollup_history({'daily': {}}, 'earnings'), [0])
+        report = get_rollup_report(earnings_history)
+        self.assertEqual(report['today']['total'], 300)
+        self.assertEqual(report['yesterday']['total'], 1200)
+        self.assertEqual(report['yesterday']['change'], 1200)
+        self.assertEqual(report['last_week']['total'], 1200)
+        self.assertIsNone(report['last_28_days']['change'])
+
+    def test_get_week_key(self):
+        self.assertEqual(get_week_key(datetime(2018, 1, 1)), '2018-W01')
+        self.assertEqual(get_week_key(datetime(2016, 1, 3)), '2015-W53')
+
+    def test_local_cache_evicts_least_recently_used_and_expired(self):
+        local_cache = LocalCache(max_size=2, timeout=60)
+        local_cache.set('a', 1)
+        local_cache.set('b', 2)
+        local_cache.get('a')
+        local_cache.set('c', 3)
+        self.assertIsNone(local_cache.get('b'))
+        self.assertEqual(local_cache.get('a'), 1)
+        self.assertEqual(local_cache.get('c'), 3)
+        local_cache.set('d', 4, timeout=-1)
+        self.assertIsNone(local_cache.get('d'))
+
+    def test_bump_service_cache_version_only_affects_that_service(self):
+        version1 = get_service_cache_version('56eb6d04b37b3379b531b101')
+        version2 = get_service_cache_version('56eb6d04b37b3379b531b102')
+        bump_service_cache_version('56eb6d04b37b3379b531b101')
+        self.assertNotEqual(get_service_cache_version('56eb6d04b37b3379b531b101'), version1)
+        self.assertEqual(get_service_cache_version('56eb6d04b37b3379b531b102'), version2)
+
+    def test_http_client_latency_histograms(self):
+        endpoint = get_endpoint('post', 'https://api.mtn.test/collection/v1_0/requesttopay/5c3f6a1e-88b1?x=1')
+        self.assertEqual(endpoint, 'POST api.mtn.test/collection/v1_0/requesttopay/:id')
+        get_latency_histograms(reset=True)
+        record_latency(endpoint, 40)
+        record_latency(endpoint, 700)
+        record_latency(endpoint, 60000, failed=True)
+        histogram = get_latency_histograms()[endpoint]
+        self.assertEqual(histogram['count'], 3)
+        self.assertEqual(histogram['errors'], 1)
+        self.assertEqual(histogram['max'], 60000)
+        self.assertListEqual(histogram['buckets'], [1, 0, 0, 0, 1, 0, 0, 0, 0, 1])
+
+    def test_http_client_retries_only_connection_errors_unless_idempotent(self):
+        retry = get_retry()
+        self.assertEqual(retry.read, 0)
+        self.assertEqual(retry.status, 0)
+        self.assertFalse(retry.status_forcelist)
+        self.assertFalse(retry.raise_on_status)
+        retry = get_retry(idempotent=True)
+        self.assertIsNone(retry.read)
+        self.assertEqual(tuple(retry.status_forcelist), RETRY_STATUS_LIST)
+        self.assertFalse(retry.raise_on_status)
+
+    @override_settings(IKWEN_SMS_RATE_LIMITS={'default': 1000})
+    def test_sms_dispatchers_share_process_wide_rate_limiter(self):
+        """
+        Dispatchers of a process all go through the limiter set with set_sms_rate_limiter()
+        """
+        class Response(object):
+            def raise_for_status(self):
+                pass
+
+        call_times = []
+
+        def fake_get(url, **kwargs):
+            call_times.append(time.time())
+            return Response()
+
+        http_client_get = http_client.get
+        http_client.get = fake_get
+        set_sms_rate_limiter(SharedRateLimiter(20))
+        try:
+            dispatcher_list = [SMSDispatcher(label='ikwen', script_url='http://sms.test/?to=$recipient')
+                               for i in range(2)]
+            for dispatcher in dispatcher_list:
+                for i in range(5):
+                    dispatcher.submit('67700000%d' % i, 'Hello')
+            results = dispatcher_list[0].join() + dispatcher_list[1].join()
+        finally:
+            http_client.get = http_client_get
+            set_sms_rate_limiter(None)
+        self.assertTrue(all(result.sent for result in results))
+        self.assertEqual(len(call_times), 10)
+        self.assertGreaterEqual(max(call_times) - min(call_times), 9 / 20.0 - 0.05)
+
+    def test_sms_dispatcher_callback_gets_every_result(self):
+        """
+        The callback of an SMSDispatcher is called once with the SMSResult of each SMS, failed ones included
+        """
+        class Response(object):
+            def __init__(self, url):
+                self.url = url
+
+            def raise_for_status(self):
+                if '677000001' in self.url:
+                    raise ValueError("Rejected")
+
+        http_client_get = http_client.get
+        http_client.get = lambda url, **kwargs: Response(url)
+        failed_tags = []
+        try:
+            dispatcher = SMSDispatcher(label='ikwen', script_url='http://sms.test/?to=$recipient',
+                                       callback=lambda result: result.sent or failed_tags.append(result.tag))
+            for i in range(4):
+                dispatcher.submit('67700000%d' % i, 'Hello', tag=i)
+            results = dispatcher.join()
+        finally:
+            http_client.get = http_client_get
+        self.assertEqual(len(results), 4)
+        self.assertListEqual(failed_tags, [1])
+
+    def test_sms_template_render(self):
+        template = SMSTemplate('Hello $client, $unknown stays. $client again')
+        self.assertEqual(template.render(client='Roger'), 'Hello Roger, $unknown stays. Roger again')
+        self.assertEqual(SMSTemplate('No placeholder').render(client='Roger'), 'No placeholder')
+
+    def test_get_prefix_tokens(self):
+        tokens = get_prefix_tokens(u'Rod\xe9', 'Mbo', None, '677')
+        self.assertEqual(tokens, ['67', '677', 'mb', 'mbo', 'ro', 'rod', 'rode'])
+        self.assertEqual(len(get_prefix_tokens('a' * 30)), 14)
+
+    def test_keyset_cursor(self):
+        values = [datetime(2020, 1, 2, 3, 4, 5, 6), u'5f3a', 3]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+        self.assertRaises(InvalidCursor, decode_cursor, '@@@')
+        keyset = get_keyset_ordering(WatchObject, ('-total_val1', ))
+        self.assertEqual(keyset, [('total_val1', True), ('id', True)])
+        self.assertEqual(get_keyset_ordering(WatchObject, ('pk', )), [('id', False)])
+
+    def test_keyset_slice_with_ties(self):
+        """
+        Walking pages from cursor to cursor over an ordering with ties on its first fields
+        gives every object exactly once, in the order of the whole list
+        """
+        WatchObject.objects.all().delete()
+        for total_val1, total_val2 in [(3, 1), (3, 2), (3, 2), (2, 5), (2, 5), (2, 5), (1, 0)]:
+            WatchObject.objects.create(total_val1=total_val1, total_val2=total_val2)
+        keyset = get_keyset_ordering(WatchObject, ('-total_val1', 'total_val2'))
+        self.assertEqual(keyset, [('total_val1', True), ('total_val2', False), ('id', False)])
+        queryset = WatchObject.objects.order_by(*get_ordering_from_keyset(keyset))
+        expected = [obj.id for obj in queryset]
+
+        object_list, cursor = get_keyset_slice(queryset, keyset, 2)
+        id_list = [obj.id for obj in object_list]
+        while cursor:
+            object_list, cursor = get_keyset_slice(queryset, keyset, 2, cursor)
+            id_list.extend([obj.id for obj in object_list])
+        self.assertListEqual(id_list, expected)
+
+        for i, obj in enumerate(queryset):
+            after = filter_after_cursor(queryset, keyset, get_cursor(obj, keyset))
+            self.assertListEqual([obj.id for obj in after], expected[i + 1:])
+        self.assertRaises(InvalidCursor, filter_after_cursor, queryset, keyset, encode_cursor([3, 1]))
+        WatchObject.objects.all().delete()
+
+    def test_get_keyset_page_without_cursor(self):
+        """
+        Pages reached without cursor are fetched by skipping objects of previous pages,
+        and an invalid cursor falls back to the first page
+        """
+        WatchObject.objects.all().delete()
+        for total_val1 in [5, 4, 4, 3, 2]:
+            WatchObject.objects.create(total_val1=total_val1)
+        view = HybridListView()
+        view.ordering = ('-total_val1', )
+        view.page_size = 2
+        queryset = WatchObject.objects.all()
+        expected = [obj.id for obj in queryset.order_by('-total_val1', '-id')]
+
+        view.request = RequestFactory().get('/', {'page': 2})
+        page = view.get_keyset_page(queryset)
+        self.assertEqual(page.number, 2)
+        self.assertListEqual([obj.id for obj in page], expected[2:4])
+        self.assertTrue(page.has_next())
+
+        view.request = RequestFactory().get('/', {'page': 3, 'cursor': page.next_cursor})
+        page = view.get_keyset_page(queryset)
+        self.assertListEqual([obj.id for obj in page], expected[4:])
+        self.assertFalse(page.has_next())
+
+        view.request = RequestFactory().get('/', {'page': 9})
+        page = view.get_keyset_page(queryset)
+        self.assertEqual(page.number, 3)  # Last page, like Paginator on EmptyPage
+        self.assertListEqual([obj.id for obj in page], expected[4:])
+
+        view.request = RequestFactory().get('/', {'page': 3, 'cursor': '@@@'})
+        page = view.get_keyset_page(queryset)
+        self.assertEqual(page.number, 1)
+        self.assertListEqual([obj.id for obj in page], expected[:2])
+        WatchObject.objects.all().delete()
+
+    def test_get_facet_choices(self):
+        facet = [(None, 4), (False, 2), (True, 3)]
+        self.assertEqual([choice[0] for choice in get_facet_choices(models.BooleanField(), facet)],
+                         ['__true__', '__false__'])
+        facet = [('Cash', 2), ('MoMo', 5)]
+        self.assertEqual(get_facet_choices(models.CharField(), facet), [('Cash', 'Cash'), ('MoMo', 'MoMo')])
+        self.assertEqual(get_facet_choices(models.CharField(), [(None, 3)]), [])
+
+    def test_mail_campaign_render(self):
+        mail_campaign._templates['test_campaign.html'] = Template('<h1>{{ company_name }}</h1>{{ member_name }}: {{ message|safe }}')
+        config = type('Config', (object,), {'company_name': 'Ikwen & Co', 'logo': None})()
+        service = type('Service', (object,), {'project_name': 'Ikwen', 'basic_config': config})()
+        campaign = mail_campaign.MailCampaign('test_campaign.html', service=service, fields=('member_name', 'message'))
+        html = campaign.render(member_name='<Roger>', message=mark_safe('<b>Hi</b>'))
+        self.assertEqual(html, '<h1>Ikwen &amp; Co</h1>&lt;Roger&gt;: <b>Hi</b>')
+        self.assertEqual(campaign.render(member_name='Jane'), '<h1>Ikwen &amp; Co</h1>Jane: ')
+        del mail_campaign._templates['test_campaign.html']
+
     # def test_group_history_value_list(self):
     #     watch_object = init_watch_object()
     #     watch_object.val2_history = list(range(57))
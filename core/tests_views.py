@@ -18,6 +18,7 @@ from daraja.models import DarajaConfig
 from echo.models import Balance
 from ikwen.billing.models import Invoice, IkwenInvoiceItem, InvoiceEntry, SupportCode
 
+from ikwen.core.local_cache import get_service_cache_version
 from ikwen.core.models import Service, OperatorWallet
 
 from ikwen.core.utils import get_service_instance, add_database_to_settings
@@ -389,3 +390,20 @@ class IkwenCoreViewsTestCase(unittest.TestCase):
         bundle = TsunamiBundle.objects.get(pk='59531a009d34fc0c2aeb13d1')
         self.assertEqual(balance.sms_count, bundle.early_payment_sms_count)
         self.assertEqual(balance.mail_count, bundle.early_payment_mail_count)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b101', IS_IKWEN=False)
+    def test_service_and_config_saves_bump_service_cache_version_only_on_cached_changes(self):
+        service_id = '56eb6d04b37b3379b531b102'
+        version = get_service_cache_version(service_id)
+        service = Service.objects.get(pk=service_id)
+        service.total_turnover = (service.total_turnover or 0) + 1000
+        service.save()
+        self.assertEqual(get_service_cache_version(service_id), version)
+        service.project_name = 'Renamed project'
+        service.save()
+        self.assertNotEqual(get_service_cache_version(service_id), version)
+        version = get_service_cache_version(service_id)
+        config = service.config
+        config.company_name = 'Renamed company'
+        config.save()
+        self.assertNotEqual(get_service_cache_version(service_id), version)
@@ -12,15 +12,15 @@ from copy import deepcopy
 from datetime import datetime, timedelta, date
 
 import pymongo
-import requests
+from bson.objectid import ObjectId
 from PIL import Image
 from ajaxuploader.backends.local import LocalUploadBackend
 from django.conf import settings
 from django.contrib.admin import AdminSite
 from django.core.cache import cache
 from django.core.files import File
-from django.core.mail import EmailMessage
-from django.db import router
+from django.core.mail import EmailMessage, get_connection
+from django.db import router, connections
 from django.db.models import F, Model
 from django.db.models.fields.files import ImageFieldFile as DjangoImageFieldFile
 from django.db.models.loading import get_model
@@ -32,13 +32,16 @@ from django.utils.translation import ugettext as _
 from pymongo import MongoClient
 from pywebpush import webpush
 
+from ikwen.core import http_client
 from ikwen.conf import settings as ikwen_settings
 from ikwen.core.constants import PC, TABLET, MOBILE
-from ikwen.core.fields import ImageFieldFile, MultiImageFieldFile
+from ikwen.core.fields import ImageFieldFile, MultiImageFieldFile, HistoryRingBuffer
+from ikwen.core.local_cache import get_request_cache, get_two_tier, set_two_tier
 
 logger = logging.getLogger('ikwen')
 
 
+
 class XEmailMessage(EmailMessage):
     """
     Email message that is logged to the database
@@ -95,6 +98,8 @@ def to_dict(var):
             dict_var[key] = dict_var[key].strftime('%Y-%m-%d %H:%M:%S')
         elif type(dict_var[key]) is date:
             dict_var[key] = dict_var[key].strftime('%Y-%m-%d')
+        elif isinstance(dict_var[key], HistoryRingBuffer):
+            dict_var[key] = dict_var[key].to_list()
         elif type(dict_var[key]) is list:
             try:
                 dict_var[key] = [item.to_dict() for item in dict_var[key]]
@@ -139,15 +144,22 @@ def get_service_instance(using='default', check_cache=True):
     Gets the Service currently running on this website in the Service
     local database or from foundation database.
     @param using: database alias to search in
-    @param check_cache: if True, fetch from cache first
+    @param check_cache: if True, fetch from cache first. The Service is looked up in the
+        current request memo, then in the process-local cache, then in the shared cache.
+        See :mod:`ikwen.core.local_cache`
     """
     from ikwen.core.models import Service
     service_id = getattr(settings, 'IKWEN_SERVICE_ID')
     key = 'service:' + using
-    service = cache.get(key)
-    if not (check_cache and service):
+    request_cache = get_request_cache()
+    if check_cache and request_cache is not None and key in request_cache:
+        return request_cache[key]
+    service = get_two_tier(key, service_id) if check_cache else None
+    if service is None:
         service = Service.objects.using(using).select_related('member', 'app').get(pk=service_id)
-        cache.set(key, service, 3600)  # Cache service for 1 hour
+        set_two_tier(key, service, service_id, 3600)  # Cache service for 1 hour
+    if request_cache is not None:
+        request_cache[key] = service
     return service
 
 
@@ -210,11 +222,13 @@ def add_database(alias, engine='django_mongodb_engine'):
     add_database_to_settings(alias, engine=engine)
 
 
-def get_mail_content(subject, message=None, template_name='core/mails/notice.html', extra_context=None, service=None):
+def get_mail_context(subject, message=None, extra_context=None, service=None):
+    """
+    Returns the dict of variables available in mail templates
+    """
     if not service:
         service = get_service_instance()
     config = service.basic_config
-    html_template = get_template(template_name)
     from ikwen.conf.settings import MEDIA_URL
     context = {
         'subject': subject,
@@ -229,7 +243,12 @@ def get_mail_content(subject, message=None, template_name='core/mails/notice.htm
     }
     if extra_context:
         context.update(extra_context)
-    d = Context(context)
+    return context
+
+
+def get_mail_content(subject, message=None, template_name='core/mails/notice.html', extra_context=None, service=None):
+    html_template = get_template(template_name)
+    d = Context(get_mail_context(subject, message, extra_context, service))
     return html_template.render(d)
 
 
@@ -242,6 +261,67 @@ def get_sms_label(config):
     return label
 
 
+def build_sms_url(script_url, label, recipient, text):
+    """
+    Replaces $label, $recipient and $text in the SMS API *script_url*
+    """
+    return script_url.replace('$label', urlencode(label))\
+        .replace('$recipient', recipient)\
+        .replace('$text', urlencode(text))
+
+
+_smtp_slots = None  # Semaphore shared by processes of the revival and billing runners
+_sms_rate_limiter = None
+
+
+def set_smtp_slots(slots):
+    """
+    Sets the semaphore bounding the number of SMTP connections opened at the same
+    time by crons run in parallel. Without it, connections are not limited.
+    """
+    global _smtp_slots
+    _smtp_slots = slots
+
+
+def open_smtp_connection():
+    """
+    Waits for a free SMTP slot, then opens and returns a mail connection.
+    The slot is given back if the connection cannot be opened.
+    """
+    if _smtp_slots is not None:
+        _smtp_slots.acquire()
+    connection = get_connection()
+    try:
+        connection.open()
+    except:
+        if _smtp_slots is not None:
+            _smtp_slots.release()
+        raise
+    return connection
+
+
+def close_smtp_connection(connection):
+    try:
+        connection.close()
+    finally:
+        if _smtp_slots is not None:
+            _smtp_slots.release()
+
+
+def set_sms_rate_limiter(limiter):
+    """
+    Sets the limiter that send_sms() and :class:`ikwen.core.sms.SMSDispatcher` go through
+    before every SMS, like a :class:`ikwen.core.sms.SharedRateLimiter`. Without it, SMS are
+    only limited per dispatcher.
+    """
+    global _sms_rate_limiter
+    _sms_rate_limiter = limiter
+
+
+def get_sms_rate_limiter():
+    return _sms_rate_limiter
+
+
 def send_sms(recipient, text, label=None, script_url=None, fail_silently=True):
     # label is made of 10 first characters of company name without space
     if not (recipient and text):
@@ -252,18 +332,18 @@ def send_sms(recipient, text, label=None, script_url=None, fail_silently=True):
     if not script_url:
         script_url = config.sms_api_script_url
     if script_url:
-        url = script_url.replace('$label', urlencode(label))\
-            .replace('$recipient', recipient)\
-            .replace('$text', urlencode(text))
+        url = build_sms_url(script_url, label, recipient, text)
         base_url = url.split('?')[0]
+        if _sms_rate_limiter is not None:
+            _sms_rate_limiter.acquire()
         if fail_silently:
             try:
-                requests.get(url)
+                http_client.get(url)
                 logger.debug('SMS submitted to %s through %s' % (recipient, base_url))
             except:
                 logger.error('Failed to submit SMS to %s through %s' % (recipient, base_url), exc_info=True)
         else:
-            requests.get(url)
+            http_client.get(url)
             logger.debug('SMS submitted to %s through %s' % (recipient, base_url))
 
 
@@ -456,7 +536,24 @@ class DefaultUploadBackend(LocalUploadBackend):
             return resp
 
 
-def increment_history_field(watch_object, history_field, increment_value=1, index=None):
+def get_collection(model, using='default'):
+    """
+    Returns the raw pymongo Collection of *model* in the database *using*.
+    Use it for server side updates the Django ORM cannot express.
+    """
+    return connections[using].get_collection(model._meta.db_table)
+
+
+def get_mongo_query(queryset):
+    """
+    Returns the Mongo query dict that the Django ORM runs for *queryset*,
+    to be used as $match stage of raw aggregations.
+    """
+    compiler = queryset.query.get_compiler(queryset.db)
+    return compiler.build_query().mongo_query
+
+
+def increment_history_field(watch_object, history_field, increment_value=1, index=None, atomic=False):
     """
     Increments the value of the last element of Watch Object. Those are objects with *history* fields
     The matching *total field* (that is the field summing up the list of values since the creation of
@@ -466,10 +563,20 @@ def increment_history_field(watch_object, history_field, increment_value=1, inde
     :param history_field:
     :param increment_value:
     :param index:
+    :param atomic: if True, the increment is done server side with a Mongo $inc rather
+        than by saving the whole object. See :func:`increment_history_fields`
     :return:
     """
+    if atomic:
+        increment_history_fields(watch_object, {history_field: increment_value}, index=index)
+        return
     sequence = watch_object.__dict__[history_field]
-    if type(sequence) is list:  # This means that the sequence is an instance of a ListField
+    if isinstance(sequence, HistoryRingBuffer):  # Sequence is an instance of a HistoryField
+        if index is not None:
+            sequence[index] += increment_value
+            return
+        sequence.increment(increment_value)
+    elif type(sequence) is list:  # This means that the sequence is an instance of a ListField
         if index is not None:
             sequence[index] += increment_value
             return
@@ -492,6 +599,9 @@ def increment_history_field(watch_object, history_field, increment_value=1, inde
         pass
     db = router.db_for_write(watch_object.__class__, instance=watch_object)
     watch_object.save(using=db)
+    watch_object.__dict__.pop('_rollover_from', None)  # Rollover was saved together with the increment
+    days_ago = 0 if index is None else _get_days_ago(sequence, index)
+    _update_service_rollups(watch_object, {history_field: increment_value}, [db], days_ago)
 
 
 def increment_history_field_many(history_field, increment_value=1, index=None, *args, **kwargs):
@@ -499,6 +609,98 @@ def increment_history_field_many(history_field, increment_value=1, index=None, *
         increment_history_field(watch_object, history_field, increment_value)
 
 
+def increment_history_fields(watch_object, increments, index=None):
+    """
+    Atomically applies many increments to a Watch Object in a single round trip, without
+    fetching nor rewriting the document. Each history field gets a Mongo $inc on
+    *<history_field>.<position>* and the matching *total field* is $inc'ed as well.
+    The in-memory object is updated accordingly.
+
+    Position is the index of the element in history lists. In history fields stored as
+    :class:`ikwen.core.fields.HistoryRingBuffer`, it is the fixed position of the slot of
+    the day in the stored array, so concurrent increments never conflict either.
+
+    Eg: increment_history_fields(service, {'turnover_history': tx.amount, 'transaction_count_history': 1})
+
+    :param watch_object:
+    :param increments: dict mapping history fields to their increment value
+    :param index: index of the element to increment. Defaults to the last one
+    """
+    from ikwen.core.models import Service
+    db = router.db_for_write(watch_object.__class__, instance=watch_object)
+    db_list = [db]
+    if isinstance(watch_object, Service) and getattr(settings, 'IS_IKWEN', False) and db != watch_object.database:
+        # Replicate on the Service's own database just like Service.save() does
+        add_database(watch_object.database)
+        db_list.append(watch_object.database)
+    for alias in db_list:
+        persist_counters_rollover(watch_object, alias)
+    watch_object.__dict__.pop('_rollover_from', None)
+
+    inc, rollup_increments = {}, {}
+    days_ago = 0
+    for history_field, increment_value in increments.items():
+        sequence = watch_object.__dict__[history_field]
+        is_ring_buffer = isinstance(sequence, HistoryRingBuffer)
+        if not (type(sequence) is list or is_ring_buffer and len(sequence) > 0):
+            # Comma separated values in a string and empty ring buffers cannot be $inc'ed
+            increment_history_field(watch_object, history_field, increment_value, index)
+            continue
+        if index is not None:
+            days_ago = _get_days_ago(sequence, index)
+        rollup_increments[history_field] = increment_value
+        if is_ring_buffer:
+            i = -1 if index is None else index
+            sequence[i] += increment_value
+            i = sequence.get_storage_index(i)
+        elif index is not None:
+            i = index if index >= 0 else len(sequence) + index
+            sequence[index] += increment_value
+        elif len(sequence) >= 1:
+            i = len(sequence) - 1
+            sequence[-1] += increment_value
+        else:
+            i = 0
+            sequence.append(increment_value)
+        inc['%s.%d' % (history_field, i)] = increment_value
+        matching_total_field = 'total_' + history_field.replace('_history', '')
+        if matching_total_field in watch_object.__dict__:
+            watch_object.__dict__[matching_total_field] += increment_value
+            inc[matching_total_field] = increment_value
+
+    if inc:
+        for alias in db_list:
+            get_collection(watch_object.__class__, alias).update({'_id': ObjectId(watch_object.id)}, {'$inc': inc})
+    if rollup_increments:
+        _update_service_rollups(watch_object, rollup_increments, db_list, days_ago)
+
+
+def _get_days_ago(sequence, index):
+    """
+    Number of days between today and the day at *index* in the history *sequence*.
+    """
+    if index < 0:
+        return -index - 1
+    return len(sequence) - 1 - index
+
+
+def _update_service_rollups(watch_object, increments, db_list, days_ago=0):
+    """
+    Reports increments on a Service to its DashboardRollup in each database of *db_list*.
+    Failures are only logged as the rollups can always be rebuilt.
+    """
+    from ikwen.core.models import Service
+    from ikwen.core.rollups import update_rollup
+    if not isinstance(watch_object, Service):
+        return
+    for alias in db_list:
+        try:
+            update_rollup(watch_object, increments, alias, days_ago)
+        except:
+            logger.error("Could not update dashboard rollup of Service %s on %s" % (watch_object.id, alias),
+                         exc_info=True)
+
+
 def calculate_watch_info(history_value_list, duration=0):
     """
     Given a list representing an history of subsequent values of a certain info,
@@ -558,7 +760,7 @@ def get_value_list(csv_or_sequence):
     :param csv_or_sequence:
     :return:
     """
-    if type(csv_or_sequence) is list:
+    if type(csv_or_sequence) is list or isinstance(csv_or_sequence, HistoryRingBuffer):
         return csv_or_sequence
     return [float(val.strip()) for val in csv_or_sequence.split(',')]
 
@@ -642,38 +844,49 @@ def group_history_value_list(days_value_list, group_unit='month'):
         group_total += val
         ytd = ref - timedelta(days=1)
         if group_unit == 'month' and ytd.month != ref.month:
-            grouped_value_list.insert(0, group_total)
+            grouped_value_list.append(group_total)
             group_total = 0
         elif group_unit == 'week' and ytd.weekday() > ref.weekday():
-            grouped_value_list.insert(0, group_total)
+            grouped_value_list.append(group_total)
             group_total = 0
         ref = ytd
+    grouped_value_list.reverse()
     return grouped_value_list
 
 
 def set_counters(watch_object, *args, **kwargs):
+    """
+    Rolls the history fields of a Watch Object over to the current day by padding
+    them with zeros for each day elapsed since *counters_reset_on*.
+
+    The rollover is done in memory only, so that read paths (dashboards, reports, etc.)
+    do not write. It reaches the database along with the next increment: either through
+    the save() of :func:`increment_history_field` or, in atomic mode, through
+    :func:`persist_counters_rollover`.
+    """
     now = timezone.now()
     last_reset = watch_object.counters_reset_on
     history_fields = [field for field in watch_object.__dict__.keys() if field.endswith('_history')]
-    db = router.db_for_write(watch_object.__class__, instance=watch_object)
     if last_reset:
         diff = now - last_reset
         gap = diff.days
         if diff.days == 0:
             if now.day == last_reset.day:
                 for field in history_fields:
-                    if type(watch_object.__dict__[field]) is list:
+                    if type(watch_object.__dict__[field]) is list or \
+                            isinstance(watch_object.__dict__[field], HistoryRingBuffer):
                         if len(watch_object.__dict__[field]) == 0:
                             watch_object.__dict__[field].append(0)
                     else:
                         if not watch_object.__dict__[field]:
                             watch_object.__dict__[field] = '0'
-                watch_object.save(using=db)
                 return
             else:
                 gap = 1
         for field in history_fields:
-            if type(watch_object.__dict__[field]) is list:
+            if isinstance(watch_object.__dict__[field], HistoryRingBuffer):
+                watch_object.__dict__[field].roll(gap)
+            elif type(watch_object.__dict__[field]) is list:
                 extension = [0 for i in range(gap)]
                 watch_object.__dict__[field].extend(extension)
                 watch_object.__dict__[field] = watch_object.__dict__[field][-366:]
@@ -684,12 +897,50 @@ def set_counters(watch_object, *args, **kwargs):
                 watch_object.__dict__[field] = ','.join(res)
     else:
         for field in history_fields:
-            if type(watch_object.__dict__[field]) is list:
+            if type(watch_object.__dict__[field]) is list or \
+                    isinstance(watch_object.__dict__[field], HistoryRingBuffer):
                 watch_object.__dict__[field].append(0)
             else:
                 watch_object.__dict__[field] = '0'
+    if '_rollover_from' not in watch_object.__dict__:
+        # Keep the stored value to later persist the rollover only if nobody else did
+        watch_object._rollover_from = last_reset
     watch_object.counters_reset_on = timezone.now()
-    watch_object.save(using=db)
+
+
+def persist_counters_rollover(watch_object, using=None):
+    """
+    Writes to the database the rollover done in memory by :func:`set_counters`.
+    The write is conditioned on *counters_reset_on* being unchanged in the database, so
+    that concurrent rollovers are applied only once. If another process rolled first,
+    history fields of *watch_object* are reloaded from the database.
+
+    A day already rolled in the database is remembered in cache, so that subsequent
+    increments of the day skip the write entirely.
+    """
+    if '_rollover_from' not in watch_object.__dict__:
+        return
+    primary = router.db_for_write(watch_object.__class__, instance=watch_object)
+    if not using:
+        using = primary
+    rollover_from = watch_object.__dict__['_rollover_from']
+    cache_key = 'counters_rolled_on:%s:%s:%s' % (using, watch_object._meta.db_table, watch_object.id)
+    today = timezone.now().date().toordinal()
+    if cache.get(cache_key) == today:
+        return
+    history_fields = [field for field in watch_object.__dict__.keys() if field.endswith('_history')]
+    values = {'counters_reset_on': watch_object.counters_reset_on}
+    for field in history_fields:
+        value = watch_object.__dict__[field]
+        values[field] = value.to_storage() if isinstance(value, HistoryRingBuffer) else value
+    collection = get_collection(watch_object.__class__, using)
+    _id = ObjectId(watch_object.id)
+    result = collection.update({'_id': _id, 'counters_reset_on': rollover_from}, {'$set': values})
+    if not (result and result.get('n')) and using == primary:
+        doc = collection.find_one({'_id': _id}, dict((field, 1) for field in history_fields))
+        for field in history_fields:
+            watch_object.__dict__[field] = watch_object._meta.get_field(field).to_python(doc.get(field))
+    cache.set(cache_key, today, 24 * 3600)
 
 
 def clear_counters(watch_object):
@@ -699,7 +950,9 @@ def clear_counters(watch_object):
     history_fields = [field for field in watch_object.__dict__.keys() if field.endswith('_history')]
     db = router.db_for_write(watch_object.__class__, instance=watch_object)
     for field in history_fields:
-        if type(watch_object.__dict__[field]) is list:
+        if isinstance(watch_object.__dict__[field], HistoryRingBuffer):
+            watch_object.__dict__[field].clear()
+        elif type(watch_object.__dict__[field]) is list:
             watch_object.__dict__[field] = []
         else:
             watch_object.__dict__[field] = ''
@@ -753,15 +1006,10 @@ def add_event(service, codename, member=None, group_id=None, object_id=None, mod
     if member:
         member = Member.objects.using(UMBRELLA).get(pk=member.id)
         Member.objects.using(UMBRELLA).filter(pk=member.id).update(personal_notices=F('personal_notices')+1)
-    elif group_id:
-        add_database_to_settings(service.database)
-        for m in Member.objects.using(service.database).all():
-            if group_id in m.group_fk_list:
-                Member.objects.using(UMBRELLA).filter(pk=m.id).update(personal_notices=F('personal_notices') + 1)
     else:
         add_database_to_settings(service.database)
-        for m in Member.objects.using(service.database).all():
-            Member.objects.using(UMBRELLA).filter(pk=m.id).update(personal_notices=F('personal_notices') + 1)
+        spec = {'group_fk_list': group_id} if group_id else {}
+        increment_personal_notices(service.database, spec)
     try:
         event_type = ConsoleEventType.objects.using(UMBRELLA).get(app=service.app, codename=codename)
     except ConsoleEventType.DoesNotExist:
@@ -776,6 +1024,33 @@ def add_event(service, codename, member=None, group_id=None, object_id=None, mod
     return event
 
 
+def increment_personal_notices(using, spec=None, batch_size=1000):
+    """
+    Increments personal_notices in UMBRELLA of all Members found in database *using*
+    and matching the raw Mongo *spec*. Only ids are fetched, then a single $inc is
+    issued per batch of *batch_size* Members, rather than one update per Member.
+
+    :param using: database where to look for Members, generally the database of a Service
+    :param spec: Mongo query on Members. Eg: {'group_fk_list': group_id} for Members of a group
+    :return: Number of Members updated
+    """
+    from ikwen.accesscontrol.backends import UMBRELLA
+    from ikwen.accesscontrol.models import Member
+    umbrella_collection = get_collection(Member, UMBRELLA)
+    cursor = get_collection(Member, using).find(spec or {}, {'_id': 1}).batch_size(batch_size)
+    count, batch = 0, []
+    for doc in cursor:
+        batch.append(doc['_id'])
+        if len(batch) >= batch_size:
+            umbrella_collection.update({'_id': {'$in': batch}}, {'$inc': {'personal_notices': 1}}, multi=True)
+            count += len(batch)
+            batch = []
+    if batch:
+        umbrella_collection.update({'_id': {'$in': batch}}, {'$inc': {'personal_notices': 1}}, multi=True)
+        count += len(batch)
+    return count
+
+
 def render_event(event, request):
     """
     Default event renderer
@@ -3,9 +3,7 @@ import json
 import logging
 from datetime import datetime, timedelta
 from threading import Thread
-from time import strptime
 
-import requests
 from ajaxuploader.views import AjaxFileUploader
 from currencies.models import Currency
 from django.conf import settings
@@ -24,18 +22,21 @@ from django.views.decorators.cache import cache_page
 from django.views.generic.base import TemplateView
 
 import ikwen.conf.settings
+from ikwen.core import http_client
 from ikwen.core.templatetags.url_utils import strip_base_alias
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.accesscontrol.models import Member, ACCESS_REQUEST_EVENT, OwnershipTransfer
 from ikwen.billing.models import Invoice, SupportCode
 from ikwen.billing.utils import get_invoicing_config_instance, get_billing_cycle_days_count, \
     get_billing_cycle_months_count, refresh_currencies_exchange_rates
-from ikwen.cashout.models import CashOutRequest
 from ikwen.core.generic import HybridListView, ChangeObjectBase, CustomizationImageUploadBackend
 from ikwen.core.models import Service, QueuedSMS, ConsoleEventType, ConsoleEvent, Country, \
     OperatorWallet, XEmailObject
+from ikwen.core.rollups import get_rollup, get_rollup_history, get_rollup_report, get_last_cash_out, \
+    refresh_rollup_wallets
+from ikwen.core.sms import claim_queued_sms, purge_dispatched_sms
 from ikwen.core.utils import get_service_instance, DefaultUploadBackend, add_database_to_settings, \
-    add_database, calculate_watch_info, set_counters, get_mail_content
+    add_database, set_counters, get_mail_content
 from ikwen.rewarding.models import CROperatorProfile
 
 try:
@@ -200,9 +201,9 @@ def get_queued_sms(request, *args, **kwargs):
     if not user.check_password(password):
         response = {'error': 'E-mail or password not found.'}
     else:
-        qs = QueuedSMS.objects.all()[:qty]
-        response = [sms.to_dict() for sms in qs]
-        qs.delete()
+        sms_list = claim_queued_sms(int(qty), puller=email)
+        response = [sms.to_dict() for sms in sms_list]
+        purge_dispatched_sms()
     return HttpResponse(json.dumps(response), 'content-type: text/json')
 
 
@@ -375,7 +376,8 @@ def get_location_by_ip(request, *args, **kwargs):
         else:
             ip = request.META['REMOTE_ADDR']
         from ikwen.conf import settings as ikwen_settings
-        r = requests.get('http://api.ipstack.com/%s?access_key=%s' % (ip, ikwen_settings.IP_STACK_API_KEY))
+        r = http_client.get('http://api.ipstack.com/%s?access_key=%s' % (ip, ikwen_settings.IP_STACK_API_KEY),
+                            idempotent=True)
         result = json.loads(r.content.decode('utf-8'))
         country = Country.objects.get(iso2=result['country_code'])
         city = result['city']
@@ -401,23 +403,27 @@ class DashboardBase(TemplateView):
     def get_context_data(self, **kwargs):
         context = super(DashboardBase, self).get_context_data(**kwargs)
         service = self.get_service(**kwargs)
-        set_counters(service)
-        earnings_today = calculate_watch_info(service.earnings_history)
-        earnings_yesterday = calculate_watch_info(service.earnings_history, 1)
-        earnings_last_week = calculate_watch_info(service.earnings_history, 7)
-        earnings_last_28_days = calculate_watch_info(service.earnings_history, 28)
-
-        earnings_report = {
-            'today': earnings_today,
-            'yesterday': earnings_yesterday,
-            'last_week': earnings_last_week,
-            'last_28_days': earnings_last_28_days
-        }
-
-        tx_count_today = calculate_watch_info(service.transaction_count_history)
-        tx_count_yesterday = calculate_watch_info(service.transaction_count_history, 1)
-        tx_count_last_week = calculate_watch_info(service.transaction_count_history, 7)
-        tx_count_last_28_days = calculate_watch_info(service.transaction_count_history, 28)
+        rollup = get_rollup(service)
+        if rollup:
+            earnings_history = get_rollup_history(rollup, 'earnings')
+            transaction_count_history = get_rollup_history(rollup, 'transaction_count')
+        else:
+            # No rollup yet for this service. See rebuild_dashboard_rollups management command.
+            set_counters(service)
+            earnings_history = service.earnings_history
+            transaction_count_history = service.transaction_count_history
+
+        earnings_report = get_rollup_report(earnings_history)
+        earnings_today = earnings_report['today']
+        earnings_yesterday = earnings_report['yesterday']
+        earnings_last_week = earnings_report['last_week']
+        earnings_last_28_days = earnings_report['last_28_days']
+
+        tx_count_report = get_rollup_report(transaction_count_history)
+        tx_count_today = tx_count_report['today']
+        tx_count_yesterday = tx_count_report['yesterday']
+        tx_count_last_week = tx_count_report['last_week']
+        tx_count_last_28_days = tx_count_report['last_28_days']
 
         # AEPT stands for Average Earning Per Transaction
         aept_today = earnings_today['total'] / tx_count_today['total'] if tx_count_today['total'] else 0
@@ -447,31 +453,30 @@ class DashboardBase(TemplateView):
             }
         }
 
-        qs = CashOutRequest.objects.using('wallets').filter(service_id=service.id, status=CashOutRequest.PAID).order_by('-id')
-        last_cash_out = qs[0] if qs.count() >= 1 else None
-        if last_cash_out:
-            # Re-transform created_on into a datetime object
+        if rollup and rollup.get('balance') is None:
+            # Balance is dropped from the rollup whenever a wallet changes. See Service.raise_balance()
+            refresh_rollup_wallets(service)
+            rollup = get_rollup(service)
+        if rollup and rollup.get('balance') is not None:
+            last_cash_out = rollup.get('last_cash_out')
+            context['balance'] = rollup['balance']
+        else:
+            last_cash_out = get_last_cash_out(service)
             try:
-                last_cash_out.created_on = datetime(*strptime(last_cash_out.created_on[:19], '%Y-%m-%d %H:%M:%S')[:6])
-            except TypeError:
+                balance = 0
+                for wallet in OperatorWallet.objects.using('wallets').filter(nonrel_id=service.id):
+                    balance += wallet.balance
+                context['balance'] = balance
+            except:
                 pass
-            if last_cash_out.amount_paid:
-                last_cash_out.amount = last_cash_out.amount_paid
-        try:
-            balance = 0
-            for wallet in OperatorWallet.objects.using('wallets').filter(nonrel_id=service.id):
-                balance += wallet.balance
-            context['balance'] = balance
-        except:
-            pass
         context['earnings_report'] = earnings_report
         context['transactions_report'] = transactions_report
         context['transactions_count_title'] = self.transactions_count_title
         context['transactions_avg_revenue_title'] = self.transactions_avg_revenue_title
         context['last_cash_out'] = last_cash_out
-        context['earnings_history'] = service.earnings_history[-30:]
-        context['earnings_history_previous_month'] = service.earnings_history[-60:-30]
-        context['transaction_count_history'] = service.transaction_count_history[-30:]
+        context['earnings_history'] = earnings_history[-30:]
+        context['earnings_history_previous_month'] = earnings_history[-60:-30]
+        context['transaction_count_history'] = transaction_count_history[-30:]
         context['CRNCY'] = Currency.active.base()
         return context
 
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized reporting on Watch Objects. History values of N objects are stacked
+in a single N x days NumPy matrix, the last column being today. Period sums,
+change rates, rankings and month/week grouping are then computed for all
+objects at once instead of looping over each history list in Python.
+
+Results follow the semantics of :func:`ikwen.core.utils.calculate_watch_info`,
+:func:`ikwen.core.utils.rank_watch_objects` and :func:`ikwen.core.utils.group_history_value_list`.
+"""
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.utils import timezone
+
+from ikwen.core.fields import HistoryRingBuffer
+from ikwen.core.utils import get_value_list, calculate_watch_info, rank_watch_objects, group_history_value_list
+
+
+def history_as_array(value):
+    """
+    Returns history values of a *history* field as a 1-D array, oldest first. A
+    :class:`HistoryRingBuffer` is read directly from its buffer without copying to a list.
+    """
+    if isinstance(value, HistoryRingBuffer):
+        if not value.length:
+            return np.zeros(0)
+        data = np.frombuffer(value.data, dtype=np.float64)
+        return np.roll(data, -(value.head + 1))[-value.length:]
+    if not value:
+        return np.zeros(0)
+    return np.asarray(get_value_list(value), dtype=np.float64)
+
+
+class RankedWatchObject(object):
+    """
+    Lightweight view of a Watch Object carrying the *total* on which it was ranked.
+    Any other attribute is read from the wrapped object, so it can be used in
+    templates just like the deep copies returned by rank_watch_objects().
+    """
+    def __init__(self, watch_object, total):
+        self.watch_object = watch_object
+        self.total = total
+
+    def __getattr__(self, item):
+        return getattr(self.watch_object, item)
+
+
+class WatchMatrix(object):
+    """
+    History values of a list of Watch Objects stacked into a 2-D matrix. Rows are
+    objects, columns are days, and shorter histories are padded with zeros on the left.
+
+    :attr:`lengths` keeps the actual length of each history, needed to tell whether
+    there are enough values to compare a period to the previous one.
+    """
+    def __init__(self, watch_object_list, history_field, width=HistoryRingBuffer.CAPACITY):
+        self.object_list = list(watch_object_list)
+        self.history_field = history_field
+        self.matrix = np.zeros((len(self.object_list), width))
+        self.lengths = np.zeros(len(self.object_list), dtype=np.int64)
+        for i, watch_object in enumerate(self.object_list):
+            row = history_as_array(watch_object.__dict__[history_field])[-width:]
+            if len(row):
+                self.matrix[i, width - len(row):] = row
+            self.lengths[i] = len(row)
+
+    def totals(self, duration=0):
+        """
+        Sum of values of each object on the *duration* previous days, today not included.
+        Duration 0 means today only.
+        """
+        if duration == 0:
+            return self.matrix[:, -1].copy()
+        if duration == 1:
+            return self.matrix[:, -2].copy()
+        return self.matrix[:, -(duration + 1):-1].sum(axis=1)
+
+    def watch_info(self, duration=0):
+        """
+        Vectorized version of calculate_watch_info(). Returns a dict of arrays
+        'total', 'change' and 'change_rate'. Values calculate_watch_info()
+        would set to None are NaN here.
+        """
+        count = len(self.object_list)
+        total = self.totals(duration)
+        if duration == 0:
+            return {'total': total, 'change': np.full(count, np.nan), 'change_rate': np.full(count, np.nan)}
+        past_length = self.lengths - 1  # Strip the last value as it represents today
+        if duration == 1:  # When duration is a day, we compare to the same day of the previous week.
+            total_0 = self.matrix[:, -9] if self.matrix.shape[1] >= 9 else np.zeros(count)
+            has_previous = past_length >= 8
+        else:
+            total_0 = self.matrix[:, -(duration * 2 + 1):-(duration + 1)].sum(axis=1)
+            has_previous = past_length >= duration * 2
+        change = total - total_0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change_rate = np.where(total_0 == 0, np.where(total == 0, 0, 100), change / total_0 * 100)
+        return {
+            'total': total,
+            'change': np.where(has_previous, change, np.nan),
+            'change_rate': np.where(has_previous, change_rate, np.nan)
+        }
+
+    def rank(self, duration=0, top=None):
+        """
+        Vectorized version of rank_watch_objects(). Objects are returned as
+        :class:`RankedWatchObject`, best first, so the original objects are neither
+        copied nor modified. If *top* is set, only the *top* best are returned.
+        """
+        totals = self.totals(duration)
+        if top and top < len(totals):
+            candidates = np.argpartition(-totals, top - 1)[:top]
+            order = candidates[np.lexsort((candidates, -totals[candidates]))]
+        else:
+            order = np.argsort(-totals, kind='mergesort')
+        return [RankedWatchObject(self.object_list[i], float(totals[i])) for i in order]
+
+    def group(self, group_unit='month', ref=None):
+        """
+        Vectorized version of group_history_value_list(). Sums days values by calendar
+        month or week (Monday to Sunday) and returns, for each object, the array of its
+        groups, oldest first. Like group_history_value_list(), only groups starting within
+        the actual history of an object are kept, so the oldest group is dropped if it is
+        incomplete and shorter histories have fewer groups.
+        """
+        if ref is None:
+            ref = timezone.now()
+        count = len(self.object_list)
+        width = self.matrix.shape[1]
+        days = [ref - timedelta(days=width - 1 - j) for j in range(width)]
+        if group_unit == 'week':
+            is_period_start = np.array([day.weekday() == 0 for day in days])
+        else:
+            is_period_start = np.array([day.day == 1 for day in days])
+        period_starts = np.flatnonzero(is_period_start)
+        if len(period_starts) == 0:
+            return [np.zeros(0) for i in range(count)]
+        starts = period_starts if period_starts[0] == 0 else np.concatenate(([0], period_starts))
+        grouped = np.add.reduceat(self.matrix, starts, axis=1)
+        if period_starts[0] != 0:
+            grouped = grouped[:, 1:]  # Group of days before the first period start
+        # Index of the first group starting within the actual history of each object
+        first_groups = np.searchsorted(period_starts, width - self.lengths)
+        return [grouped[i, first_groups[i]:] for i in range(count)]
+
+
+def benchmark(count=10000, days=366, durations=(0, 1, 7, 28)):
+    """
+    Times the pure Python reporting functions of ikwen.core.utils against
+    :class:`WatchMatrix` on *count* objects having *days* of history each.
+    Returns a dict of durations in seconds.
+    """
+    class _WatchObject(object):
+        def __init__(self, history):
+            self.earnings_history = history
+
+    rng = np.random.RandomState(0)
+    object_list = [_WatchObject(rng.randint(0, 50000, days).tolist()) for i in range(count)]
+    report = {}
+
+    t0 = time.time()
+    for duration in durations:
+        for watch_object in object_list:
+            calculate_watch_info(watch_object.earnings_history, duration)
+        rank_watch_objects(object_list, 'earnings_history', duration)
+    for watch_object in object_list:
+        group_history_value_list(watch_object.earnings_history)
+    report['python'] = time.time() - t0
+
+    t0 = time.time()
+    watch_matrix = WatchMatrix(object_list, 'earnings_history', days)
+    report['numpy_stacking'] = time.time() - t0
+    for duration in durations:
+        watch_matrix.watch_info(duration)
+        watch_matrix.rank(duration)
+    watch_matrix.group()
+    report['numpy'] = time.time() - t0
+    return report
+
+
+if __name__ == '__main__':
+    import sys
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 366
+    report = benchmark(count, days)
+    print("%d objects x %d days" % (count, days))
+    print("Pure Python: %.3fs" % report['python'])
+    print("NumPy:       %.3fs (stacking: %.3fs)" % (report['numpy'], report['numpy_stacking']))
@@ -16,7 +16,8 @@ from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.accesscontrol.models import Member
 from ikwen.billing.models import CloudBillingPlan, IkwenInvoiceItem, InvoiceEntry
 from ikwen.core.models import Application, Service
-from ikwen.core.utils import get_service_instance, set_counters, calculate_watch_info, rank_watch_objects
+from ikwen.core.utils import get_service_instance, set_counters, calculate_watch_info
+from ikwen.core.watch_analytics import WatchMatrix
 from ikwen.core.views import HybridListView, DashboardBase
 from ikwen.partnership.cloud_setup import deploy, DeploymentForm
 from ikwen.partnership.forms import ChangeServiceForm
@@ -98,20 +99,22 @@ class Dashboard(DashboardBase):
         customers = list(Service.objects.all())
         for customer in customers:
             set_counters(customer)
+        customers_matrix = WatchMatrix(customers, 'earnings_history')
         customers_report = {
-            'today': rank_watch_objects(customers, 'earnings_history'),
-            'yesterday': rank_watch_objects(customers, 'earnings_history', 1),
-            'last_week': rank_watch_objects(customers, 'earnings_history', 7),
-            'last_28_days': rank_watch_objects(customers, 'earnings_history', 28)
+            'today': customers_matrix.rank(),
+            'yesterday': customers_matrix.rank(1),
+            'last_week': customers_matrix.rank(7),
+            'last_28_days': customers_matrix.rank(28)
         }
         apps = list(Application.objects.all())
         for app in apps:
             set_counters(app)
+        apps_matrix = WatchMatrix(apps, 'earnings_history')
         apps_report = {
-            'today': rank_watch_objects(apps, 'earnings_history'),
-            'yesterday': rank_watch_objects(apps, 'earnings_history', 1),
-            'last_week': rank_watch_objects(apps, 'earnings_history', 7),
-            'last_28_days': rank_watch_objects(apps, 'earnings_history', 28)
+            'today': apps_matrix.rank(),
+            'yesterday': apps_matrix.rank(1),
+            'last_week': apps_matrix.rank(7),
+            'last_28_days': apps_matrix.rank(28)
         }
         context['customers_report'] = customers_report
         context['apps_report'] = apps_report
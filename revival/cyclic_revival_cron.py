@@ -5,8 +5,6 @@ import sys
 import logging
 from datetime import datetime
 
-from core.models import XEmailObject
-
 sys.path.append("/home/libran/virtualenv/lib/python2.7/site-packages")
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ikwen.conf.settings")
@@ -14,8 +12,7 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ikwen.conf.settings")
 from currencies.models import Currency
 
 from django.conf import settings
-from django.core import mail
-from django.db import transaction
+from django.utils.safestring import mark_safe
 from django.utils.translation import activate
 
 from echo.models import Balance, SMSObject
@@ -24,9 +21,13 @@ from echo.utils import notify_for_empty_messaging_credit, LOW_MAIL_LIMIT, LOW_SM
 from ikwen.conf.settings import WALLETS_DB_ALIAS
 from ikwen.accesscontrol.models import Member
 from ikwen.core.models import XEmailObject
-from ikwen.core.utils import add_database, get_mail_content, send_sms, get_sms_label, set_counters, \
-    increment_history_field, XEmailMessage
+from ikwen.core.mail_campaign import MailCampaign
+from ikwen.core.messaging_credit import CreditReservation, MAIL_CREDIT, SMS_CREDIT
+from ikwen.core.sms import SMSDispatcher, SMSTemplate
+from ikwen.core.utils import add_database, get_sms_label, set_counters, \
+    increment_history_field, XEmailMessage, open_smtp_connection, close_smtp_connection
 from ikwen.revival.models import MemberProfile, CyclicRevival, CyclicTarget, ProfileTag
+from ikwen.revival.utils import claim_revival
 from ikwen_kakocase.kako.models import Product
 
 from ikwen.core.log import CRONS_LOGGING
@@ -36,23 +37,23 @@ logger = logging.getLogger('ikwen.crons')
 MAX_BATCH_SEND = 500
 
 
-def notify_profiles(debug=False):
+def notify_profiles(debug=False, service_id=None):
+    """
+    Runs cyclic revivals due at the current hour.
+    :param service_id: If set, only revivals of this Service are run
+    """
     t0 = datetime.now()
     total_revival, total_mail, total_sms = 0, 0, 0
     logger.debug("Starting cyclic revival")
     today = t0.date()
     queryset = CyclicRevival.objects.select_related('service')\
         .filter(next_run_on=today, hour_of_sending=t0.hour, end_on__gt=today, is_active=True)
+    if service_id:
+        queryset = queryset.filter(service=service_id)
     for revival in queryset:
-        try:
-            refreshed = CyclicRevival.objects.get(pk=revival.id)
-            if refreshed.is_running:
-                continue
-            refreshed.is_running = True
-            refreshed.save()
-            total_revival += 1
-        except CyclicRevival.DoesNotExist:
+        if not claim_revival(revival):
             continue
+        total_revival += 1
         service = revival.service
         db = service.database
         add_database(db)
@@ -74,6 +75,9 @@ def notify_profiles(debug=False):
                 logger.error("Failed to notify %s for low messaging credit." % service, exc_info=True)
 
         label = get_sms_label(service.config)
+        sms_dispatcher = SMSDispatcher(label=label)
+        if revival.sms_text:
+            sms_template = SMSTemplate(revival.sms_text)
         notified_empty_mail_credit = False
         notified_empty_sms_credit = False
         if debug:
@@ -104,22 +108,14 @@ def notify_profiles(debug=False):
                         CyclicTarget.objects.using(db).get_or_create(revival=revival_local, member=member)
         revival.set_next_run_date()
 
-        connection = mail.get_connection()
         try:
-            connection.open()
+            connection = open_smtp_connection()
         except:
+            revival.is_running = False
+            revival.save()
             logger.error(u"Connexion error", exc_info=True)
             break
-
-        logger.debug("Running revival %s for %s" % (revival.mail_subject, revival.service))
-        for target in revival_local.cyclictarget_set.select_related('member'):
-            member = target.member
-            if member.language:
-                activate(member.language)
-            else:
-                activate('en')
-            subject = revival.mail_subject
-            message = revival.mail_content.replace('$client', member.first_name)
+        try:
             sender = '%s <no-reply@%s>' % (service.project_name, service.domain)
             try:
                 currency = Currency.objects.using(using=db).get(is_base=True)
@@ -127,69 +123,93 @@ def notify_profiles(debug=False):
                 currency = None
             product_list = []
             if service.app.slug == 'kakocase':
-                product_list = Product.objects.using(db).filter(pk__in=revival.items_fk_list)
+                product_list = list(Product.objects.using(db).filter(pk__in=revival.items_fk_list))
             extra_context = {
                 'revival': revival,
                 'currency': currency,
                 'media_url': getattr(settings, 'CLUSTER_MEDIA_URL') + service.project_name_slug + '/',
                 'product_list': product_list
             }
+            mail_credit = CreditReservation(service, MAIL_CREDIT, balance=balance)
+            sms_credit = CreditReservation(service, SMS_CREDIT, balance=balance)
             try:
-                html_content = get_mail_content(subject, message, template_name='revival/mails/default.html',
-                                                service=service, extra_context=extra_context)
-            except:
-                logger.error("Could not render mail for member %s, Cyclic revival on %s" % (member.username, profile_tag), exc_info=True)
-                break
-            msg = XEmailMessage(subject, html_content, sender, [member.email])
-            msg.content_subtype = "html"
-            msg.type = XEmailObject.REVIVAL
-
-            if balance.mail_count == 0 and not notified_empty_mail_credit:
-                notify_for_empty_messaging_credit(service, balance)
-                notified_empty_mail_credit = True
-            else:
-                try:
-                    with transaction.atomic(using=WALLETS_DB_ALIAS):
-                        if not debug:
-                            balance.mail_count -= 1
-                            balance.save()
-                        if msg.send():
-                            target.revival_count += 1
-                            target.save()
+                mail_campaign = MailCampaign('revival/mails/default.html', revival.mail_subject, service=service,
+                                             extra_context=extra_context, fields=('message',))
+
+                logger.debug("Running revival %s for %s" % (revival.mail_subject, revival.service))
+                for target in revival_local.cyclictarget_set.select_related('member'):
+                    member = target.member
+                    if member.language:
+                        activate(member.language)
+                    else:
+                        activate('en')
+                    subject = revival.mail_subject
+                    message = revival.mail_content.replace('$client', member.first_name)
+                    try:
+                        html_content = mail_campaign.render(message=mark_safe(message))
+                    except:
+                        logger.error("Could not render mail for member %s, Cyclic revival on %s" % (member.username, profile_tag), exc_info=True)
+                        break
+                    msg = XEmailMessage(subject, html_content, sender, [member.email], connection=connection)
+                    msg.content_subtype = "html"
+                    msg.type = XEmailObject.REVIVAL
+
+                    if not debug and not mail_credit.ensure():
+                        if not notified_empty_mail_credit:
+                            notify_for_empty_messaging_credit(service, balance)
+                            notified_empty_mail_credit = True
+                    else:
+                        charged = not debug and mail_credit.consume()
+                        try:
+                            sent = msg.send()
+                        except:
+                            sent = False
+                        if sent:
                             total_mail += 1
-                            increment_history_field(profile_tag, 'cyclic_revival_mail_history')
+                            try:
+                                target.revival_count += 1
+                                target.save()
+                                increment_history_field(profile_tag, 'cyclic_revival_mail_history')
+                            except:
+                                logger.error("Mail sent but not recorded for member %s" % member.email, exc_info=True)
                         else:
+                            if charged:
+                                mail_credit.refund()
                             logger.error("Cyclic revival with subject %s not sent for member %s" % (subject, member.email),
-                                     exc_info=True)
-                except:
-                    logger.error("Critical error in revival %s when processing Mail sending for member %s" % (revival.id, member.email),
-                                 exc_info=True)
-            if revival.sms_text:
-                if balance.sms_count == 0 and not notified_empty_sms_credit:
-                    notify_for_empty_messaging_credit(service, balance)
-                    notified_empty_sms_credit = True
-                else:
-                    sms_text = revival.sms_text.replace('$client', member.first_name)
-                    page_count = count_pages(sms_text)
-                    try:
-                        with transaction.atomic(using=WALLETS_DB_ALIAS):
-                            balance.sms_count -= page_count
-                            balance.save()
-                            send_sms(recipient=member.phone, text=sms_text, fail_silently=False)
-                            total_sms += 1
-                            increment_history_field(profile_tag, 'cyclic_revival_sms_history')
-                            SMSObject.objects.create(recipient=member.phone, text=sms_text, label=label)
-                    except:
-                        logger.error("Critical error in revival %s when processing SMS sending for member %s" % (revival.id, member.email),
-                                     exc_info=True)
-            if balance.mail_count == 0 and balance.sms_count == 0:
-                break
-        revival.is_running = False
-        revival.save()
-        try:
-            connection.close()
-        except:
-            pass
+                                         exc_info=True)
+                    if revival.sms_text and member.phone:
+                        sms_text = sms_template.render(client=member.first_name)
+                        page_count = count_pages(sms_text)
+                        if not sms_credit.consume(page_count):
+                            if not notified_empty_sms_credit:
+                                notify_for_empty_messaging_credit(service, balance)
+                                notified_empty_sms_credit = True
+                        else:
+                            # Credit is refunded below if the SMS eventually fails
+                            sms_dispatcher.submit(member.phone, sms_text, tag=page_count)
+                    if not mail_credit.ensure() and not sms_credit.ensure():
+                        break
+                sms_sent = 0
+                for result in sms_dispatcher.join():
+                    if result.sent:
+                        sms_sent += 1
+                        SMSObject.objects.create(recipient=result.recipient, text=result.text, label=label)
+                    else:
+                        sms_credit.refund(result.tag)
+                        logger.error("Cyclic revival %s SMS not sent to %s: %s" % (revival.id, result.recipient, result.error))
+            finally:
+                mail_credit.release()
+                sms_credit.release()
+            if sms_sent:
+                total_sms += sms_sent
+                increment_history_field(profile_tag, 'cyclic_revival_sms_history', sms_sent)
+            revival.is_running = False
+            revival.save()
+        finally:
+            try:
+                close_smtp_connection(connection)
+            except:
+                pass
         diff = datetime.now() - t0
         logger.debug("%d revivals run. %d mails and %d SMS sent in %s" % (total_revival, total_mail, total_sms, diff))
 
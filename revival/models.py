@@ -7,7 +7,7 @@ from django.utils.translation import gettext_lazy as _
 from django.db import models
 from djangotoolbox.fields import ListField
 
-from ikwen.core.fields import MultiImageField
+from ikwen.core.fields import MultiImageField, HistoryField
 from ikwen.core.constants import PENDING
 from ikwen.core.models import Model, Service, AbstractWatchModel
 from ikwen.accesscontrol.models import Member
@@ -20,9 +20,9 @@ class ProfileTag(AbstractWatchModel):
     is_active = models.BooleanField(default=True)
     is_reserved = models.BooleanField(default=False)
     is_auto = models.BooleanField(default=False)
-    smart_revival_history = ListField()
-    cyclic_revival_mail_history = ListField()
-    cyclic_revival_sms_history = ListField()
+    smart_revival_history = HistoryField()
+    cyclic_revival_mail_history = HistoryField()
+    cyclic_revival_sms_history = HistoryField()
 
     smart_total_revival = models.IntegerField(default=0)
     total_cyclic_mail_revival = models.IntegerField(default=0)
@@ -101,7 +101,7 @@ class CyclicRevival(Model):
 class MemberProfile(Model):
     member = models.ForeignKey(Member, unique=True)
     tag_list = ListField()
-    tag_fk_list = ListField()
+    tag_fk_list = ListField(db_index=True)
 
 
 class ObjectProfile(Model):
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs smart and cyclic revivals of all Services in parallel.
+
+Revivals are grouped by Service and each Service is handed to one process of a pool,
+where its revivals run one after the other exactly as the smart_revival_crons and
+cyclic_revival_cron scripts do. So a Service with a large audience only keeps one
+worker busy, while campaigns of other Services go on in the remaining workers.
+SMTP connections opened by all workers are bounded by a shared semaphore.
+
+Run it from the crontab every hour in place of both scripts:
+python revival_runner.py [debug] [--workers=4] [--smtp-connections=8]
+"""
+import os
+import sys
+
+sys.path.append("/home/libran/virtualenv/lib/python2.7/site-packages")
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ikwen.conf.settings")
+
+import logging.handlers
+from datetime import datetime
+from multiprocessing import Pool, BoundedSemaphore
+
+from django.db import connections
+from django.db.models import Q
+from django.utils.log import AdminEmailHandler
+
+from ikwen.core.constants import COMPLETE, STARTED
+from ikwen.revival.models import Revival, CyclicRevival
+from ikwen.core.utils import set_smtp_slots
+from ikwen.revival import smart_revival_crons, cyclic_revival_cron
+
+logger = logging.getLogger('crons.error')
+logger.setLevel(logging.DEBUG)
+file_handler = logging.handlers.RotatingFileHandler('revival_runner.log', 'w', 1000000, 4)
+file_handler.setLevel(logging.INFO)
+f = logging.Formatter('%(levelname)-10s %(asctime)-27s %(message)s')
+file_handler.setFormatter(f)
+email_handler = AdminEmailHandler()
+email_handler.setLevel(logging.ERROR)
+email_handler.setFormatter(f)
+logger.addHandler(file_handler)
+logger.addHandler(email_handler)
+
+DEFAULT_WORKERS = 4
+DEFAULT_SMTP_CONNECTIONS = 8
+MAX_TASKS_PER_CHILD = 20  # Worker processes are recycled after that many Services
+
+
+def _close_db_connections():
+    for connection in connections.all():
+        try:
+            connection.close()
+        except:
+            pass
+
+
+def _init_worker(smtp_slots):
+    # Connections inherited from the parent process must not be shared
+    _close_db_connections()
+    set_smtp_slots(smtp_slots)
+
+
+def get_service_id_list():
+    """
+    Ids of Services having at least a revival that any of the revival crons would run now.
+    """
+    now = datetime.now()
+    today = now.date()
+    queryset_list = [
+        Revival.objects.exclude(status=COMPLETE, is_active=False),
+        Revival.objects.filter(Q(status=COMPLETE) | Q(status=STARTED), is_active=True),
+        CyclicRevival.objects.filter(next_run_on=today, hour_of_sending=now.hour, end_on__gt=today, is_active=True)
+    ]
+    service_id_list = []
+    for queryset in queryset_list:
+        for revival in queryset.filter(is_running=False):
+            if revival.service_id not in service_id_list:
+                service_id_list.append(revival.service_id)
+    return service_id_list
+
+
+def run_service_revivals(service_id, debug=False):
+    """
+    Runs all revivals of a Service. Errors are logged so that they never stop other Services.
+    """
+    t0 = datetime.now()
+    for run in (smart_revival_crons.notify_profiles, smart_revival_crons.notify_profiles_retro,
+                smart_revival_crons.rerun_complete_revivals, cyclic_revival_cron.notify_profiles):
+        try:
+            run(debug, service_id=service_id)
+        except:
+            logger.error(u"%s failed for Service %s" % (run.__name__, service_id), exc_info=True)
+    return service_id, datetime.now() - t0
+
+
+def _run_service_revivals(args):
+    return run_service_revivals(*args)
+
+
+def run(debug=False, workers=DEFAULT_WORKERS, smtp_connections=DEFAULT_SMTP_CONNECTIONS):
+    t0 = datetime.now()
+    service_id_list = get_service_id_list()
+    logger.debug(u"Running revivals of %d Services with %d workers" % (len(service_id_list), workers))
+    if not service_id_list:
+        return
+    _close_db_connections()
+    smtp_slots = BoundedSemaphore(smtp_connections)
+    pool = Pool(workers, _init_worker, (smtp_slots,), MAX_TASKS_PER_CHILD)
+    try:
+        args_list = [(service_id, debug) for service_id in service_id_list]
+        for service_id, duration in pool.imap_unordered(_run_service_revivals, args_list):
+            logger.debug(u"Revivals of Service %s run in %s" % (service_id, duration))
+    finally:
+        pool.close()
+        pool.join()
+    logger.debug(u"Revivals of %d Services run in %s" % (len(service_id_list), datetime.now() - t0))
+
+
+def _get_option(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith('--%s=' % name):
+            return int(arg.split('=')[1])
+    return default
+
+
+if __name__ == "__main__":
+    try:
+        DEBUG = 'debug' in sys.argv[1:]
+        run(DEBUG, _get_option('workers', DEFAULT_WORKERS),
+            _get_option('smtp-connections', DEFAULT_SMTP_CONNECTIONS))
+    except:
+        logger.error(u"Fatal error occured, revivals not run", exc_info=True)
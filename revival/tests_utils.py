@@ -8,8 +8,8 @@ from django.test.utils import override_settings
 from django.utils import unittest
 
 from ikwen.accesscontrol.backends import UMBRELLA
-from ikwen.revival.models import ProfileTag, CyclicRevival, MemberProfile
-from ikwen.revival.utils import reset_profile_tag_member_count
+from ikwen.revival.models import ProfileTag, CyclicRevival, MemberProfile, Revival, Target
+from ikwen.revival.utils import reset_profile_tag_member_count, select_revival_targets
 from ikwen.revival.tests_views import wipe_test_data
 
 
@@ -47,6 +47,21 @@ class RevivalUtilsTestCase(unittest.TestCase):
         self.assertEqual(profile_tag2.member_count, 3)
         self.assertEqual(profile_tag3.member_count, 3)
 
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102', UNIT_TESTING=True)
+    def test_select_revival_targets(self):
+        """
+        Targets are created once for each Member with email tagged with the
+        revival ProfileTag. Running the selection again creates nothing new.
+        """
+        revival = Revival.objects.get(pk='58eb3eb637b33795ddfd04b1')
+        matched, created = select_revival_targets(revival, 'default')
+        self.assertEqual(matched, created)
+        self.assertEqual(Target.objects.filter(revival=revival).count(), created)
+        matched2, created2 = select_revival_targets(revival, 'default')
+        self.assertEqual(matched2, matched)
+        self.assertEqual(created2, 0)
+        self.assertGreaterEqual(MemberProfile.objects.filter(tag_fk_list=revival.profile_tag_id).count(), matched)
+
     @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
     def test_CyclicRevival_set_next_run_date_with_days_cycle(self):
         """
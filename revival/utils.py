@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
+from random import random
+
+from bson import ObjectId
 from django.conf import settings
 from django.core.exceptions import MultipleObjectsReturned
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from ikwen.accesscontrol.models import Member
-from ikwen.core.utils import get_mail_content
-from ikwen.revival.models import MemberProfile, ProfileTag
+from ikwen.core.utils import get_mail_content, get_collection
+from ikwen.revival.models import MemberProfile, ProfileTag, Target
+
+TARGETING_BATCH_SIZE = 1000
 
 
 def reset_profile_tag_member_count():
@@ -66,6 +72,87 @@ def set_profile_tag_member_count(member, previous_tag_fk_list=[]):
             continue
 
 
+def claim_revival(revival, using='default'):
+    """
+    Atomically marks *revival* (a Revival or a CyclicRevival) as running, unless
+    it already is. Only the process that gets True must run it, then set
+    is_running back to False when done.
+    """
+    collection = get_collection(type(revival), using)
+    query = {'_id': ObjectId(revival.id), 'is_running': {'$ne': True}}
+    update = {'$set': {'is_running': True, 'updated_on': timezone.now()}}
+    if collection.find_and_modify(query, update, fields={'_id': 1}) is None:
+        return False
+    revival.is_running = True
+    return True
+
+
+def create_missing_member_profiles(using, member_spec=None):
+    """
+    Creates the MemberProfile of Members matching the raw Mongo *member_spec* that
+    have none yet, tagging them with the REFERRAL ProfileTag. Ids of existing profiles
+    and Members are fetched with projections and missing profiles inserted in bulk.
+
+    :return: Number of MemberProfile created
+    """
+    from ikwen.rewarding.utils import REFERRAL
+    profile_collection = get_collection(MemberProfile, using)
+    profiled = set(doc['member_id'] for doc in profile_collection.find({}, {'member_id': 1}))
+    missing = [doc['_id'] for doc in get_collection(Member, using).find(member_spec or {}, {'_id': 1})
+               if doc['_id'] not in profiled]
+    if not missing:
+        return 0
+    ref_tag = ProfileTag.objects.using(using).get(slug=REFERRAL)
+    now = timezone.now()
+    for i in range(0, len(missing), TARGETING_BATCH_SIZE):
+        profile_collection.insert([{'member_id': member_id, 'tag_list': [], 'tag_fk_list': [ref_tag.id],
+                                    'created_on': now, 'updated_on': now}
+                                   for member_id in missing[i:i + TARGETING_BATCH_SIZE]])
+    return len(missing)
+
+
+def select_revival_targets(revival, using, member_spec=None):
+    """
+    Creates the missing Target of *revival*: Members with an email, matching the raw
+    Mongo *member_spec* and whose MemberProfile is tagged with revival.profile_tag_id.
+
+    Candidates are resolved with a single query on the indexed MemberProfile.tag_fk_list,
+    then filtered on Members in batches of TARGETING_BATCH_SIZE ids. New Target are
+    inserted in bulk rather than with a get_or_create() per Member.
+
+    :param revival: Revival as found in the *using* database
+    :param using: database of the Service running the revival
+    :param member_spec: Mongo query restricting Members. Eg: {'date_joined': {'$lte': some_date}}
+    :return: tuple (number of Members targeted, number of Target created)
+    """
+    create_missing_member_profiles(using, member_spec)
+    revival_id = ObjectId(revival.id)
+    profile_cursor = get_collection(MemberProfile, using).find({'tag_fk_list': revival.profile_tag_id},
+                                                               {'member_id': 1})
+    candidate_id_list = [doc['member_id'] for doc in profile_cursor.batch_size(TARGETING_BATCH_SIZE)]
+    member_collection = get_collection(Member, using)
+    target_collection = get_collection(Target, using)
+    existing = set(doc['member_id'] for doc in target_collection.find({'revival_id': revival_id}, {'member_id': 1}))
+    now = timezone.now()
+    matched, created = 0, 0
+    for i in range(0, len(candidate_id_list), TARGETING_BATCH_SIZE):
+        spec = dict(member_spec or {})
+        spec['_id'] = {'$in': candidate_id_list[i:i + TARGETING_BATCH_SIZE]}
+        spec['email'] = {'$nin': [None, '']}
+        new_target_list = []
+        for doc in member_collection.find(spec, {'_id': 1}):
+            matched += 1
+            if doc['_id'] in existing:
+                continue
+            new_target_list.append({'revival_id': revival_id, 'member_id': doc['_id'], 'revival_count': 0,
+                                    'notified': False, 'revived_on': None, 'rand': random(),
+                                    'created_on': now, 'updated_on': now})
+        if new_target_list:
+            target_collection.insert(new_target_list)
+            created += len(new_target_list)
+    return matched, created
+
+
 def render_suggest_create_account_mail(target, service, revival, **kwargs):
     if not target.member.is_ghost:
         return None, None, None